@@ -1,19 +1,24 @@
 # -*- coding: utf-8 -*-
-from pioreactor.actions import add_alt_media
-from pioreactor.actions import add_media
-from pioreactor.actions import remove_waste
-from pioreactor.actions import od_normalization
-from pioreactor.actions import led_intensity
-from pioreactor.actions.leader import download_experiment_data
-from pioreactor.actions.leader import backup_database
+import importlib
 
+# actions are imported on first access, so importing one action (or the CLI) doesn't import all of them.
+_actions = {
+    "download_experiment_data": "pioreactor.actions.leader.download_experiment_data",
+    "backup_database": "pioreactor.actions.leader.backup_database",
+    "replay_growth_rate": "pioreactor.actions.leader.replay_growth_rate",
+    "migrate_database": "pioreactor.actions.leader.migrate_database",
+    "od_normalization": "pioreactor.actions.od_normalization",
+    "remove_waste": "pioreactor.actions.remove_waste",
+    "add_media": "pioreactor.actions.add_media",
+    "add_alt_media": "pioreactor.actions.add_alt_media",
+    "led_intensity": "pioreactor.actions.led_intensity",
+}
 
-__all__ = (
-    download_experiment_data,
-    backup_database,
-    od_normalization,
-    remove_waste,
-    add_media,
-    add_alt_media,
-    led_intensity,
-)
+
+__all__ = tuple(_actions)
+
+
+def __getattr__(name):
+    if name in _actions:
+        return importlib.import_module(_actions[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
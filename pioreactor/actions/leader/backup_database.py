@@ -2,8 +2,9 @@
 
 import logging
 import click
-from pioreactor.config import config, get_active_workers_in_inventory
+from pioreactor.config import get_active_workers_in_inventory
 from pioreactor.whoami import get_unit_name
+from pioreactor.storage import read_connection
 
 logger = logging.getLogger("backup_database")
 
@@ -24,14 +25,13 @@ def backup_database(output):
 
     logger.debug(f"Starting backup of database to {output}")
 
-    con = sqlite3.connect(config.get("storage", "database"))
     bck = sqlite3.connect(output)
 
-    with bck:
+    # a read-only connection is enough, and in WAL mode doesn't block the MQTT to DB streamer.
+    with read_connection() as con, bck:
         con.backup(bck, pages=-1, progress=progress)
 
     bck.close()
-    con.close()
     logger.debug(
         f"Completed backup of database to {output}. Attempting distributed backup..."
     )
@@ -1,50 +1,327 @@
 # -*- coding: utf-8 -*-
 # download experiment data
 # See create_tables.sql for all tables
+#
+# Rows are streamed from the database straight into the zip, so exporting doesn't need free space for
+# an uncompressed copy of the data, and memory use doesn't grow with the size of the export.
+#
+# Two formats:
+#  - csv (default): a zip of one CSV per table.
+#  - npz: typed columns, one .npy per column, named <table>/<column>. Timestamps are int64 milliseconds
+#    since the epoch (UTC), text columns are dictionary encoded: <table>/<column> holds int32 codes
+#    (-1 for NULL) into <table>/<column>.categories. The npz is uncompressed, so it loads with
+#    `numpy.load(path)`, or without copying with `load_npz(path)`. For pandas:
+#
+#        pd.Categorical.from_codes(data["od_readings_raw/angle"], data["od_readings_raw/angle.categories"])
 
-import os
 from datetime import datetime
 import logging
 import click
 from pioreactor.whoami import get_latest_experiment_name
-from pioreactor.config import config
+from pioreactor.storage import read_connection
 
 logger = logging.getLogger("download_experiment_data")
 
+ISO_TIMESTAMP = (
+    "strftime('%Y-%m-%dT%H:%M:%fZ', timestamp / 1000.0, 'unixepoch') AS timestamp"
+)
 
-def download_experiment_data(experiment, output, tables):
-    import sqlite3
-    import zipfile
+FORMATS = ("csv", "npz")
+
+# REAL columns are float64, except these.
+NPZ_DTYPES = {"od_reading_v": "float32"}
+
+# a series is the rows of a table that downsampling thins out together, ex: one sensor's readings.
+SERIES_COLUMNS = ("pioreactor_unit", "angle")
+
+
+def to_milliseconds(dt):
+    # naive datetimes are local time, like the rest of the CLI.
+    return None if dt is None else int(dt.timestamp() * 1000)
+
+
+def is_time_series(columns):
+    # tables with an INTEGER timestamp. Others, like experiments, aren't filtered on time, ordered, or
+    # downsampled.
+    return ("timestamp", "INTEGER") in columns
+
+
+def is_unmigrated(table, columns):
+    # before migrate_database, these tables' timestamps were TEXT, and can't be compared to start_time
+    # or end_time.
+    from pioreactor.actions.leader.migrate_database import TIME_SERIES_TABLES
+
+    return table in TIME_SERIES_TABLES and not is_time_series(columns)
+
+
+def create_query(table, columns, start_time=None, end_time=None, iso_timestamps=True):
+    """
+    Returns the query, and the series columns, for exporting `table`. `columns` is the table's
+    [(name, type)]. Only time series tables (see `is_time_series`) are filtered on time and ordered.
+    """
+    time_series = is_time_series(columns)
+    names = [name for name, _ in columns]
+
+    selects = [
+        (
+            ISO_TIMESTAMP
+            if (name == "timestamp" and time_series and iso_timestamps)
+            else name
+        )
+        for name in names
+    ]
+    wheres = ["experiment=:experiment"]
+    series = []
+    order_by = ""
+
+    if time_series:
+        if start_time is not None:
+            wheres.append("timestamp >= :start_time")
+        if end_time is not None:
+            wheres.append("timestamp < :end_time")
+
+        # ordered like most of the tables' indexes, (experiment, <series>, timestamp), so those need no
+        # sort. logs is indexed on (experiment, timestamp), so it's sorted.
+        series = [name for name in SERIES_COLUMNS if name in names]
+        order_by = f"ORDER BY {', '.join(series + ['timestamp'])}"
+
+    query = f"""
+        SELECT {", ".join(selects)}, {"timestamp" if time_series else "NULL"} AS _ms
+        FROM {table}
+        WHERE {" AND ".join(wheres)}
+        {order_by}
+    """
+    return query, [names.index(name) for name in series]
+
+
+def fetch_in_chunks(cursor, chunksize, table, progress=None):
+    n_rows = 0
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            return
+
+        yield from rows
+        n_rows += len(rows)
+        if progress is not None:
+            progress(table, n_rows)
+
+
+def downsample(rows, series_indexes, every_n_ms):
+    """
+    Keep at most one row every `every_n_ms` milliseconds per series. Rows end with their timestamp
+    in milliseconds, which is removed. Rows without a timestamp are all kept.
+    """
+    last_kept = {}
+    for row in rows:
+        *row, ms = row
+        if every_n_ms and ms is not None:
+            key = tuple(row[i] for i in series_indexes)
+            if key in last_kept and ms < last_kept[key] + every_n_ms:
+                continue
+            last_kept[key] = ms
+        yield row
+
+
+def write_csv(zf, filename, columns, rows):
     import csv
+    import io
+
+    # force_zip64, since we don't know the size of the entry before writing it.
+    with zf.open(filename, "w", force_zip64=True) as entry, io.TextIOWrapper(
+        entry, encoding="utf-8", newline=""
+    ) as csv_file:
+        csv_writer = csv.writer(csv_file, delimiter=",")
+        csv_writer.writerow([name for name, _ in columns])
+        csv_writer.writerows(rows)
+
+
+def write_npz_columns(zf, table, columns, rows, chunksize=10000):
+    """
+    A zip can only write one member at a time, so each column is spooled to a temporary file (in its
+    binary form, much smaller than CSV), then copied into the zip once the number of rows is known.
+    """
+    import numpy as np
+    import tempfile
+    import shutil
+    from itertools import islice
+
+    dtypes = [
+        np.dtype(
+            NPZ_DTYPES.get(
+                name, {"INTEGER": "int64", "REAL": "float64"}.get(type_, "int32")
+            )
+        )
+        for name, type_ in columns
+    ]
+    # text column -> {value: code}
+    categories = {
+        i: {} for i, (_, type_) in enumerate(columns) if type_ not in ("INTEGER", "REAL")
+    }
+    spools = [tempfile.TemporaryFile() for _ in columns]
+
+    n_rows = 0
+    while True:
+        chunk = list(islice(rows, chunksize))
+        if not chunk:
+            break
+        n_rows += len(chunk)
+
+        for i, values in enumerate(zip(*chunk)):
+            if i in categories:
+                codes = categories[i]
+                values = [
+                    -1 if v is None else codes.setdefault(v, len(codes)) for v in values
+                ]
+            else:
+                values = [np.nan if v is None else v for v in values]
+            spools[i].write(np.asarray(values, dtype=dtypes[i]).tobytes())
+
+    for i, ((name, _), dtype, spool) in enumerate(zip(columns, dtypes, spools)):
+        with spool, zf.open(f"{table}/{name}.npy", "w", force_zip64=True) as entry:
+            header = {
+                "descr": np.lib.format.dtype_to_descr(dtype),
+                "fortran_order": False,
+                "shape": (n_rows,),
+            }
+            np.lib.format.write_array_header_1_0(entry, header)
+            spool.seek(0)
+            shutil.copyfileobj(spool, entry)
+
+        if i in categories:
+            with zf.open(
+                f"{table}/{name}.categories.npy", "w", force_zip64=True
+            ) as entry:
+                np.lib.format.write_array(entry, np.array(list(categories[i]), dtype=str))
+
+
+def load_npz(path):
+    """
+    Memory map each column of an npz export, without reading it into memory. Returns a dict of
+    "<table>/<column>" -> numpy array, like `numpy.load(path)`.
+    """
+    import numpy as np
+    import zipfile
+    import struct
+
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(
+                    f"{info.filename} is compressed, and can't be memory mapped."
+                )
+
+            # skip the member's local header to get to the .npy
+            f.seek(info.header_offset)
+            *_, name_length, extra_length = struct.unpack("<4s5H3L2H", f.read(30))
+            f.seek(name_length + extra_length, 1)
+
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            arrays[info.filename[: -len(".npy")]] = np.memmap(
+                path,
+                dtype=dtype,
+                mode="r",
+                offset=f.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+
+def download_experiment_data(
+    experiment,
+    output,
+    tables,
+    start_time=None,
+    end_time=None,
+    downsample_seconds=None,
+    progress=None,
+    chunksize=10000,
+    format="csv",
+):
+    """
+    Parameters
+    -----------
+    start_time, end_time: datetime
+        only export rows of time series tables in [start_time, end_time). Tables that haven't been
+        migrated (see migrate_database) can't be filtered or downsampled, and raise a ValueError.
+    downsample_seconds: float
+        keep at most one row every `downsample_seconds` for each Pioreactor (and sensor) in
+        time series tables.
+    progress: callable
+        called as progress(table, n_rows) after each chunk of rows, with the rows read so far.
+    format: str
+        "csv" or "npz", see above.
+    """
+    import zipfile
+
+    if format not in FORMATS:
+        raise ValueError(f"format must be one of {FORMATS}, not {format}.")
 
     if experiment == "current":
         experiment = get_latest_experiment_name()
 
     logger.info("Starting export of data.")
 
+    params = {
+        "experiment": experiment,
+        "start_time": to_milliseconds(start_time),
+        "end_time": to_milliseconds(end_time),
+    }
+    every_n_ms = int(downsample_seconds * 1000) if downsample_seconds else None
+
     time = datetime.now().strftime("%Y%m%d%H%m%S")
-    zf = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED)
-    con = sqlite3.connect(config["storage"]["database"])
+    # npz members are stored uncompressed, so they can be memory mapped.
+    compression = zipfile.ZIP_DEFLATED if format == "csv" else zipfile.ZIP_STORED
+    is_filtered = start_time is not None or end_time is not None or every_n_ms is not None
+    with read_connection() as con:
+        existing_tables = {
+            name
+            for (name,) in con.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'"
+            )
+        }
 
-    for table in tables:
-        _filename = f"{experiment}-{table}-{time}.dump.csv".replace(" ", "_")
-        path_to_file = os.path.join(os.path.dirname(output), _filename)
+        # check every table before we start writing.
+        columns_by_table = {}
+        for table in tables:
+            # table names can't be query parameters, so only allow real tables.
+            if table not in existing_tables:
+                raise ValueError(f"{table} is not a table in the database.")
 
-        query = f"""
-            SELECT * from {table} WHERE experiment="{experiment}"
-        """
-        cursor = con.cursor()
-        cursor.execute(query)
+            columns = [
+                (name, type_.upper())
+                for _, name, type_, *_ in con.execute(f"PRAGMA table_info({table})")
+            ]
+            if is_filtered and is_unmigrated(table, columns):
+                raise ValueError(
+                    f"{table} hasn't been migrated, so it can't be filtered on time or "
+                    "downsampled. Run `pio run migrate_database` first."
+                )
+            columns_by_table[table] = columns
 
-        with open(path_to_file, "w") as csv_file:
-            csv_writer = csv.writer(csv_file, delimiter=",")
-            csv_writer.writerow([i[0] for i in cursor.description])
-            csv_writer.writerows(cursor)
+        with zipfile.ZipFile(output, "w", compression) as zf:
+            for table, columns in columns_by_table.items():
+                query, series_indexes = create_query(
+                    table, columns, start_time, end_time, iso_timestamps=(format == "csv")
+                )
+                cursor = con.execute(query, params)
 
-        zf.write(path_to_file, arcname=_filename)
+                rows = downsample(
+                    fetch_in_chunks(cursor, chunksize, table, progress),
+                    series_indexes,
+                    every_n_ms if is_time_series(columns) else None,
+                )
 
-    con.close()
-    zf.close()
+                if format == "csv":
+                    _filename = f"{experiment}-{table}-{time}.dump.csv".replace(" ", "_")
+                    write_csv(zf, _filename, columns, rows)
+                else:
+                    write_npz_columns(zf, table, columns, rows)
 
     logger.info("Completed export of data.")
     return
@@ -54,8 +331,31 @@ def download_experiment_data(experiment, output, tables):
 @click.option("--experiment", default="current")
 @click.option("--output", default="/home/pi/exports/export.zip")
 @click.option("--tables", multiple=True, default=[])
-def click_download_experiment_data(experiment, output, tables):
+@click.option("--format", type=click.Choice(FORMATS), default="csv", show_default=True)
+@click.option("--start-time", type=click.DateTime(), help="local time")
+@click.option("--end-time", type=click.DateTime(), help="local time")
+@click.option(
+    "--downsample-seconds",
+    type=float,
+    help="keep at most one reading per sensor every this many seconds",
+)
+def click_download_experiment_data(
+    experiment, output, tables, format, start_time, end_time, downsample_seconds
+):
     """
     (leader only) Export tables from db.
     """
-    return download_experiment_data(experiment, output, tables)
+
+    def progress(table, n_rows):
+        logger.debug(f"Exported {n_rows} rows from {table}.")
+
+    return download_experiment_data(
+        experiment,
+        output,
+        tables,
+        start_time=start_time,
+        end_time=end_time,
+        downsample_seconds=downsample_seconds,
+        progress=progress,
+        format=format,
+    )
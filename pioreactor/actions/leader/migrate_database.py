@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Bring an existing database up to the schema in sql/create_tables.sql.
+
+Version 1 stores timestamps in the time series tables as INTEGER milliseconds since the unix epoch (UTC),
+instead of local-time ISO8601 TEXT, and replaces the indexes with ones ending in timestamp. Rows whose
+timestamp can't be parsed are moved to <table>_unparseable, and counted in the logs.
+
+>>> pio run migrate_database
+
+The migration runs in a single transaction, so if anything fails the database is left as it was. Stop
+mqtt_to_db_streaming first, else it waits on the migration's lock.
+"""
+import logging
+import click
+
+from pioreactor.storage import connect_writer, get_schema_version, SCHEMA_VERSION
+
+logger = logging.getLogger("migrate_database")
+
+# table -> its index's columns. Keep in sync with sql/create_tables.sql.
+TIME_SERIES_TABLES = {
+    "od_readings_raw": (
+        "experiment",
+        "pioreactor_unit",
+        "angle",
+        "timestamp",
+        "od_reading_v",
+    ),
+    "od_readings_filtered": (
+        "experiment",
+        "pioreactor_unit",
+        "angle",
+        "timestamp",
+        "od_reading_v",
+    ),
+    "growth_rates": ("experiment", "pioreactor_unit", "timestamp", "rate"),
+    "alt_media_fraction": ("experiment", "pioreactor_unit", "timestamp"),
+    "dosing_events": ("experiment", "pioreactor_unit", "timestamp"),
+    "led_events": ("experiment", "pioreactor_unit", "timestamp"),
+    "logs": ("experiment", "timestamp"),
+    "pid_logs": ("experiment", "pioreactor_unit", "timestamp"),
+}
+
+# Old rows were written with datetime.now().isoformat(), i.e. local time. The 'utc' modifier converts
+# local time to UTC. Rows that are only digits are already in milliseconds (written by a new
+# mqtt_to_db_streaming before the migration ran).
+IS_MILLISECONDS = "(timestamp <> '' AND timestamp NOT GLOB '*[^0-9]*')"
+
+TEXT_TO_MILLISECONDS = f"""
+    CASE
+        WHEN {IS_MILLISECONDS} THEN CAST(timestamp AS INTEGER)
+        ELSE CAST(ROUND((julianday(timestamp, 'utc') - 2440587.5) * 86400000) AS INTEGER)
+    END
+"""
+
+# COALESCE, since a NULL timestamp makes the condition NULL, not false.
+IS_PARSEABLE = f"COALESCE({IS_MILLISECONDS} OR julianday(timestamp) IS NOT NULL, 0)"
+
+
+def migrate_table(con, table, index_columns):
+    """
+    Returns the number of rows that couldn't be migrated. They're moved to <table>_unparseable.
+    """
+    columns = con.execute(f"PRAGMA table_info({table})").fetchall()
+    if not columns:
+        logger.debug(f"{table} doesn't exist, skipping.")
+        return 0
+
+    # (cid, name, type, notnull, default, pk)
+    timestamp_type = next(type_ for _, name, type_, *_ in columns if name == "timestamp")
+
+    con.execute(f"DROP INDEX IF EXISTS {table}_ix")
+
+    n_unparseable = 0
+    if timestamp_type.upper() != "INTEGER":
+        con.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+        con.execute(
+            f"CREATE TABLE {table} ({', '.join(column_definition(c) for c in columns)})"
+        )
+
+        names = [name for _, name, *_ in columns]
+        selects = [
+            TEXT_TO_MILLISECONDS if name == "timestamp" else name for name in names
+        ]
+        con.execute(f"""
+            INSERT INTO {table} ({', '.join(names)})
+            SELECT {', '.join(selects)} FROM {table}_old
+            WHERE {IS_PARSEABLE}
+            """)
+
+        (n_unparseable,) = con.execute(
+            f"SELECT COUNT(*) FROM {table}_old WHERE NOT {IS_PARSEABLE}"
+        ).fetchone()
+        if n_unparseable:
+            con.execute(f"""
+                CREATE TABLE {table}_unparseable AS
+                SELECT * FROM {table}_old WHERE NOT {IS_PARSEABLE}
+                """)
+            logger.warning(
+                f"Moved {n_unparseable} rows with unparseable timestamps from {table} to "
+                f"{table}_unparseable."
+            )
+
+        con.execute(f"DROP TABLE {table}_old")
+
+    con.execute(f"CREATE INDEX {table}_ix ON {table} ({', '.join(index_columns)})")
+    logger.debug(f"Migrated {table}.")
+    return n_unparseable
+
+
+def column_definition(column):
+    _, name, type_, notnull, default, _ = column
+    if name == "timestamp":
+        type_ = "INTEGER"
+    return " ".join(
+        [name, type_]
+        + (["NOT NULL"] if notnull else [])
+        + ([f"DEFAULT {default}"] if default is not None else [])
+    )
+
+
+def migrate_database(database=None):
+    # isolation_level=None, so we control the transaction: the sqlite3 module won't begin one for DDL.
+    con = connect_writer(database, isolation_level=None)
+
+    schema_version = get_schema_version(con)
+    if schema_version >= SCHEMA_VERSION:
+        logger.info(f"Database is already at schema version {schema_version}.")
+        con.close()
+        return
+
+    logger.info(
+        f"Starting migration of database from schema version {schema_version} to "
+        f"{SCHEMA_VERSION}."
+    )
+
+    n_unparseable = 0
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        for table, index_columns in TIME_SERIES_TABLES.items():
+            n_unparseable += migrate_table(con, table, index_columns)
+        con.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    except Exception:
+        con.execute("ROLLBACK")
+        con.close()
+        logger.error("Migration failed, the database is unchanged.")
+        raise
+    con.execute("COMMIT")
+
+    # the old tables' pages are free now, give them back to the SD card.
+    con.execute("VACUUM")
+    con.close()
+
+    logger.info(
+        f"Completed migration of database. {n_unparseable} rows had unparseable timestamps."
+    )
+    return
+
+
+@click.command(name="migrate_database")
+def click_migrate_database():
+    """
+    (leader only) Migrate the db to the latest schema.
+    """
+    return migrate_database()
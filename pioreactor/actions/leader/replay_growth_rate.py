@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Reconstruct growth rates and filtered ODs for an experiment from the raw OD readings in the database, by
+replaying them through the same Kalman filter that growth_rate_calculating uses live. Useful if
+growth_rate_calculating wasn't running, or to try different [growth_rate_kalman] settings after the fact.
+
+>>> pio run replay_growth_rate --experiment trial15 --unit pioreactor1 --overwrite
+
+"""
+
+import logging
+from statistics import median, variance
+
+import click
+
+from pioreactor.whoami import get_latest_experiment_name
+from pioreactor.config import config
+from pioreactor.storage import connect_writer
+
+logger = logging.getLogger("replay_growth_rate")
+
+# same as od_normalization
+N_NORMALIZATION_SAMPLES = 35
+
+
+def yield_batches(cursor, angles, chunksize):
+    """
+    The database has one row per reading. Group the rows (ordered by time) back into batches, one reading
+    per angle, like od_raw_batched. A batch's timestamp is its last reading's.
+    """
+    batch = {}
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            return
+
+        for timestamp, angle, od_reading_v in rows:
+            if angle in batch:
+                # we missed a reading for some angle, start over with this one.
+                batch = {}
+            batch[angle] = od_reading_v
+
+            if len(batch) == len(angles):
+                yield timestamp, [batch[angle] for angle in angles]
+                batch = {}
+
+
+def replay_growth_rate(
+    experiment,
+    unit,
+    overwrite=False,
+    chunksize=10000,
+    rate_variance=None,
+    od_variance=None,
+):
+    import numpy as np
+    from pioreactor.background_jobs.growth_rate_calculating import (
+        create_extended_kalman_filter,
+        DOSING_EVENT_OD_VARIANCE_FACTOR,
+    )
+
+    if experiment == "current":
+        experiment = get_latest_experiment_name()
+
+    logger.info(f"Starting replay of growth rates for {unit} in {experiment}.")
+
+    samples_per_second = config.getfloat("od_config.od_sampling", "samples_per_second")
+    dt = 1 / samples_per_second / 60 / 60
+    samples_per_minute = 60 * samples_per_second
+
+    con = connect_writer()
+    params = {"experiment": experiment, "unit": unit}
+
+    # match the live job: sorted in reverse, and 180 degree sensors are ignored.
+    angles = sorted(
+        (
+            angle
+            for (angle,) in con.execute(
+                "SELECT DISTINCT angle FROM od_readings_raw WHERE experiment=:experiment AND pioreactor_unit=:unit",
+                params,
+            )
+            if not angle.startswith("180")
+        ),
+        reverse=True,
+    )
+    if not angles:
+        con.close()
+        raise ValueError(f"No OD readings found for {unit} in {experiment}.")
+
+    existing_rows = con.execute(
+        "SELECT COUNT(*) FROM growth_rates WHERE experiment=:experiment AND pioreactor_unit=:unit",
+        params,
+    ).fetchone()[0]
+    if existing_rows and not overwrite:
+        con.close()
+        raise ValueError(
+            f"growth_rates already has rows for {unit} in {experiment}. Use --overwrite to replace them."
+        )
+
+    dosing_event_timestamps = [
+        timestamp
+        for (timestamp,) in con.execute(
+            "SELECT timestamp FROM dosing_events WHERE experiment=:experiment AND pioreactor_unit=:unit ORDER BY timestamp",
+            params,
+        )
+    ]
+
+    readings_query = f"""
+        SELECT timestamp, angle, od_reading_v FROM od_readings_raw
+        WHERE experiment=:experiment AND pioreactor_unit=:unit
+        AND angle IN ({", ".join(f":angle{i}" for i in range(len(angles)))})
+        ORDER BY timestamp
+    """
+    readings_params = {**params, **{f"angle{i}": angle for i, angle in enumerate(angles)}}
+
+    # like od_normalization, use the first readings to compute each sensor's median and variance.
+    first_batches = []
+    for _, batch in yield_batches(
+        con.execute(readings_query, readings_params), angles, chunksize
+    ):
+        first_batches.append(batch)
+        if len(first_batches) == N_NORMALIZATION_SAMPLES:
+            break
+
+    if len(first_batches) < 2:
+        con.close()
+        raise ValueError(f"Not enough OD readings for {unit} in {experiment}.")
+
+    first_batches = np.array(first_batches)
+    medians = np.array([median(series) for series in first_batches.T])
+    od_variances = {
+        angle: variance(series) for angle, series in zip(angles, first_batches.T)
+    }
+
+    batches = yield_batches(
+        con.execute(readings_query, readings_params), angles, chunksize
+    )
+    _, first_batch = next(batches)
+    ekf = create_extended_kalman_filter(
+        dict(zip(angles, np.array(first_batch) / medians)),
+        0.0,
+        od_variances,
+        dt,
+        rate_variance=rate_variance,
+        od_variance=od_variance,
+    )
+
+    # we write with the same connection we are reading from, else our open read
+    # cursor would hold a lock that blocks our writes.
+    if overwrite:
+        with con:
+            con.execute(
+                "DELETE FROM growth_rates WHERE experiment=:experiment AND pioreactor_unit=:unit",
+                params,
+            )
+            con.execute(
+                "DELETE FROM od_readings_filtered WHERE experiment=:experiment AND pioreactor_unit=:unit",
+                params,
+            )
+
+    def flush(growth_rates, filtered_ods):
+        with con:
+            con.executemany(
+                "INSERT INTO growth_rates (timestamp, experiment, rate, pioreactor_unit) VALUES (?, ?, ?, ?)",
+                growth_rates,
+            )
+            con.executemany(
+                "INSERT INTO od_readings_filtered (timestamp, pioreactor_unit, od_reading_v, experiment, angle) VALUES (?, ?, ?, ?, ?)",
+                filtered_ods,
+            )
+
+    n_steps = round(0.5 * samples_per_minute)
+    next_dosing_event = 0
+    count = 0
+    growth_rates, filtered_ods = [], []
+
+    for timestamp, batch in batches:
+        # live, a dosing event inflates the variance before the next observation.
+        while (
+            next_dosing_event < len(dosing_event_timestamps)
+            and dosing_event_timestamps[next_dosing_event] <= timestamp
+        ):
+            ekf.scale_OD_variance_for_next_n_steps(
+                DOSING_EVENT_OD_VARIANCE_FACTOR, n_steps
+            )
+            next_dosing_event += 1
+
+        ekf.update(np.array(batch) / medians)
+        state = ekf.state_
+
+        growth_rates.append((timestamp, experiment, float(state[-1]), unit))
+        filtered_ods.extend(
+            (timestamp, unit, float(state[i]), experiment, angle)
+            for i, angle in enumerate(angles)
+        )
+        count += 1
+
+        if len(growth_rates) >= chunksize:
+            flush(growth_rates, filtered_ods)
+            growth_rates, filtered_ods = [], []
+
+    flush(growth_rates, filtered_ods)
+    con.close()
+
+    logger.info(f"Completed replay of {count} OD readings for {unit} in {experiment}.")
+    return
+
+
+@click.command(name="replay_growth_rate")
+@click.option("--experiment", default="current")
+@click.option("--unit", required=True, help="the Pioreactor unit to replay")
+@click.option(
+    "--overwrite", is_flag=True, help="replace existing growth rates and filtered ODs"
+)
+@click.option("--chunksize", default=10000, show_default=True)
+@click.option(
+    "--rate-variance",
+    type=float,
+    help="override growth_rate_kalman.rate_variance in the config",
+)
+@click.option(
+    "--od-variance",
+    type=float,
+    help="override growth_rate_kalman.od_variance in the config",
+)
+def click_replay_growth_rate(
+    experiment, unit, overwrite, chunksize, rate_variance, od_variance
+):
+    """
+    (leader only) Reconstruct growth rates from raw OD readings in the db.
+    """
+    return replay_growth_rate(
+        experiment,
+        unit,
+        overwrite=overwrite,
+        chunksize=chunksize,
+        rate_variance=rate_variance,
+        od_variance=od_variance,
+    )
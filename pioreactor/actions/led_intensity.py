@@ -2,7 +2,7 @@
 import logging
 import json
 import click
-from pioreactor.pubsub import publish, subscribe, QOS
+from pioreactor.pubsub import publish, get_retained_messages, QOS
 from pioreactor.whoami import get_latest_experiment_name, get_unit_name
 
 
@@ -14,7 +14,8 @@ def get_current_state_from_broker(unit, experiment):
     # TODO: It's possible to also get this information from the DAC device. Not
     # sure what is better
     # this also ignores the status of "power on"
-    msg = subscribe(f"pioreactor/{unit}/{experiment}/leds/intensity", timeout=0.5)
+    topic = f"pioreactor/{unit}/{experiment}/leds/intensity"
+    msg = get_retained_messages(topic, timeout=0.5).get(topic)
     if msg:
         return json.loads(msg.payload)
     else:
@@ -8,7 +8,7 @@ import logging
 import click
 
 from pioreactor.config import config
-from pioreactor.utils import pio_jobs_running
+from pioreactor.utils import is_pio_job_running, batch_codec
 from pioreactor.whoami import get_unit_name, get_latest_experiment_name
 from pioreactor import pubsub
 
@@ -19,11 +19,11 @@ def od_normalization(od_angle_channel=None, unit=None, experiment=None, N_sample
 
     logger.info("Starting OD normalization")
 
-    if "stirring" not in pio_jobs_running():
+    if not is_pio_job_running("stirring"):
         logger.error("stirring jobs should be running. Run `mb stirring -b` first.")
         raise ValueError("stirring jobs should be running. Run `mb stirring -b` first. ")
 
-    if "od_reading" not in pio_jobs_running():
+    if not is_pio_job_running("od_reading"):
         from pioreactor.background_jobs.od_reading import od_reading
 
         # we sample faster, because we can...
@@ -36,7 +36,7 @@ def od_normalization(od_angle_channel=None, unit=None, experiment=None, N_sample
         def yield_from_mqtt():
             while True:
                 msg = pubsub.subscribe(f"pioreactor/{unit}/{experiment}/od_raw_batched")
-                yield json.loads(msg.payload)
+                yield batch_codec.decode(msg.payload).readings
 
         signal = yield_from_mqtt()
 
@@ -1,25 +1,25 @@
 # -*- coding: utf-8 -*-
-from pioreactor.background_jobs import growth_rate_calculating
-from pioreactor.background_jobs import dosing_control
-from pioreactor.background_jobs import led_control
-from pioreactor.background_jobs import od_reading
-from pioreactor.background_jobs import stirring
-from pioreactor.background_jobs import monitor
-from pioreactor.background_jobs.leader import log_aggregating
-from pioreactor.background_jobs.leader import mqtt_to_db_streaming
-from pioreactor.background_jobs.leader import time_series_aggregating
-from pioreactor.background_jobs.leader import watchdog
+import importlib
 
+# jobs are imported on first access, so importing one job (or the CLI) doesn't import all of them.
+_jobs = {
+    "growth_rate_calculating": "pioreactor.background_jobs.growth_rate_calculating",
+    "dosing_control": "pioreactor.background_jobs.dosing_control",
+    "led_control": "pioreactor.background_jobs.led_control",
+    "od_reading": "pioreactor.background_jobs.od_reading",
+    "stirring": "pioreactor.background_jobs.stirring",
+    "monitor": "pioreactor.background_jobs.monitor",
+    "log_aggregating": "pioreactor.background_jobs.leader.log_aggregating",
+    "mqtt_to_db_streaming": "pioreactor.background_jobs.leader.mqtt_to_db_streaming",
+    "time_series_aggregating": "pioreactor.background_jobs.leader.time_series_aggregating",
+    "watchdog": "pioreactor.background_jobs.leader.watchdog",
+}
 
-__all__ = (
-    growth_rate_calculating,
-    dosing_control,
-    led_control,
-    od_reading,
-    stirring,
-    log_aggregating,
-    mqtt_to_db_streaming,
-    time_series_aggregating,
-    monitor,
-    watchdog,
-)
+
+__all__ = tuple(_jobs)
+
+
+def __getattr__(name):
+    if name in _jobs:
+        return importlib.import_module(_jobs[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
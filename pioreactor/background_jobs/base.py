@@ -8,8 +8,8 @@ import threading
 import atexit
 from collections import namedtuple
 import logging
-from pioreactor.utils import pio_jobs_running
-from pioreactor.pubsub import QOS, create_client
+from pioreactor.utils import job_registry
+from pioreactor.pubsub import QOS, get_shared_connection
 from pioreactor.whoami import UNIVERSAL_IDENTIFIER
 
 faulthandler.enable()
@@ -63,16 +63,25 @@ class BackgroundJob:
         self.unit = unit
         self.editable_settings = self.editable_settings + ["state"]
         self.logger = logging.getLogger(self.job_name)
-        self.pub_client = self.create_pub_client()
-        self.sub_client = self.create_sub_client()
-        self.pubsub_clients = [self.pub_client, self.sub_client]
 
+        # before opening our channel, so we don't leave it open if we abort.
         self.check_for_duplicate_process()
+
+        try:
+            self.channel = self.create_channel()
+        except Exception:
+            job_registry.unregister(self.job_name)
+            raise
+        self.logger.debug(
+            f"Waited {self.channel.startup_latency:.3f}s to connect to the broker."
+        )
+
         self.set_state(self.INIT)
         self.set_state(self.READY)
         self.set_up_disconnect_protocol()
 
-    def create_pub_client(self):
+    def create_channel(self):
+        # all jobs in this process share a single connection to the broker, see pubsub.SharedConnection.
         last_will = {
             "topic": f"pioreactor/{self.unit}/{self.experiment}/{self.job_name}/$state",
             "payload": self.LOST,
@@ -80,36 +89,20 @@ class BackgroundJob:
             "retain": True,
         }
 
-        client = create_client(
-            last_will=last_will,
-            client_id=f"{self.unit}-pub-{self.job_name}-{id(self)}",
-            keepalive=10,
-        )
-
-        return client
-
-    def create_sub_client(self):
-        client = create_client(client_id=f"{self.unit}-sub-{self.job_name}-{id(self)}")
-
         # when we reconnect to the broker, we want to republish our state
-        # to overwrite potential last-will losts...
-        # also reconnect to our old topics.
-        def reconnect_protocol(client, userdata, flags, rc, properties=None):
-
+        # to overwrite potential last-will losts. Our subscriptions are restored
+        # by the shared connection.
+        def reconnect_protocol():
             self.publish_attr("state")
-            self.start_general_passive_listeners()
-            self.start_passive_listeners()
 
-        # the client connects async, but we want it to be connected before adding
-        # our reconnect callback
-        while not client.is_connected():
-            pass
-
-        client.on_connect = reconnect_protocol
-        return client
+        return get_shared_connection().open_channel(
+            last_will=last_will,
+            on_reconnect=reconnect_protocol,
+            client_id=f"{self.unit}-{self.job_name}-{id(self)}",
+        )
 
     def publish(self, *args, **kwargs):
-        self.pub_client.publish(*args, **kwargs)
+        self.channel.publish(*args, **kwargs)
 
     def publish_attr(self, attr: str) -> None:
         if attr == "state":
@@ -174,8 +167,7 @@ class BackgroundJob:
         )
 
         for sub in subscriptions:
-            self.sub_client.message_callback_add(sub, wrap_callback(callback))
-            self.sub_client.subscribe(sub, qos=qos)
+            self.channel.subscribe(sub, wrap_callback(callback), qos=qos)
         return
 
     def set_up_disconnect_protocol(self):
@@ -205,16 +197,8 @@ class BackgroundJob:
         self.state = self.INIT
         self.logger.debug(self.INIT)
 
-        if threading.current_thread() is not threading.main_thread():
-            # if we re-init (via MQTT, close previous threads), but don't do this in main thread
-            for client in self.pubsub_clients:
-                client.loop_stop()  # pretty sure this doesn't close the thread if called in a thread: https://github.com/eclipse/paho.mqtt.python/blob/master/src/paho/mqtt/client.py#L1835
-                client.disconnect()
-
-            self.pub_client = self.create_pub_client()
-            self.sub_client = self.create_sub_client()
-            self.pubsub_clients = [self.pub_client, self.sub_client]
-
+        # if we re-init (via MQTT), we keep our channel to the broker: it's shared with
+        # other jobs in this process, and re-subscribing below replaces our old callbacks.
         self.declare_settable_properties_to_broker()
         self.start_general_passive_listeners()
 
@@ -242,12 +226,11 @@ class BackgroundJob:
         # set state to disconnect
         self.state = self.DISCONNECTED
         self.logger.info(self.DISCONNECTED)
+        job_registry.unregister(self.job_name)
 
-        # disconnect from the passive subscription threads
+        # close our channel to the broker (and the connection, if we are the last job using it).
         # this HAS to happen last, because this contains our publishing client
-        for client in self.pubsub_clients:
-            client.loop_stop()  # pretty sure this doesn't close the thread if if in a thread: https://github.com/eclipse/paho.mqtt.python/blob/master/src/paho/mqtt/client.py#L1835
-            client.disconnect()
+        self.channel.close()
 
         # exit from python using a signal - this works in threads (sometimes `disconnected` is called in a thread)
         # this time.sleep is for race conflicts - without it was causing the MQTT client to disconnect too late and a last-will was sent.
@@ -318,9 +301,8 @@ class BackgroundJob:
         )
 
     def check_for_duplicate_process(self):
-        if (
-            sum([p == self.job_name for p in pio_jobs_running()]) > 1
-        ):  # this process counts as one - see if there is another.
+        # registering fails if another process is running this job, see job_registry.
+        if not job_registry.register(self.job_name):
             self.logger.warn(f"{self.job_name} is already running. Aborting.")
             raise ValueError(f"{self.job_name} is already running. Aborting.")
 
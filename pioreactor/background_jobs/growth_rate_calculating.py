@@ -1,4 +1,18 @@
 # -*- coding: utf-8 -*-
+"""
+Estimate the growth rate, and filtered OD, from od_reading's od_raw_batched with an extended Kalman filter.
+
+Topics published to
+
+    pioreactor/<unit>/<experiment>/growth_rate
+    pioreactor/<unit>/<experiment>/od_filtered/<angle>/<label>
+    pioreactor/<unit>/<experiment>/od_filtered_batched
+
+od_filtered_batched is in the same format as od_raw_batched, see `pioreactor.utils.batch_codec`. With
+`publish_per_channel=0` in the [growth_rate_kalman] config section, the per-channel od_filtered/ topics
+are not published. The leader's od_filtered charts and database read od_filtered_batched, and the dosing
+and LED automations follow the same config setting.
+"""
 import json
 import os
 import signal
@@ -7,8 +21,8 @@ import logging
 import click
 
 from pioreactor.utils.streaming_calculations import ExtendedKalmanFilter
-from pioreactor.utils import pio_jobs_running
-from pioreactor.pubsub import subscribe, QOS
+from pioreactor.utils import is_pio_job_running, batch_codec
+from pioreactor.pubsub import RetainedMessageCache, QOS
 
 from pioreactor.whoami import get_unit_name, get_latest_experiment_name
 from pioreactor.config import config
@@ -17,27 +31,151 @@ from pioreactor.actions.od_normalization import od_normalization
 
 JOB_NAME = os.path.splitext(os.path.basename((__file__)))[0]
 
+# after a dosing event, we expect a jump in OD, so we inflate the OD process variance for a while.
+DOSING_EVENT_OD_VARIANCE_FACTOR = 5e3
+
+# od_reading's sample variances (see oversampling) come from a few samples in a single reading, so are
+# noisy. We smooth them with an EWMA, clip each message to within a factor of the estimate, and blend the
+# estimate with od_normalization's variances, see update_obs_noise_covariance_from_sample_variances.
+SAMPLE_VARIANCE_SMOOTHING = 0.05
+SAMPLE_VARIANCE_MAX_STEP = 2.0
+SAMPLE_VARIANCE_WEIGHT = 0.5
+
+
+def create_extended_kalman_filter(
+    initial_observations,
+    initial_growth_rate,
+    od_variances,
+    dt,
+    rate_variance=None,
+    od_variance=None,
+):
+    """
+    Parameters
+    -----------
+    initial_observations: dict of (angle: normalized OD) pairs, in the order the filter will observe them.
+    initial_growth_rate: float
+    od_variances: dict of (angle: variance) pairs, see od_normalization.
+    dt: float
+        hours between observations
+    rate_variance, od_variance: float
+        defaults to the values in the [growth_rate_kalman] config section.
+    """
+    import numpy as np
+
+    if rate_variance is None:
+        rate_variance = config.getfloat("growth_rate_kalman", "rate_variance")
+
+    initial_state = np.array([*initial_observations.values(), initial_growth_rate])
+
+    d = initial_state.shape[0]
+
+    # empirically selected
+    initial_covariance = 0.0001 * np.diag(initial_state.tolist()[:-1] + [0.00001])
+
+    OD_process_covariance = create_OD_covariance(
+        initial_observations.keys(), dt, od_variance
+    )
+
+    rate_process_variance = (rate_variance * dt) ** 2
+    process_noise_covariance = np.block(
+        [
+            [OD_process_covariance, 0 * np.ones((d - 1, 1))],
+            [0 * np.ones((1, d - 1)), rate_process_variance],
+        ]
+    )
+    observation_noise_covariance = create_obs_noise_covariance(
+        initial_observations.keys(), od_variances, dt
+    )
+    return ExtendedKalmanFilter(
+        initial_state,
+        initial_covariance,
+        process_noise_covariance,
+        observation_noise_covariance,
+        dt=dt,
+    )
+
+
+def create_obs_noise_covariance(angles, od_variances, dt):
+    import numpy as np
+
+    # if a sensor has X times the variance of the other, we should encode this in the obs. covariance.
+    obs_variances = np.array([od_variances[angle] for angle in angles])
+    obs_variances = obs_variances / obs_variances.min()
+
+    # add a fudge factor
+    return 200 * (0.05 * dt) ** 2 * np.diag(obs_variances)
+
+
+def create_OD_covariance(angles, dt, od_variance=None):
+    import numpy as np
+
+    if od_variance is None:
+        od_variance = config.getfloat("growth_rate_kalman", "od_variance")
+
+    d = len(angles)
+    variances = {
+        "135": (od_variance * dt) ** 2,
+        "90": (od_variance * dt) ** 2,
+        "45": (od_variance * dt) ** 2,
+    }
+
+    OD_covariance = 0 * np.ones((d, d))
+    for i, a in enumerate(angles):
+        for k in variances:
+            if a.startswith(k):
+                OD_covariance[i, i] = variances[k]
+    return OD_covariance
+
 
 class GrowthRateCalculator(BackgroundJob):
 
     editable_settings = []
 
     def __init__(self, ignore_cache=False, unit=None, experiment=None):
+        import numpy as np
+
         super(GrowthRateCalculator, self).__init__(
             job_name=JOB_NAME, unit=unit, experiment=experiment
         )
 
         self.ignore_cache = ignore_cache
-        self.initial_growth_rate = self.set_initial_growth_rate()
-        self.od_normalization_factors = self.set_od_normalization_factors()
-        self.od_variances = self.set_od_variances()
+
         self.samples_per_minute = 60 * config.getfloat(
             "od_config.od_sampling", "samples_per_second"
         )
         self.dt = (
             1 / config.getfloat("od_config.od_sampling", "samples_per_second") / 60 / 60
         )
-        self.ekf, self.angles = self.initialize_extended_kalman_filter()
+
+        # gather all the retained state we need on startup in a single round trip. It's closed on
+        # the way out, even if something raises.
+        with RetainedMessageCache(
+            [
+                f"pioreactor/{self.unit}/{self.experiment}/growth_rate",
+                f"pioreactor/{self.unit}/{self.experiment}/od_normalization/median",
+                f"pioreactor/{self.unit}/{self.experiment}/od_normalization/variance",
+                f"pioreactor/{self.unit}/{self.experiment}/od_raw_batched",
+            ],
+            timeout=2,
+        ) as self.retained_state:
+            self.initial_growth_rate = self.set_initial_growth_rate()
+            self.od_normalization_factors = self.set_od_normalization_factors()
+            self.od_variances = self.set_od_variances()
+            self.ekf, self.angles = self.initialize_extended_kalman_filter()
+
+        # the smoothed ratios of the angles' sample variances, starting from od_normalization's.
+        self.sample_variance_ratios_ = self.od_variance_ratios()
+        # the angles' order is fixed at startup, so an observation only needs to be divided by this.
+        self.od_normalization_factors_ = np.array(
+            [self.od_normalization_factors[angle] for angle in self.angles]
+        )
+        self.payload_format = config.get(
+            "od_config.od_sampling", "payload_format", fallback=batch_codec.JSON
+        )
+        self.publish_per_channel = config.getboolean(
+            "growth_rate_kalman", "publish_per_channel", fallback=True
+        )
         self.start_passive_listeners()
 
     @property
@@ -45,84 +183,33 @@ class GrowthRateCalculator(BackgroundJob):
         return self.ekf.state_
 
     def initialize_extended_kalman_filter(self):
-        import numpy as np
-
-        latest_od = subscribe(f"pioreactor/{self.unit}/{self.experiment}/od_raw_batched")
-        angles_and_initial_points = self.scale_raw_observations(
-            self.json_to_sorted_dict(latest_od.payload)
+        latest_od = self.retained_state.wait_for(
+            f"pioreactor/{self.unit}/{self.experiment}/od_raw_batched"
         )
-
-        initial_state = np.array(
-            [*angles_and_initial_points.values(), self.initial_growth_rate]
-        )
-
-        d = initial_state.shape[0]
-
-        # empirically selected
-        initial_covariance = 0.0001 * np.diag(initial_state.tolist()[:-1] + [0.00001])
-
-        OD_process_covariance = self.create_OD_covariance(
-            angles_and_initial_points.keys()
-        )
-
-        rate_process_variance = (
-            config.getfloat("growth_rate_kalman", "rate_variance") * self.dt
-        ) ** 2
-        process_noise_covariance = np.block(
-            [
-                [OD_process_covariance, 0 * np.ones((d - 1, 1))],
-                [0 * np.ones((1, d - 1)), rate_process_variance],
-            ]
-        )
-        observation_noise_covariance = self.create_obs_noise_covariance(
-            angles_and_initial_points.keys()
+        angles_and_initial_points = self.scale_raw_observations(
+            self.batch_to_sorted_dict(latest_od.payload)
         )
         return (
-            ExtendedKalmanFilter(
-                initial_state,
-                initial_covariance,
-                process_noise_covariance,
-                observation_noise_covariance,
-                dt=self.dt,
+            create_extended_kalman_filter(
+                angles_and_initial_points,
+                self.initial_growth_rate,
+                self.od_variances,
+                self.dt,
             ),
-            angles_and_initial_points.keys(),
+            tuple(angles_and_initial_points),
         )
 
-    def create_obs_noise_covariance(self, angles):
-        import numpy as np
-
-        # if a sensor has X times the variance of the other, we should encode this in the obs. covariance.
-        obs_variances = np.array([self.od_variances[angle] for angle in angles])
-        obs_variances = obs_variances / obs_variances.min()
-
-        # add a fudge factor
-        return 200 * (0.05 * self.dt) ** 2 * np.diag(obs_variances)
-
-    def create_OD_covariance(self, angles):
-        import numpy as np
-
-        d = len(angles)
-        variances = {
-            "135": (config.getfloat("growth_rate_kalman", "od_variance") * self.dt) ** 2,
-            "90": (config.getfloat("growth_rate_kalman", "od_variance") * self.dt) ** 2,
-            "45": (config.getfloat("growth_rate_kalman", "od_variance") * self.dt) ** 2,
-        }
-
-        OD_covariance = 0 * np.ones((d, d))
-        for i, a in enumerate(angles):
-            for k in variances:
-                if a.startswith(k):
-                    OD_covariance[i, i] = variances[k]
-        return OD_covariance
+    def create_obs_noise_covariance(self, angles, od_variances=None):
+        return create_obs_noise_covariance(
+            angles, od_variances or self.od_variances, self.dt
+        )
 
     def set_initial_growth_rate(self):
         if self.ignore_cache:
             return 0
 
-        message = subscribe(
-            f"pioreactor/{self.unit}/{self.experiment}/growth_rate",
-            timeout=2,
-            qos=QOS.EXACTLY_ONCE,
+        message = self.retained_state.get(
+            f"pioreactor/{self.unit}/{self.experiment}/growth_rate"
         )
         if message:
             return float(message.payload)
@@ -131,36 +218,75 @@ class GrowthRateCalculator(BackgroundJob):
 
     def set_od_normalization_factors(self):
         # we check if the broker has variance/median stats, and if not, run it ourselves.
-        message = subscribe(
-            f"pioreactor/{self.unit}/{self.experiment}/od_normalization/median",
-            timeout=2,
-            qos=QOS.EXACTLY_ONCE,
-        )
+        topic = f"pioreactor/{self.unit}/{self.experiment}/od_normalization/median"
+        message = self.retained_state.get(topic)
         if message and not self.ignore_cache:
             return self.json_to_sorted_dict(message.payload)
         else:
-            assert (
-                "od_reading" in pio_jobs_running()
+            assert is_pio_job_running(
+                "od_reading"
             ), "OD reading should be running. Stopping."
-            od_normalization(unit=self.unit, experiment=self.experiment)
-            return self.set_od_normalization_factors()
+            self.run_od_normalization()
+            return self.json_to_sorted_dict(self.retained_state.wait_for(topic).payload)
 
     def set_od_variances(self):
         # we check if the broker has variance/median stats, and if not, run it ourselves.
-        message = subscribe(
-            f"pioreactor/{self.unit}/{self.experiment}/od_normalization/variance",
-            timeout=2,
-            qos=QOS.EXACTLY_ONCE,
-        )
+        topic = f"pioreactor/{self.unit}/{self.experiment}/od_normalization/variance"
+        message = self.retained_state.get(topic)
         if message and not self.ignore_cache:
             return self.json_to_sorted_dict(message.payload)
         else:
-            od_normalization(unit=self.unit, experiment=self.experiment)
-            return self.set_od_normalization_factors()
+            self.run_od_normalization()
+            return self.json_to_sorted_dict(self.retained_state.wait_for(topic).payload)
+
+    def run_od_normalization(self):
+        # od_normalization publishes new (retained) medians and variances, which our
+        # retained_state cache will pick up - so forget the old values first.
+        self.retained_state.pop(
+            f"pioreactor/{self.unit}/{self.experiment}/od_normalization/median"
+        )
+        self.retained_state.pop(
+            f"pioreactor/{self.unit}/{self.experiment}/od_normalization/variance"
+        )
+        od_normalization(unit=self.unit, experiment=self.experiment)
 
     def update_ekf_variance_after_dosing_event(self, message):
         self.ekf.scale_OD_variance_for_next_n_steps(
-            5e3, round(0.5 * self.samples_per_minute)
+            DOSING_EVENT_OD_VARIANCE_FACTOR, round(0.5 * self.samples_per_minute)
+        )
+
+    def od_variance_ratios(self):
+        import numpy as np
+
+        od_variances = np.array([self.od_variances[angle] for angle in self.angles])
+        return od_variances / od_variances.min()
+
+    def update_obs_noise_covariance_from_sample_variances(self, message):
+        # when od_reading oversamples, it publishes the variance of each reading's samples. Like
+        # od_normalization's variances, only their ratios between angles end up in the observation
+        # covariance, see create_obs_noise_covariance.
+        import numpy as np
+
+        variances = batch_codec.decode(message.payload).readings
+        if not all(variances.get(angle, 0) > 0 for angle in self.angles):
+            return
+
+        ratios = np.array([variances[angle] for angle in self.angles])
+        ratios = np.clip(
+            ratios / ratios.min(),
+            self.sample_variance_ratios_ / SAMPLE_VARIANCE_MAX_STEP,
+            self.sample_variance_ratios_ * SAMPLE_VARIANCE_MAX_STEP,
+        )
+        self.sample_variance_ratios_ += SAMPLE_VARIANCE_SMOOTHING * (
+            ratios - self.sample_variance_ratios_
+        )
+
+        od_variance_ratios = self.od_variance_ratios()
+        blended = od_variance_ratios + SAMPLE_VARIANCE_WEIGHT * (
+            self.sample_variance_ratios_ - od_variance_ratios
+        )
+        self.ekf.observation_noise_covariance = self.create_obs_noise_covariance(
+            self.angles, dict(zip(self.angles, blended.tolist()))
         )
 
     def scale_raw_observations(self, observations):
@@ -169,26 +295,46 @@ class GrowthRateCalculator(BackgroundJob):
             for angle in observations.keys()
         }
 
+    def scale_observation_batch(self, batch):
+        import numpy as np
+
+        readings = batch.readings
+        observations = np.fromiter(
+            (readings[angle] for angle in self.angles),
+            dtype=float,
+            count=len(self.angles),
+        )
+        return observations / self.od_normalization_factors_
+
     def update_state_from_observation(self, message):
         if self.state != self.READY:
             return
         try:
-            observations = self.json_to_sorted_dict(message.payload)
-            scaled_observations = self.scale_raw_observations(observations)
-            self.ekf.update(list(scaled_observations.values()))
+            batch = batch_codec.decode(message.payload)
+            self.ekf.update(self.scale_observation_batch(batch))
 
+            state = self.state_.tolist()
             self.publish(
                 f"pioreactor/{self.unit}/{self.experiment}/growth_rate",
-                self.state_[-1],
+                state[-1],
                 retain=True,
             )
 
-            for i, angle_label in enumerate(self.angles):
-                self.publish(
-                    f"pioreactor/{self.unit}/{self.experiment}/od_filtered/{angle_label}",
-                    self.state_[i],
-                )
+            # the state is the filtered ODs, in the order of self.angles, then the growth rate.
+            od_filtered = dict(zip(self.angles, state))
+            if self.publish_per_channel:
+                for angle_label, value in od_filtered.items():
+                    self.publish(
+                        f"pioreactor/{self.unit}/{self.experiment}/od_filtered/{angle_label}",
+                        value,
+                    )
 
+            self.publish(
+                f"pioreactor/{self.unit}/{self.experiment}/od_filtered_batched",
+                batch_codec.encode(
+                    od_filtered, format=self.payload_format, timestamp=batch.timestamp
+                ),
+            )
             return
 
         except Exception as e:
@@ -200,8 +346,14 @@ class GrowthRateCalculator(BackgroundJob):
         self.subscribe_and_callback(
             self.update_state_from_observation,
             f"pioreactor/{self.unit}/{self.experiment}/od_raw_batched",
-            qos=QOS.EXACTLY_ONCE,
+            qos=config.getint("od_config.od_sampling", "qos", fallback=QOS.EXACTLY_ONCE),
         )
+        if len(self.angles) > 1:
+            # with a single angle, there are no ratios to update.
+            self.subscribe_and_callback(
+                self.update_obs_noise_covariance_from_sample_variances,
+                f"pioreactor/{self.unit}/{self.experiment}/od_raw_variance_batched",
+            )
         self.subscribe_and_callback(
             self.update_ekf_variance_after_dosing_event,
             f"pioreactor/{self.unit}/{self.experiment}/dosing_events",
@@ -215,6 +367,14 @@ class GrowthRateCalculator(BackgroundJob):
             k: float(d[k]) for k in sorted(d, reverse=True) if not k.startswith("180")
         }
 
+    @staticmethod
+    def batch_to_sorted_dict(payload):
+        # od_raw_batched may be json or a binary frame, see batch_codec.
+        d = batch_codec.decode(payload).readings
+        return {
+            k: float(d[k]) for k in sorted(d, reverse=True) if not k.startswith("180")
+        }
+
 
 def growth_rate_calculating(ignore_cache):
     unit = get_unit_name()
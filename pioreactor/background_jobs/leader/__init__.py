@@ -7,8 +7,8 @@ they're settings, status, etc. are tied to an experiment. However, there is no u
 about the latest_experiment¹
 
 
-¹ The one use case I can think of is clearing the dashboard time series upon a new experiment starts, but maybe
-the leader will partition based on experiment name too, and write <time_series>_<experiment>.json that the dashboard
-can read.
+¹ The one use case I can think of is clearing the dashboard time series upon a new experiment starts. Instead, with
+--partition-by-experiment, the aggregating jobs partition on the experiment name from the topic, and write
+<output>_<experiment>.json that the dashboard can read.
 
 """
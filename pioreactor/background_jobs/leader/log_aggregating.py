@@ -5,14 +5,19 @@ This job runs on the leader, and is a replacement for the NodeRed aggregation jo
 import signal
 import time
 import os
+import glob
 import traceback
 import click
 import json
+import threading
+from collections import deque, OrderedDict
 
 from pioreactor.pubsub import QOS
 from pioreactor.background_jobs.base import BackgroundJob
 from pioreactor.whoami import get_unit_name, UNIVERSAL_EXPERIMENT
 from pioreactor.config import config
+from pioreactor.utils import write_atomically
+from pioreactor.utils.timing import RepeatedTimer
 
 JOB_NAME = os.path.splitext(os.path.basename((__file__)))[0]
 
@@ -21,7 +26,33 @@ def current_time():
     return time.time_ns() // 1_000_000
 
 
+class LogPartition:
+    """
+    The logs written to one output file, newest first, in a bounded deque.
+    """
+
+    def __init__(self, output, logs, log_display_count):
+        self.output = output
+        self.dirty = False
+        self.table = deque()
+        self.resize(log_display_count, logs)
+
+    def resize(self, log_display_count, logs=None):
+        # logs are newest first. A deque built from an iterable keeps its last items, so slice first.
+        logs = self.table if logs is None else logs
+        self.table = deque(list(logs)[:log_display_count], maxlen=log_display_count)
+
+
 class LogAggregation(BackgroundJob):
+    """
+    Keeps the latest `log_display_count` logs, newest first, in a bounded deque. Instead of rewriting the
+    file on every log, the file is (atomically) rewritten at most every `write_every_n_seconds`, and only
+    if there were new logs - so a burst of logs from many workers is one write.
+
+    With `partition_by_experiment`, each experiment's logs are kept, and written, separately, to
+    <output>_<experiment>.json. Only the `max_partitions_in_memory` most recently logged to experiments are
+    kept in memory, older ones are written to disk and dropped (and read back if they get new logs).
+    """
 
     editable_settings = ["log_display_count"]
 
@@ -30,34 +61,123 @@ class LogAggregation(BackgroundJob):
         topics,
         output,
         log_display_count=int(config["ui.overview.settings"]["log_display_count"]),
+        write_every_n_seconds=1,
+        partition_by_experiment=False,
+        max_partitions_in_memory=3,
         **kwargs,
     ):
         super(LogAggregation, self).__init__(job_name=JOB_NAME, **kwargs)
         self.topics = topics
         self.output = output
-        self.aggregated_log_table = self.read()
+        self.partition_by_experiment = partition_by_experiment
+        self.max_partitions_in_memory = max_partitions_in_memory
+        # logs arrive on the MQTT thread, writes are on the timer's.
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
         self.log_display_count = log_display_count
+
+        # experiment (or None) -> LogPartition, least recently logged to first.
+        self.partitions = OrderedDict()
+        # dropped from memory, waiting to be written.
+        self.evicted_partitions = {}
+        if not self.partition_by_experiment:
+            self.get_partition(None)
+
+        self.write_timer = RepeatedTimer(
+            write_every_n_seconds, self.write_if_dirty, job_name=self.job_name
+        ).start()
         self.start_passive_listeners()
 
+    def on_disconnect(self):
+        self.write_timer.cancel()
+        self.write_if_dirty()
+
+    @property
+    def aggregated_log_table(self):
+        """
+        The logs, newest first. With partition_by_experiment, a dict of experiment -> logs, for the experiments
+        in memory.
+        """
+        with self.lock:
+            if not self.partition_by_experiment:
+                return list(self.partitions[None].table)
+            return {
+                experiment: list(partition.table)
+                for experiment, partition in self.partitions.items()
+            }
+
+    def set_log_display_count(self, log_display_count):
+        with self.lock:
+            self.log_display_count = int(log_display_count)
+            for partition in self.partitions.values():
+                partition.resize(self.log_display_count)
+                partition.dirty = True
+
+    def partition_output(self, experiment):
+        if experiment is None:
+            return self.output
+        base, extension = os.path.splitext(self.output)
+        return f"{base}_{experiment}{extension}"
+
+    def experiments_on_disk(self):
+        """
+        The experiments with a partition on disk, including ones no longer in memory.
+        """
+        base, extension = os.path.splitext(self.output)
+        prefix = base + "_"
+        return {
+            path[len(prefix) : len(path) - len(extension)]
+            for path in glob.glob(glob.escape(prefix) + "*" + extension)
+        }
+
+    def get_partition(self, experiment):
+        """
+        Get an experiment's partition, reading it from disk if it isn't in memory. Call with the lock held.
+        """
+        if experiment in self.partitions:
+            self.partitions.move_to_end(experiment)
+            return self.partitions[experiment]
+
+        if experiment in self.evicted_partitions:
+            partition = self.evicted_partitions.pop(experiment)
+        else:
+            output = self.partition_output(experiment)
+            partition = LogPartition(output, self.read(output), self.log_display_count)
+        self.partitions[experiment] = partition
+
+        while len(self.partitions) > self.max_partitions_in_memory:
+            evicted_experiment, evicted = self.partitions.popitem(last=False)
+            if evicted.dirty:
+                self.evicted_partitions[evicted_experiment] = evicted
+
+        return partition
+
     def on_message(self, message):
         try:
-            unit = message.topic.split("/")[1]
+            _, unit, experiment, topic_name = message.topic.split("/")
             payload = message.payload.decode()
-            self.aggregated_log_table.insert(
-                0,
-                {
-                    "timestamp": current_time(),
-                    "message": payload,
-                    "unit": unit,
-                    "is_error": "error" in payload.lower(),
-                    "is_warning": "warning" in payload.lower(),
-                },
-            )
-            self.aggregated_log_table = self.aggregated_log_table[
-                : self.log_display_count
-            ]
-
-            self.write()
+            if topic_name.endswith("_batched"):
+                # oldest first, see pioreactor.logging.MQTTHandler
+                logs = json.loads(payload)
+            else:
+                logs = [{"timestamp": current_time(), "message": payload}]
+
+            with self.lock:
+                partition = self.get_partition(
+                    experiment if self.partition_by_experiment else None
+                )
+                for log in logs:
+                    # the oldest log falls off the end.
+                    partition.table.appendleft(
+                        {
+                            "timestamp": log["timestamp"],
+                            "message": log["message"],
+                            "unit": unit,
+                            "is_error": "error" in log["message"].lower(),
+                            "is_warning": "warning" in log["message"].lower(),
+                        }
+                    )
+                partition.dirty = True
         except Exception as e:
             traceback.print_exc()
             raise e
@@ -66,21 +186,56 @@ class LogAggregation(BackgroundJob):
     def clear(self, message):
         payload = message.payload
         if not payload:
-            self.aggregated_log_table = []
-            self.write()
+            experiment = message.topic.split("/")[2]
+            with self.lock:
+                if not self.partition_by_experiment:
+                    partitions = self.partitions.values()
+                elif experiment != UNIVERSAL_EXPERIMENT:
+                    partitions = [self.get_partition(experiment)]
+                else:
+                    # every experiment's, including the ones evicted from memory.
+                    for experiment in self.experiments_on_disk():
+                        if experiment not in self.partitions:
+                            self.evicted_partitions[experiment] = LogPartition(
+                                self.partition_output(experiment),
+                                [],
+                                self.log_display_count,
+                            )
+                    partitions = [
+                        *self.partitions.values(),
+                        *self.evicted_partitions.values(),
+                    ]
+
+                for partition in partitions:
+                    partition.table.clear()
+                    partition.dirty = True
+            self.write_if_dirty()
         else:
             self.logger.warning("Only empty messages allowed to empty the log table.")
 
-    def read(self):
+    def read(self, output):
         try:
-            with open(self.output, "r") as f:
+            with open(output, "r") as f:
                 return json.load(f)
         except Exception:
             return []
 
-    def write(self):
-        with open(self.output, "w") as f:
-            json.dump(self.aggregated_log_table, f)
+    def write_if_dirty(self):
+        # write_lock: clear (on the MQTT thread) and the timer could write at the same time.
+        with self.write_lock:
+            with self.lock:
+                to_write = []
+                for partition in [
+                    *self.partitions.values(),
+                    *self.evicted_partitions.values(),
+                ]:
+                    if partition.dirty:
+                        partition.dirty = False
+                        to_write.append((partition.output, list(partition.table)))
+                self.evicted_partitions = {}
+
+            for output, aggregated_log_table in to_write:
+                write_atomically(output, json.dumps(aggregated_log_table))
 
     def start_passive_listeners(self):
         self.subscribe_and_callback(self.on_message, self.topics)
@@ -98,15 +253,21 @@ class LogAggregation(BackgroundJob):
     default="/home/pi/pioreactorui/backend/build/data/all_pioreactor.log.json",
     help="the output file",
 )
-def click_log_aggregating(output):
+@click.option(
+    "--partition-by-experiment",
+    is_flag=True,
+    help="write each experiment's logs to their own file",
+)
+def click_log_aggregating(output, partition_by_experiment):
     """
     (leader only) Aggregate logs for the UI
     """
     logs = LogAggregation(  # noqa: F841
-        ["pioreactor/+/+/app_logs_for_ui"],
+        ["pioreactor/+/+/app_logs_for_ui", "pioreactor/+/+/app_logs_for_ui_batched"],
         output,
         experiment=UNIVERSAL_EXPERIMENT,
         unit=get_unit_name(),
+        partition_by_experiment=partition_by_experiment,
     )
 
     while True:
@@ -4,22 +4,33 @@ This job runs on the leader, and is a replacement for the NodeRed database strea
 """
 import signal
 import os
+import time
 import click
 import json
+import threading
+import logging
 from collections import namedtuple
-from datetime import datetime
 
 
 from pioreactor.pubsub import QOS
 from pioreactor.background_jobs.base import BackgroundJob
 from pioreactor.whoami import get_unit_name, UNIVERSAL_EXPERIMENT
 from pioreactor.config import config
+from pioreactor.utils.timing import RepeatedTimer
+from pioreactor.utils import batch_codec
+from pioreactor.storage import (
+    connect_writer,
+    read_connection,
+    get_schema_version,
+    SCHEMA_VERSION,
+)
 
 JOB_NAME = os.path.splitext(os.path.basename((__file__)))[0]
 
 
 def current_time():
-    return datetime.now().isoformat()
+    # milliseconds since the unix epoch, see create_tables.sql
+    return int(time.time() * 1000)
 
 
 def produce_metadata(topic):
@@ -30,14 +41,169 @@ def produce_metadata(topic):
     return SetAttrSplitTopic(v[1], v[2], current_time())
 
 
+class BatchedDBWriter:
+    """
+    Buffers rows in memory, grouped by table (and columns), and writes them from a single thread with
+    `executemany`, in one transaction per flush. A flush happens every `flush_every_n_rows` rows or
+    `flush_every_n_ms` milliseconds, whichever comes first. This is much cheaper on the leader's SD card
+    than one transaction per row.
+
+    `write` is called from the MQTT client's network thread, so it never blocks: if the writer falls
+    behind and `max_pending_rows` rows are waiting, new rows are dropped (and counted) until the next flush.
+    A flush that fails because the database is busy or locked (ex: a migration or a backup) is retried
+    `flush_attempts` times before its rows are dropped. `stats` records how far behind the writer is, and
+    how many rows were dropped.
+
+    Parameters
+    -----------
+    database: str
+        path to the sqlite database
+    """
+
+    def __init__(
+        self,
+        database,
+        flush_every_n_rows=500,
+        flush_every_n_ms=1000,
+        max_pending_rows=10000,
+        flush_attempts=3,
+        retry_after_s=1.0,
+    ):
+        self.database = database
+        self.flush_every_n_rows = flush_every_n_rows
+        self.flush_every_n_ms = flush_every_n_ms
+        self.max_pending_rows = max_pending_rows
+        self.flush_attempts = flush_attempts
+        self.retry_after_s = retry_after_s
+        self.logger = logging.getLogger(JOB_NAME)
+
+        self.stats = {
+            "rows_written": 0,
+            "flushes": 0,
+            "pending_rows": 0,
+            "max_pending_rows": 0,
+            "last_flush_ms": 0.0,
+            "dropped_rows": 0,
+            "errors": 0,
+        }
+
+        self._buffers = {}  # (table, columns) -> list of rows
+        self._sql = {}  # (table, columns) -> INSERT statement
+        self._pending = 0
+        self._dropping = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, table, cols_to_values):
+        key = (table, tuple(cols_to_values.keys()))
+
+        with self._condition:
+            if self._pending >= self.max_pending_rows:
+                self.stats["dropped_rows"] += 1
+                if not self._dropping:
+                    self._dropping = True
+                    self.logger.warning(
+                        f"The database writer is {self._pending} rows behind, dropping new rows."
+                    )
+                return
+
+            if key not in self._sql:
+                self._sql[key] = self._create_sql(*key)
+
+            self._buffers.setdefault(key, []).append(cols_to_values)
+            self._pending += 1
+            self.stats["pending_rows"] = self._pending
+            self.stats["max_pending_rows"] = max(
+                self.stats["max_pending_rows"], self._pending
+            )
+
+            if self._pending >= self.flush_every_n_rows:
+                self._condition.notify_all()
+
+    def close(self):
+        # flushes anything left in the buffers.
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    @staticmethod
+    def _create_sql(table, columns):
+        cols_placeholder = ", ".join(columns)
+        values_placeholder = ", ".join([":" + c for c in columns])
+        return (
+            f"""INSERT INTO {table} ({cols_placeholder}) VALUES ({values_placeholder})"""
+        )
+
+    def _run(self):
+        # sqlite3 connections can only be used in the thread that created them. This is
+        # the leader's single writer connection, see pioreactor.storage.
+        connection = connect_writer(self.database)
+
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._pending >= self.flush_every_n_rows or self._closed,
+                    timeout=self.flush_every_n_ms / 1000,
+                )
+                buffers, self._buffers = self._buffers, {}
+                n_rows, self._pending = self._pending, 0
+                self.stats["pending_rows"] = 0
+                self._dropping = False
+                closed = self._closed
+
+            if n_rows:
+                self._flush(connection, buffers, n_rows)
+
+            if closed:
+                connection.close()
+                return
+
+    def _flush(self, connection, buffers, n_rows):
+        import sqlite3
+
+        for attempt in range(1, self.flush_attempts + 1):
+            start = time.perf_counter()
+            try:
+                with connection:
+                    for key, rows in buffers.items():
+                        connection.executemany(self._sql[key], rows)
+            except sqlite3.Error as e:
+                # the transaction is rolled back, so we can try again if the database was locked. Other
+                # errors (ex: an IntegrityError) won't go away.
+                self.stats["errors"] += 1
+                if (
+                    isinstance(e, sqlite3.OperationalError)
+                    and attempt < self.flush_attempts
+                ):
+                    self.logger.debug(
+                        f"Attempt {attempt} to write {n_rows} rows failed: {e}"
+                    )
+                    time.sleep(self.retry_after_s * attempt)
+                    continue
+
+                self.stats["dropped_rows"] += n_rows
+                self.logger.error(
+                    f"Failed to write {n_rows} rows to the database, dropping them: {e}"
+                )
+                return
+
+            self.stats["last_flush_ms"] = 1000 * (time.perf_counter() - start)
+            self.stats["rows_written"] += n_rows
+            self.stats["flushes"] += 1
+            return
+
+
 class MqttToDBStreamer(BackgroundJob):
     def __init__(self, topics_and_parsers, **kwargs):
 
-        from sqlite3worker import Sqlite3Worker
-
         super(MqttToDBStreamer, self).__init__(job_name=JOB_NAME, **kwargs)
-        self.sqliteworker = Sqlite3Worker(
-            config["storage"]["database"], max_queue_size=250, raise_on_error=False
+        self.check_schema_version()
+        self.writer = BatchedDBWriter(config["storage"]["database"])
+        self.publish_stats_timer = RepeatedTimer(
+            60, self.publish_writer_stats, job_name=self.job_name
         )
         self.topics_and_callbacks = [
             {
@@ -49,17 +215,37 @@ class MqttToDBStreamer(BackgroundJob):
 
         self.start_passive_listeners()
 
+    def check_schema_version(self):
+        with read_connection() as con:
+            schema_version = get_schema_version(con)
+
+        if schema_version < SCHEMA_VERSION:
+            # we still write, and the migration converts anything written in the meantime.
+            self.logger.warning(
+                f"Database schema is version {schema_version}, expected {SCHEMA_VERSION}. Run `pio run migrate_database`."
+            )
+
     def on_disconnect(self):
-        self.sqliteworker.close()  # close the db safely
+        self.publish_stats_timer.cancel()
+        self.writer.close()  # flush and close the db safely
+        self.publish_writer_stats()
+
+    def publish_writer_stats(self):
+        self.publish(
+            f"pioreactor/{self.unit}/{self.experiment}/{self.job_name}/writer_stats",
+            json.dumps(self.writer.stats),
+            retain=True,
+        )
 
     def create_on_message(self, topic_and_parser):
         def _callback(message):
             cols_to_values = topic_and_parser.parser(message.topic, message.payload)
-
-            cols_placeholder = ", ".join(cols_to_values.keys())
-            values_placeholder = ", ".join([":" + c for c in cols_to_values.keys()])
-            SQL = f"""INSERT INTO {topic_and_parser.table} ({cols_placeholder}) VALUES ({values_placeholder})"""
-            self.sqliteworker.execute(SQL, cols_to_values)
+            # parsers of batched topics return a list of rows.
+            if isinstance(cols_to_values, list):
+                for row in cols_to_values:
+                    self.writer.write(topic_and_parser.table, row)
+            else:
+                self.writer.write(topic_and_parser.table, cols_to_values)
 
         return _callback
 
@@ -78,16 +264,21 @@ def click_mqtt_to_db_streaming():
     (leader only) Send MQTT streams to the database. Parsers should return a dict of all the entries in the corresponding table.
     """
 
-    def parse_od(topic, payload):
+    def parse_od_batched(topic, payload):
+        # one row per angle. The batched topics are always published, while the per-angle topics
+        # can be turned off (see publish_per_channel), so the od tables are fed from these.
         metadata = produce_metadata(topic)
 
-        return {
-            "experiment": metadata.experiment,
-            "pioreactor_unit": metadata.pioreactor_unit,
-            "timestamp": metadata.timestamp,
-            "od_reading_v": float(payload),
-            "angle": "".join(topic.split("/")[-2:]),
-        }
+        return [
+            {
+                "experiment": metadata.experiment,
+                "pioreactor_unit": metadata.pioreactor_unit,
+                "timestamp": metadata.timestamp,
+                "od_reading_v": float(od_reading_v),
+                "angle": "".join(angle_label.split("/")),
+            }
+            for angle_label, od_reading_v in batch_codec.decode(payload).readings.items()
+        ]
 
     def parse_dosing_events(topic, payload):
         payload = json.loads(payload)
@@ -158,12 +349,27 @@ def click_mqtt_to_db_streaming():
 
     def parse_logs(topic, payload):
         metadata = produce_metadata(topic)
+        source = topic.split("/")[-1]
+
+        if source.endswith("_batched"):
+            # see pioreactor.logging.MQTTHandler
+            return [
+                {
+                    "experiment": metadata.experiment,
+                    "pioreactor_unit": metadata.pioreactor_unit,
+                    "timestamp": log["timestamp"],
+                    "message": log["message"],
+                    "source": source[: -len("_batched")],
+                }
+                for log in json.loads(payload)
+            ]
+
         return {
             "experiment": metadata.experiment,
             "pioreactor_unit": metadata.pioreactor_unit,
             "timestamp": metadata.timestamp,
             "message": payload.decode(),
-            "source": topic.split("/")[-1],  # should be app, ui, etc.
+            "source": source,  # should be app, ui, etc.
         }
 
     def parse_automation_settings(topic, payload):
@@ -173,8 +379,10 @@ def click_mqtt_to_db_streaming():
     Metadata = namedtuple("Metadata", ["topic", "table", "parser"])
 
     topics_and_parsers = [
-        Metadata("pioreactor/+/+/od_filtered/+/+", "od_readings_filtered", parse_od),
-        Metadata("pioreactor/+/+/od_raw/+/+", "od_readings_raw", parse_od),
+        Metadata(
+            "pioreactor/+/+/od_filtered_batched", "od_readings_filtered", parse_od_batched
+        ),
+        Metadata("pioreactor/+/+/od_raw_batched", "od_readings_raw", parse_od_batched),
         Metadata("pioreactor/+/+/dosing_events", "dosing_events", parse_dosing_events),
         Metadata("pioreactor/+/+/led_events", "led_events", parse_led_events),
         Metadata("pioreactor/+/+/growth_rate", "growth_rates", parse_growth_rate),
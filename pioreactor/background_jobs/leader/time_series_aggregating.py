@@ -1,11 +1,29 @@
 # -*- coding: utf-8 -*-
 """
 This file contains N jobs that run on the leader, and is a replacement for the NodeRed aggregation job.
+
+Each job writes its series to <output_dir>/<job_name>.json, as {"series": [label, ...], "data": [[{"x", "y"}, ...], ...]}.
+By default the whole file is rewritten (atomically) whenever it changes. In incremental mode, new points
+are instead appended to a segment log, and only every `compact_every_n_seconds` is the full file
+rewritten (compacted) and a new segment started. A small manifest says which segment goes with the full
+file:
+
+    <job_name>.json                 full snapshot, up to "compacted_until"
+    <job_name>.segment.<n>.jsonl    one {"x": time, "y": {label: value}} per line, after "compacted_until"
+    <job_name>.manifest.json        {"snapshot", "segment", "compacted_until", "generation", "time_window_seconds"}
+
+Use `read_time_series` to read the full series, or only the points since some time. With
+--partition-by-experiment, each experiment gets its own files, named <job_name>_<experiment>.
 """
+
 import signal
 import time
 import os
+import glob
 import json
+import threading
+from array import array
+from collections import OrderedDict
 
 import click
 
@@ -15,6 +33,8 @@ from pioreactor.background_jobs.base import BackgroundJob
 from pioreactor.whoami import get_unit_name, UNIVERSAL_EXPERIMENT
 from pioreactor.utils.timing import RepeatedTimer
 from pioreactor.config import config
+from pioreactor.utils import write_atomically, batch_codec
+from pioreactor.utils.downsampling import DOWNSAMPLERS
 
 DEFAULT_JOB_NAME = os.path.splitext(os.path.basename((__file__)))[0]
 
@@ -23,10 +43,202 @@ def current_time():
     return time.time_ns() // 1_000_000
 
 
+def manifest_path(output_dir, job_name):
+    return output_dir + job_name + ".manifest.json"
+
+
+def read_time_series(output_dir, job_name, since=None, attempts=3):
+    """
+    Read an incremental job's output. With `since` (a time in ms, ex: the latest x a client has), only
+    points after it are returned, with "snapshot" False - if the segment log still has them. Otherwise
+    every point is returned, with "snapshot" True, and clients should replace what they have (this
+    also happens after each compaction, and when the series are cleared).
+
+    If the job compacts while we read, the segment we were told about is gone, and we start over with the
+    new manifest, at most `attempts` times.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return _read_time_series(output_dir, job_name, since)
+        except FileNotFoundError:
+            if attempt == attempts:
+                raise
+
+
+def _read_time_series(output_dir, job_name, since):
+    with open(manifest_path(output_dir, job_name)) as f:
+        manifest = json.load(f)
+
+    is_delta = since is not None and since > manifest["compacted_until"]
+    if is_delta:
+        series, data = [], []
+    else:
+        with open(output_dir + manifest["snapshot"]) as f:
+            snapshot = json.load(f)
+        series, data = snapshot["series"], snapshot["data"]
+        since = manifest["compacted_until"]
+
+    slots = {label: ix for ix, label in enumerate(series)}
+    with open(output_dir + manifest["segment"]) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break  # a line still being written
+
+            if record["x"] <= since:
+                continue
+
+            for label, y in record["y"].items():
+                if label not in slots:
+                    slots[label] = len(series)
+                    series.append(label)
+                    data.append([])
+                data[slots[label]].append({"x": record["x"], "y": y})
+
+    if manifest["time_window_seconds"]:
+        cutoff = current_time() - manifest["time_window_seconds"] * 1000
+        data = [[point for point in points if point["x"] > cutoff] for points in data]
+
+    return {"snapshot": not is_delta, "series": series, "data": data}
+
+
+class RingBuffer:
+    """
+    (x, y) points, oldest first, in parallel arrays used as a ring. Evicting the oldest point is O(1).
+    Appending is O(1) too, until the buffer is full, when its capacity is doubled.
+    """
+
+    def __init__(self, capacity=64):
+        self._x = array("d", bytes(8 * capacity))
+        self._y = array("d", bytes(8 * capacity))
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _ordered(self, a):
+        end = self._start + self._size
+        if end <= len(a):
+            return a[self._start : end]
+        return a[self._start :] + a[: end - len(a)]
+
+    def append(self, x, y):
+        capacity = len(self._x)
+        if self._size == capacity:
+            self._x = self._ordered(self._x) + array("d", bytes(8 * capacity))
+            self._y = self._ordered(self._y) + array("d", bytes(8 * capacity))
+            self._start = 0
+            capacity *= 2
+
+        end = (self._start + self._size) % capacity
+        self._x[end] = x
+        self._y[end] = y
+        self._size += 1
+
+    def evict_up_to(self, x):
+        """
+        Remove points with x values up to and including `x`. Points are assumed to be appended in order.
+        Returns the number of points removed.
+        """
+        capacity = len(self._x)
+        n_evicted = 0
+        while self._size and self._x[self._start] <= x:
+            self._start = (self._start + 1) % capacity
+            self._size -= 1
+            n_evicted += 1
+        return n_evicted
+
+    def to_list(self):
+        return [
+            {"x": int(x), "y": y}
+            for x, y in zip(self._ordered(self._x), self._ordered(self._y))
+        ]
+
+    def to_arrays(self):
+        import numpy as np
+
+        return (
+            np.frombuffer(self._ordered(self._x)),
+            np.frombuffer(self._ordered(self._y)),
+        )
+
+
+class TimeSeriesPartition:
+    """
+    The series written to one output file: <output_dir>/<name>.json, and in incremental mode its segments
+    and manifest. Not thread safe, TimeSeriesAggregation's lock guards it.
+    """
+
+    def __init__(self, output_dir, name, buffer_capacity):
+        self.output_dir = output_dir
+        self.name = name
+        self.buffer_capacity = buffer_capacity
+        self.dirty = True  # the full file is out of date
+        self.latest_record_time = 0
+        self.pending_records = []  # incremental mode: not yet appended to the segment log
+        self.generation = 0
+        self.compacted_at = 0
+        self.clear()
+
+    @property
+    def output(self):
+        return self.output_dir + self.name + ".json"
+
+    @property
+    def manifest(self):
+        return manifest_path(self.output_dir, self.name)
+
+    @property
+    def segment(self):
+        return f"{self.output_dir}{self.name}.segment.{self.generation}.jsonl"
+
+    def clear(self):
+        self.series = []
+        self.buffers = {}  # label -> RingBuffer
+        self.dirty = True
+
+    def load(self, aggregated_time_series):
+        for label, points in zip(
+            aggregated_time_series["series"], aggregated_time_series["data"]
+        ):
+            buffer = self.get_or_create_buffer(label)
+            for point in points:
+                buffer.append(point["x"], point["y"])
+
+    def get_or_create_buffer(self, label):
+        if label not in self.buffers:
+            self.series.append(label)
+            self.buffers[label] = RingBuffer(self.buffer_capacity)
+        return self.buffers[label]
+
+    def record(self, time, latest_values, evict_up_to=None, incremental=False):
+        for label, latest_value in latest_values.items():
+            self.get_or_create_buffer(label).append(time, latest_value)
+
+        n_evicted = 0
+        if evict_up_to is not None:
+            for buffer in self.buffers.values():
+                n_evicted += buffer.evict_up_to(evict_up_to)
+
+        self.latest_record_time = time
+        self.dirty = self.dirty or bool(latest_values) or bool(n_evicted)
+        if incremental and latest_values:
+            self.pending_records.append({"x": time, "y": latest_values})
+
+
 class TimeSeriesAggregation(BackgroundJob):
     """
     This aggregates data _regardless_ of the experiment - users can choose to clear it (using the button), but better would
     be for the UI to clear it on new experiment creation.
+
+    With `partition_by_experiment`, each experiment's series are kept, and written, separately, to
+    <job_name>_<experiment>.json. Only the `max_partitions_in_memory` most recently updated experiments are
+    kept in memory, older ones are written to disk and dropped (and read back if they get new data).
+
+    Topics ending in `_batched` (ex: od_raw_batched) carry one value per key, and each key is labelled as
+    if it were published to `<topic>/<key>`.
     """
 
     def __init__(
@@ -39,16 +251,42 @@ class TimeSeriesAggregation(BackgroundJob):
         record_every_n_seconds=None,  # controls how often we should sample data. Ex: growth_rate is ~5min
         write_every_n_seconds=None,  # controls how often we write to disk. Ex: about 30seconds
         time_window_seconds=None,
+        incremental=False,  # append new points to a segment log, see above.
+        compact_every_n_seconds=300,
+        max_points_per_series=None,  # downsample series longer than this when written, for the UI.
+        downsampler="lttb",  # see pioreactor.utils.downsampling
+        partition_by_experiment=False,
+        max_partitions_in_memory=3,
         **kwargs,
     ):
 
         super(TimeSeriesAggregation, self).__init__(job_name=job_name, **kwargs)
         self.topic = topic
         self.output_dir = output_dir
-        self.aggregated_time_series = self.read(ignore_cache)
         self.extract_label = extract_label
+        self.ignore_cache = ignore_cache
         self.time_window_seconds = time_window_seconds
-        self.cache = {}
+        self.incremental = incremental
+        self.compact_every_n_seconds = compact_every_n_seconds
+        self.max_points_per_series = max_points_per_series
+        self.downsampler = DOWNSAMPLERS[downsampler]
+        self.partition_by_experiment = partition_by_experiment
+        self.max_partitions_in_memory = max_partitions_in_memory
+        self.cache = {}  # (experiment or None, label) -> latest value
+
+        # one RingBuffer per label. Points are only converted to json when written.
+        if time_window_seconds and record_every_n_seconds:
+            self.buffer_capacity = int(time_window_seconds / record_every_n_seconds) + 2
+        else:
+            self.buffer_capacity = 64
+
+        # on_clear is called from the MQTT thread. Reentrant, since writing is done while holding it.
+        self.lock = threading.RLock()
+        self.partitions = (
+            OrderedDict()
+        )  # experiment (or None) -> TimeSeriesPartition, oldest first
+        if not self.partition_by_experiment:
+            self.get_partition(None)
 
         self.write_thread = RepeatedTimer(
             write_every_n_seconds, self.write, job_name=self.job_name
@@ -63,16 +301,60 @@ class TimeSeriesAggregation(BackgroundJob):
         self.write_thread.cancel()
         self.append_cache_thread.cancel()
 
-    @property
-    def output(self):
-        return self.output_dir + self.job_name + ".json"
+    def partition_name(self, experiment):
+        return self.job_name if experiment is None else f"{self.job_name}_{experiment}"
+
+    def get_partition(self, experiment):
+        """
+        Get an experiment's partition, reading it from disk if it isn't in memory. Call with the lock held.
+        """
+        if experiment in self.partitions:
+            self.partitions.move_to_end(experiment)
+            return self.partitions[experiment]
 
-    def read(self, ignore_cache):
-        if ignore_cache:
+        partition = TimeSeriesPartition(
+            self.output_dir, self.partition_name(experiment), self.buffer_capacity
+        )
+        partition.load(self.read(partition))
+        self.partitions[experiment] = partition
+
+        if self.incremental:
+            partition.generation = self.read_manifest(partition).get("generation", 0)
+            self.compact(partition)
+        return partition
+
+    def experiments_on_disk(self):
+        """
+        The experiments with a partition on disk, including ones no longer in memory.
+        """
+        prefix = self.output_dir + self.job_name + "_"
+        return {
+            path[len(prefix) : -len(".json")]
+            for path in glob.glob(glob.escape(prefix) + "*.json")
+            if not path.endswith(".manifest.json")
+        }
+
+    def evict_partitions(self):
+        while len(self.partitions) > self.max_partitions_in_memory:
+            _, partition = self.partitions.popitem(last=False)
+            self.flush(partition)
+
+    def read_manifest(self, partition):
+        try:
+            with open(partition.manifest) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def read(self, partition):
+        if self.ignore_cache:
             return {"series": [], "data": []}
         try:
             # try except hell
-            with open(self.output, "r") as f:
+            if self.incremental and os.path.exists(partition.manifest):
+                return read_time_series(self.output_dir, partition.name)
+
+            with open(partition.output, "r") as f:
                 return json.loads(f.read())
         except (OSError, FileNotFoundError) as e:
             self.logger.debug(f"Loading failed or not found. {str(e)}")
@@ -81,51 +363,179 @@ class TimeSeriesAggregation(BackgroundJob):
             self.logger.debug(f"Loading failed or not found. {str(e)}")
             return {"series": [], "data": []}
 
+    @property
+    def aggregated_time_series(self):
+        """
+        The series, as written to disk. With partition_by_experiment, a dict of experiment -> series, for the
+        experiments in memory.
+        """
+        with self.lock:
+            if not self.partition_by_experiment:
+                return self.serialize(self.partitions[None])
+            return {
+                experiment: self.serialize(partition)
+                for experiment, partition in self.partitions.items()
+            }
+
+    def serialize(self, partition):
+        return {
+            "series": list(partition.series),
+            "data": [self.points(partition.buffers[label]) for label in partition.series],
+        }
+
+    def points(self, buffer):
+        if self.max_points_per_series and len(buffer) > self.max_points_per_series:
+            x, y = self.downsampler(*buffer.to_arrays(), self.max_points_per_series)
+            return [{"x": int(x_), "y": y_} for x_, y_ in zip(x.tolist(), y.tolist())]
+        return buffer.to_list()
+
     def write(self):
-        self.latest_write = current_time()
-        with open(self.output, mode="wt") as f:
-            json.dump(self.aggregated_time_series, f)
+        with self.lock:
+            self.latest_write = current_time()
+
+            for partition in self.partitions.values():
+                if not self.incremental:
+                    self.write_if_dirty(partition)
+
+                elif (
+                    self.latest_write - partition.compacted_at
+                    >= self.compact_every_n_seconds * 1000
+                ):
+                    self.compact(partition)
+
+                else:
+                    self.append_to_segment(partition)
+
+    def flush(self, partition):
+        if self.incremental:
+            self.compact(partition)
+        else:
+            self.write_if_dirty(partition)
+
+    def write_if_dirty(self, partition):
+        if not partition.dirty:
+            return
+        partition.dirty = False
+        write_atomically(partition.output, json.dumps(self.serialize(partition)))
+
+    def append_to_segment(self, partition):
+        records, partition.pending_records = partition.pending_records, []
+
+        if records:
+            with open(partition.segment, mode="at") as f:
+                f.write("".join(json.dumps(record) + "\n" for record in records))
+
+    def compact(self, partition):
+        """
+        Rewrite the full file, and start a new, empty, segment.
+        """
+        old_segment = partition.segment
+        partition.pending_records = []  # they're in the full file now
+        partition.generation += 1
+
+        write_atomically(partition.output, json.dumps(self.serialize(partition)))
+        open(partition.segment, mode="wt").close()
+        write_atomically(
+            partition.manifest,
+            json.dumps(
+                {
+                    "snapshot": os.path.basename(partition.output),
+                    "segment": os.path.basename(partition.segment),
+                    "compacted_until": partition.latest_record_time,
+                    "generation": partition.generation,
+                    "time_window_seconds": self.time_window_seconds,
+                }
+            ),
+        )
+
+        try:
+            os.remove(old_segment)
+        except FileNotFoundError:
+            pass
+
+        partition.compacted_at = current_time()
 
     def append_cache_and_clear(self):
         self.update_data_series()
-        self.cache = {}
 
     def update_data_series(self):
         time = current_time()
 
-        # .copy because a thread may try to update this while iterating.
-        for (label, latest_value) in self.cache.copy().items():
+        with self.lock:
+            # swap, because the MQTT thread may update the cache while we iterate.
+            cache, self.cache = self.cache, {}
 
-            if label not in self.aggregated_time_series["series"]:
-                self.aggregated_time_series["series"].append(label)
-                self.aggregated_time_series["data"].append([])
+            latest_values = {}  # experiment -> label -> value
+            for (experiment, label), value in cache.items():
+                latest_values.setdefault(experiment, {})[label] = value
 
-            ix = self.aggregated_time_series["series"].index(label)
-            self.aggregated_time_series["data"][ix].append({"x": time, "y": latest_value})
+            for experiment in latest_values:
+                self.get_partition(experiment)
 
-        if self.time_window_seconds:
-            for ix, _ in enumerate(self.aggregated_time_series["data"]):
-                # this is pretty inefficient, but okay for now.
-                self.aggregated_time_series["data"][ix] = [
-                    point
-                    for point in self.aggregated_time_series["data"][ix]
-                    if point["x"] > (current_time() - self.time_window_seconds * 1000)
-                ]
+            evict_up_to = (
+                time - self.time_window_seconds * 1000
+                if self.time_window_seconds
+                else None
+            )
+            for experiment, partition in self.partitions.items():
+                partition.record(
+                    time,
+                    latest_values.get(experiment, {}),
+                    evict_up_to=evict_up_to,
+                    incremental=self.incremental,
+                )
+
+            self.evict_partitions()
 
     def on_message(self, message):
+        experiment = message.topic.split("/")[2] if self.partition_by_experiment else None
+        if message.topic.endswith("_batched"):
+            self.on_batched_message(message, experiment)
+            return
+
         label = self.extract_label(message.topic)
         try:
-            self.cache[label] = float(message.payload)
+            self.cache[(experiment, label)] = float(message.payload)
         except ValueError:
             # sometimes a empty string is sent to clear the MQTT cache - that's okay - just pass.
             pass
 
+    def on_batched_message(self, message, experiment):
+        # ex: od_raw_batched, see batch_codec. Each key is labelled as if it came from its own
+        # topic, ex: {"135/0": 0.1} on .../od_raw_batched is labelled like .../od_raw/135/0.
+        topic = message.topic[: -len("_batched")]
+        try:
+            readings = batch_codec.decode(message.payload).readings
+        except ValueError:
+            # an empty message, to clear the MQTT cache.
+            return
+
+        for key, value in readings.items():
+            self.cache[(experiment, self.extract_label(f"{topic}/{key}"))] = float(value)
+
     def on_clear(self, message):
         payload = message.payload
         if not payload:
-            self.cache = {}
-            self.aggregated_time_series = {"series": [], "data": []}
-            self.write()
+            with self.lock:
+                self.cache = {}
+                for partition in self.partitions.values():
+                    partition.clear()
+                    # in incremental mode, this also tells readers to drop what they have.
+                    self.flush(partition)
+
+                if self.partition_by_experiment:
+                    # the experiments evicted from memory, write their partitions empty.
+                    for experiment in self.experiments_on_disk() - set(self.partitions):
+                        partition = TimeSeriesPartition(
+                            self.output_dir,
+                            self.partition_name(experiment),
+                            self.buffer_capacity,
+                        )
+                        if self.incremental:
+                            partition.generation = self.read_manifest(partition).get(
+                                "generation", 0
+                            )
+                        self.flush(partition)
         else:
             self.logger.warning("Only empty messages allowed to empty the cache.")
 
@@ -148,7 +558,19 @@ class TimeSeriesAggregation(BackgroundJob):
     help="the output directory",
 )
 @click.option("--ignore-cache", is_flag=True, help="skip using the saved data on disk")
-def click_time_series_aggregating(output_dir, ignore_cache):
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="append new points to a segment log, and only periodically rewrite the full files",
+)
+@click.option(
+    "--partition-by-experiment",
+    is_flag=True,
+    help="write each experiment's series to their own files",
+)
+def click_time_series_aggregating(
+    output_dir, ignore_cache, incremental, partition_by_experiment
+):
     """
     (leader only) Aggregate time series for UI.
 
@@ -160,6 +582,10 @@ def click_time_series_aggregating(output_dir, ignore_cache):
     from showing up. So we don't allow retained messages.
     """
     unit = get_unit_name()
+    max_points_per_series = config.getint(
+        "ui.overview.settings", "max_points_per_series", fallback=None
+    )
+    downsampler = config.get("ui.overview.settings", "downsampler", fallback="lttb")
 
     def single_sensor_label_from_topic(topic):
         split_topic = topic.split("/")
@@ -171,12 +597,16 @@ def click_time_series_aggregating(output_dir, ignore_cache):
         return split_topic[1]
 
     raw135 = TimeSeriesAggregation(  # noqa: F841
-        "pioreactor/+/+/od_raw/+/+",  # see note above about why we have no filter on experiment
+        "pioreactor/+/+/od_raw_batched",  # see note above about why we have no filter on experiment
         output_dir,
         experiment=UNIVERSAL_EXPERIMENT,
         job_name="od_raw_time_series_aggregating",
         unit=unit,
         ignore_cache=ignore_cache,
+        incremental=incremental,
+        partition_by_experiment=partition_by_experiment,
+        max_points_per_series=max_points_per_series,
+        downsampler=downsampler,
         extract_label=single_sensor_label_from_topic,
         write_every_n_seconds=10,
         time_window_seconds=60
@@ -185,12 +615,16 @@ def click_time_series_aggregating(output_dir, ignore_cache):
     )
 
     filtered135 = TimeSeriesAggregation(  # noqa: F841
-        "pioreactor/+/+/od_filtered/+/+",
+        "pioreactor/+/+/od_filtered_batched",
         output_dir,
         experiment=UNIVERSAL_EXPERIMENT,
         job_name="od_filtered_time_series_aggregating",
         unit=unit,
         ignore_cache=ignore_cache,
+        incremental=incremental,
+        partition_by_experiment=partition_by_experiment,
+        max_points_per_series=max_points_per_series,
+        downsampler=downsampler,
         extract_label=single_sensor_label_from_topic,
         write_every_n_seconds=10,
         time_window_seconds=60
@@ -205,6 +639,10 @@ def click_time_series_aggregating(output_dir, ignore_cache):
         job_name="growth_rate_time_series_aggregating",
         unit=unit,
         ignore_cache=ignore_cache,
+        incremental=incremental,
+        partition_by_experiment=partition_by_experiment,
+        max_points_per_series=max_points_per_series,
+        downsampler=downsampler,
         extract_label=unit_from_topic,
         write_every_n_seconds=10,
         record_every_n_seconds=3 * 60,  # TODO: move this to a config param
@@ -217,6 +655,10 @@ def click_time_series_aggregating(output_dir, ignore_cache):
         job_name="alt_media_fraction_time_series_aggregating",
         unit=unit,
         ignore_cache=ignore_cache,
+        incremental=incremental,
+        partition_by_experiment=partition_by_experiment,
+        max_points_per_series=max_points_per_series,
+        downsampler=downsampler,
         extract_label=unit_from_topic,
         write_every_n_seconds=10,
         record_every_n_seconds=1,
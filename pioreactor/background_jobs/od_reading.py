@@ -24,15 +24,30 @@ Also published to
 
 a json like: {"135/0": 0.086, "135/1": 0.086, "135/2": 0.0877, "135/3": 0.0873}
 
+or, with `payload_format=binary` in the [od_config.od_sampling] config section, a packed binary frame. Use
+`pioreactor.utils.batch_codec.decode` to read either format. The QoS of this pipeline is also configurable, with `qos`.
+
+With `direct=1` in the [od_config.od_sampling] config section, the ADCReader hands its readings to the ODReader
+in-process, instead of through the adc/ topics on the broker. The per-channel od_raw/ topics can then be turned off
+with `publish_per_channel=0`, so each sample is published once, in od_raw_batched. The leader's od_raw charts, and
+its od_readings_raw table, are fed by od_raw_batched.
+
+With `oversampling=N` (N > 1) in the [od_config.od_sampling] config section, each channel is read N times per
+reading, and the N samples are reduced to one value (see `oversampling_reducer`). The variance of the N samples is
+published to
+
+    pioreactor/<unit>/<experiment>/od_raw_variance_batched
+
+in the same format as od_raw_batched. Use a faster `data_rate` with oversampling, else a reading takes N times longer.
 
 """
 import time
-import json
 import signal
 
 import click
 from adafruit_ads1x15.analog_in import AnalogIn
 import adafruit_ads1x15.ads1115 as ADS
+from adafruit_ads1x15.ads1x15 import Mode
 import busio
 
 from pioreactor.utils.streaming_calculations import MovingStats
@@ -46,6 +61,7 @@ from pioreactor.background_jobs.subjobs.base import BackgroundSubJob
 from pioreactor.actions.led_intensity import led_intensity
 from pioreactor.hardware_mappings import SCL, SDA
 from pioreactor.pubsub import QOS
+from pioreactor.utils import batch_codec
 
 ADS_GAIN_THRESHOLDS = {
     2 / 3: (4.096, 6.144),
@@ -57,17 +73,77 @@ ADS_GAIN_THRESHOLDS = {
 }
 
 
+def _mean(samples):
+    return samples.mean(axis=1)
+
+
+def _median(samples):
+    import numpy as np
+
+    return np.median(samples, axis=1)
+
+
+def _trimmed_mean(samples, proportion=0.1):
+    # drop the lowest and highest `proportion` of each row's samples, and average the rest.
+    import numpy as np
+
+    n = samples.shape[1]
+    k = int(proportion * n)
+    return np.sort(samples, axis=1)[:, k : n - k].mean(axis=1)
+
+
+# each reduces a (channels, samples) array to one value per channel.
+REDUCERS = {"mean": _mean, "median": _median, "trimmed_mean": _trimmed_mean}
+
+
 class ADCReader(BackgroundSubJob):
-    def __init__(self, sampling_rate=1, fake_data=False, unit=None, experiment=None):
+    """
+    Parameters
+    -----------
+
+    on_reading: callable
+        if provided, readings are passed to on_reading(raw_signals, timestamp, gain, variances) instead of being
+        published to the broker. raw_signals is a dict of (ADS channel: voltage) pairs, and variances is a
+        dict of (ADS channel: variance) pairs of the oversampled readings, or None if not oversampling.
+
+    """
+
+    def __init__(
+        self,
+        sampling_rate=1,
+        fake_data=False,
+        on_reading=None,
+        unit=None,
+        experiment=None,
+    ):
         super(ADCReader, self).__init__(
             job_name="adc_reader", unit=unit, experiment=experiment
         )
         self.fake_data = fake_data
+        self.on_reading = on_reading
         self.ma = MovingStats(lookback=10)
         self.timer = RepeatedTimer(sampling_rate, self.take_reading)
         self.counter = 0
         self.ads = None
         self.analog_in = []
+        self.payload_format = config.get(
+            "od_config.od_sampling", "payload_format", fallback=batch_codec.JSON
+        )
+        self.qos = config.getint(
+            "od_config.od_sampling", "qos", fallback=QOS.EXACTLY_ONCE
+        )
+        # data_rate is measured in signals-per-second, and generally has less noise the lower the value. See datasheet.
+        self.data_rate = config.getint("od_config.od_sampling", "data_rate", fallback=8)
+        self.oversampling = config.getint(
+            "od_config.od_sampling", "oversampling", fallback=1
+        )
+        self.reducer = config.get(
+            "od_config.od_sampling", "oversampling_reducer", fallback="mean"
+        )
+        assert self.oversampling >= 1, "oversampling must be at least 1."
+        assert (
+            self.reducer in REDUCERS
+        ), f"oversampling_reducer must be one of {list(REDUCERS)}."
 
     def setup_adc(self):
         if self.fake_data:
@@ -77,8 +153,7 @@ class ADCReader(BackgroundSubJob):
 
         try:
             # we will change the gain dynamically later.
-            # data_rate is measured in signals-per-second, and generally has less noise the lower the value. See datasheet.
-            self.ads = ADS.ADS1115(i2c, gain=2, data_rate=8)
+            self.ads = ADS.ADS1115(i2c, gain=2, data_rate=self.data_rate)
         except ValueError as e:
             self.logger.error(
                 "Is the Pioreactor hardware installed on the RaspberryPi? Unable to find I²C for ADC measurements."
@@ -93,9 +168,43 @@ class ADCReader(BackgroundSubJob):
                 ai = AnalogIn(self.ads, getattr(ADS, f"P{channel}"))
             self.analog_in.append((channel, ai))
 
+        if self.oversampling > 1 and not self.fake_data:
+            # in continuous mode, repeated reads of the same channel don't need to
+            # start (and wait for) a new single-shot conversion each time.
+            self.ads.mode = Mode.CONTINUOUS
+
+    def read_channels(self):
+        """
+        Read each channel `oversampling` times, and reduce the samples.
+
+        Returns
+        --------
+        (dict of channel: voltage, dict of channel: variance or None)
+        """
+        if self.oversampling == 1:
+            return {channel: ai.voltage for channel, ai in self.analog_in}, None
+
+        import numpy as np
+
+        samples = np.empty((len(self.analog_in), self.oversampling))
+        for i, (_, ai) in enumerate(self.analog_in):
+            for j in range(self.oversampling):
+                if j > 0 and self.ads.mode == Mode.CONTINUOUS:
+                    # wait for the next conversion, else we read the same value again.
+                    time.sleep(1 / self.ads.data_rate)
+                samples[i, j] = ai.voltage
+
+        reduced = REDUCERS[self.reducer](samples)
+        variances = samples.var(axis=1, ddof=1)
+        channels = [channel for channel, _ in self.analog_in]
+        return (
+            dict(zip(channels, reduced.tolist())),
+            dict(zip(channels, variances.tolist())),
+        )
+
     def on_disconnect(self):
         try:
-            self.timer_thread.cancel()
+            self.timer.cancel()
         except AttributeError:
             pass
 
@@ -103,15 +212,15 @@ class ADCReader(BackgroundSubJob):
         self.counter += 1
         self.logger.debug(f"start = {time.time()}")
         try:
-            raw_signals = {}
-            for channel, ai in self.analog_in:
-                raw_signal_ = ai.voltage
-                self.publish(
-                    f"pioreactor/{self.unit}/{self.experiment}/adc/{channel}",
-                    raw_signal_,
-                    qos=QOS.EXACTLY_ONCE,
-                )
-                raw_signals[channel] = raw_signal_
+            timestamp = time.time()
+            raw_signals, variances = self.read_channels()
+            for channel, raw_signal_ in raw_signals.items():
+                if self.on_reading is None:
+                    self.publish(
+                        f"pioreactor/{self.unit}/{self.experiment}/adc/{channel}",
+                        raw_signal_,
+                        qos=self.qos,
+                    )
 
                 # since we don't show the user the raw voltage values, they may miss that they are near saturation of the op-amp (and could
                 # also damage the ADC). We'll alert the user if the voltage gets higher than 2.5V, which is well above anything normal.
@@ -123,12 +232,28 @@ class ADCReader(BackgroundSubJob):
                 # TODO: check if more than 3V, and shut down something? to prevent damage to ADC.
             self.logger.debug(f"end = {time.time()}")
 
-            # publish the batch of data, too, for reading
-            self.publish(
-                f"pioreactor/{self.unit}/{self.experiment}/adc_batched",
-                json.dumps(raw_signals),
-                qos=QOS.EXACTLY_ONCE,
-            )
+            if self.on_reading is None:
+                # publish the batch of data, too, for reading
+                self.publish(
+                    f"pioreactor/{self.unit}/{self.experiment}/adc_batched",
+                    batch_codec.encode(
+                        raw_signals,
+                        format=self.payload_format,
+                        timestamp=timestamp,
+                        gain=self.ads.gain,
+                    ),
+                    qos=self.qos,
+                )
+                if variances is not None:
+                    self.publish(
+                        f"pioreactor/{self.unit}/{self.experiment}/adc_variance_batched",
+                        batch_codec.encode(
+                            variances, format=self.payload_format, timestamp=timestamp
+                        ),
+                        qos=self.qos,
+                    )
+            else:
+                self.on_reading(raw_signals, timestamp, self.ads.gain, variances)
 
             # the max signal should determine the ADS1115's gain
             self.ma.update(max(raw_signals.values()))
@@ -166,6 +291,10 @@ class ODReader(BackgroundJob):
     -----------
 
     channel_label_map: dict of (ADS channel: label) pairs, ex: {0: "135/0", 1: "90/1"}
+    direct: bool
+        receive readings from our ADCReader in-process, instead of through the broker.
+    publish_per_channel: bool
+        also publish each reading to its own od_raw/<label> topic.
 
     """
 
@@ -177,6 +306,8 @@ class ODReader(BackgroundJob):
         channel_label_map,
         sampling_rate=1,
         fake_data=False,
+        direct=False,
+        publish_per_channel=True,
         unit=None,
         experiment=None,
     ):
@@ -185,9 +316,18 @@ class ODReader(BackgroundJob):
         )
         self.channel_label_map = channel_label_map
         self.fake_data = fake_data
+        self.direct = direct
+        self.publish_per_channel = publish_per_channel
+        self.payload_format = config.get(
+            "od_config.od_sampling", "payload_format", fallback=batch_codec.JSON
+        )
+        self.qos = config.getint(
+            "od_config.od_sampling", "qos", fallback=QOS.EXACTLY_ONCE
+        )
         self.adc_reader = ADCReader(
             sampling_rate=sampling_rate,
             fake_data=fake_data,
+            on_reading=self.publish_readings if self.direct else None,
             unit=self.unit,
             experiment=self.experiment,
         )
@@ -221,18 +361,78 @@ class ODReader(BackgroundJob):
         for job in self.sub_jobs:
             job.set_state("disconnected")
 
+    def publish_readings(self, raw_signals, timestamp=None, gain=None, variances=None):
+        # used in direct mode: our ADCReader hands us readings in-process.
+        if self.state != self.READY:
+            return
+
+        if variances is not None:
+            self.publish(
+                f"pioreactor/{self.unit}/{self.experiment}/od_raw_variance_batched",
+                batch_codec.encode(
+                    {
+                        label: variances[channel]
+                        for channel, label in self.channel_label_map.items()
+                    },
+                    format=self.payload_format,
+                    timestamp=timestamp,
+                ),
+                qos=self.qos,
+            )
+
+        od_readings = {}
+        for channel, label in self.channel_label_map.items():
+            od_readings[label] = raw_signals[channel]
+
+            if self.publish_per_channel:
+                self.publish(
+                    f"pioreactor/{self.unit}/{self.experiment}/od_raw/{label}",
+                    raw_signals[channel],
+                    qos=self.qos,
+                )
+
+        self.publish(
+            f"pioreactor/{self.unit}/{self.experiment}/od_raw_batched",
+            batch_codec.encode(
+                od_readings, format=self.payload_format, timestamp=timestamp, gain=gain
+            ),
+            qos=self.qos,
+        )
+
     def publish_batch(self, message):
         if self.state != self.READY:
             return
-        ads_readings = json.loads(message.payload)
+        ads_batch = batch_codec.decode(message.payload)
         od_readings = {}
         for channel, label in self.channel_label_map.items():
-            od_readings[label] = ads_readings[str(channel)]
+            od_readings[label] = ads_batch.readings[str(channel)]
 
         self.publish(
             f"pioreactor/{self.unit}/{self.experiment}/od_raw_batched",
-            json.dumps(od_readings),
-            qos=QOS.EXACTLY_ONCE,
+            batch_codec.encode(
+                od_readings,
+                format=self.payload_format,
+                timestamp=ads_batch.timestamp,
+                gain=ads_batch.gain,
+            ),
+            qos=self.qos,
+        )
+
+    def publish_variance_batch(self, message):
+        if self.state != self.READY:
+            return
+        ads_batch = batch_codec.decode(message.payload)
+        od_variances = {
+            label: ads_batch.readings[str(channel)]
+            for channel, label in self.channel_label_map.items()
+        }
+
+        self.publish(
+            f"pioreactor/{self.unit}/{self.experiment}/od_raw_variance_batched",
+            batch_codec.encode(
+                od_variances, format=self.payload_format, timestamp=ads_batch.timestamp
+            ),
+            qos=self.qos,
         )
 
     def publish_single(self, message):
@@ -248,21 +448,29 @@ class ODReader(BackgroundJob):
         self.publish(
             f"pioreactor/{self.unit}/{self.experiment}/od_raw/{label}",
             message.payload,
-            qos=QOS.EXACTLY_ONCE,
+            qos=self.qos,
         )
 
     def start_passive_listeners(self):
+        if self.direct:
+            # readings come straight from our ADCReader, see publish_readings.
+            return
 
         # process incoming data
         self.subscribe_and_callback(
             self.publish_batch,
             f"pioreactor/{self.unit}/{self.experiment}/adc_batched",
-            qos=QOS.EXACTLY_ONCE,
+            qos=self.qos,
+        )
+        self.subscribe_and_callback(
+            self.publish_variance_batch,
+            f"pioreactor/{self.unit}/{self.experiment}/adc_variance_batched",
+            qos=self.qos,
         )
         self.subscribe_and_callback(
             self.publish_single,
             f"pioreactor/{self.unit}/{self.experiment}/adc/+",
-            qos=QOS.EXACTLY_ONCE,
+            qos=self.qos,
         )
 
 
@@ -287,6 +495,10 @@ def od_reading(
     ODReader(
         channel_label_map,
         sampling_rate=sampling_rate,
+        direct=config.getboolean("od_config.od_sampling", "direct", fallback=False),
+        publish_per_channel=config.getboolean(
+            "od_config.od_sampling", "publish_per_channel", fallback=True
+        ),
         unit=unit,
         experiment=experiment,
         fake_data=fake_data,
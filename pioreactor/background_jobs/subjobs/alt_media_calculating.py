@@ -6,7 +6,7 @@ Continuously monitor the bioreactor and provide summary statistics on what's goi
 import json
 import os
 
-from pioreactor.pubsub import subscribe, QOS
+from pioreactor.pubsub import get_retained_messages, QOS
 from pioreactor.utils.timing import RepeatedTimer
 from pioreactor.background_jobs.subjobs.base import BackgroundSubJob
 from pioreactor.config import config
@@ -81,10 +81,10 @@ class AltMediaCalculator(BackgroundSubJob):
         return self.latest_alt_media_fraction
 
     def get_initial_alt_media_fraction(self):
-        message = subscribe(
-            f"pioreactor/{self.unit}/{self.experiment}/{self.job_name}/alt_media_fraction",
-            timeout=2,
+        topic = (
+            f"pioreactor/{self.unit}/{self.experiment}/{self.job_name}/alt_media_fraction"
         )
+        message = get_retained_messages(topic, timeout=2).get(topic)
 
         if message:
             return float(message.payload)
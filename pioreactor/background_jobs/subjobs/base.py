@@ -8,6 +8,10 @@ class BackgroundSubJob(BackgroundJob):
     def set_up_disconnect_protocol(self):
         pass
 
+    def check_for_duplicate_process(self):
+        # our parent job is registered, see job_registry.
+        pass
+
     def disconnected(self):
         # subjobs don't send a USR signal to end the job.
 
@@ -23,7 +27,5 @@ class BackgroundSubJob(BackgroundJob):
         self.state = self.DISCONNECTED
         self.logger.info(self.DISCONNECTED)
 
-        # disconnect from the passive subscription threads
-        for client in self.pubsub_clients:
-            client.loop_stop()  # takes a second or two.
-            client.disconnect()
+        # close our channel to the broker, our parent may still be using the connection.
+        self.channel.close()
@@ -9,7 +9,8 @@ from pioreactor.actions.add_media import add_media
 from pioreactor.actions.remove_waste import remove_waste
 from pioreactor.actions.add_alt_media import add_alt_media
 from pioreactor.pubsub import QOS
-from pioreactor.utils import pio_jobs_running
+from pioreactor.utils import is_pio_job_running, batch_codec
+from pioreactor.config import config
 from pioreactor.utils.timing import RepeatedTimer
 from pioreactor.background_jobs.subjobs.alt_media_calculating import AltMediaCalculator
 from pioreactor.background_jobs.subjobs.throughput_calculating import ThroughputCalculator
@@ -102,8 +103,8 @@ class DosingAutomation(BackgroundSubJob):
         time.sleep(8)  # wait some time for data to arrive
         if (self.latest_growth_rate is None) or (self.latest_od is None):
             self.logger.debug("Waiting for OD and growth rate data to arrive")
-            if not ("od_reading" in pio_jobs_running()) and (
-                "growth_rate_calculating" in pio_jobs_running()
+            if not is_pio_job_running("od_reading") and is_pio_job_running(
+                "growth_rate_calculating"
             ):
                 self.logger.warn(
                     "`od_reading` and `growth_rate_calculating` should be running."
@@ -222,8 +223,16 @@ class DosingAutomation(BackgroundSubJob):
         self.latest_growth_rate_timestamp = time.time()
 
     def _set_OD(self, message):
+        self._update_OD(float(message.payload))
+
+    def _set_OD_from_batch(self, message):
+        readings = batch_codec.decode(message.payload).readings
+        if self.sensor in readings:
+            self._update_OD(float(readings[self.sensor]))
+
+    def _update_OD(self, od):
         self.previous_od = self.latest_od
-        self.latest_od = float(message.payload)
+        self.latest_od = od
         self.latest_od_timestamp = time.time()
 
     def _clear_mqtt_cache(self):
@@ -262,10 +271,17 @@ class DosingAutomation(BackgroundSubJob):
         )
 
     def start_passive_listeners(self):
-        self.subscribe_and_callback(
-            self._set_OD,
-            f"pioreactor/{self.unit}/{self.experiment}/od_filtered/{self.sensor}",
-        )
+        # only one of these is subscribed to, else we'd see each OD twice (and previous_od == latest_od).
+        if config.getboolean("growth_rate_kalman", "publish_per_channel", fallback=True):
+            self.subscribe_and_callback(
+                self._set_OD,
+                f"pioreactor/{self.unit}/{self.experiment}/od_filtered/{self.sensor}",
+            )
+        else:
+            self.subscribe_and_callback(
+                self._set_OD_from_batch,
+                f"pioreactor/{self.unit}/{self.experiment}/od_filtered_batched",
+            )
         self.subscribe_and_callback(
             self._set_growth_rate, f"pioreactor/{self.unit}/{self.experiment}/growth_rate"
         )
@@ -7,7 +7,7 @@ import os
 import json
 
 
-from pioreactor.pubsub import subscribe, QOS
+from pioreactor.pubsub import RetainedMessageCache, QOS
 from pioreactor.background_jobs.subjobs.base import BackgroundSubJob
 
 JOB_NAME = os.path.splitext(os.path.basename((__file__)))[0]
@@ -27,8 +27,17 @@ class ThroughputCalculator(BackgroundSubJob):
             job_name=JOB_NAME, unit=unit, experiment=experiment
         )
 
-        self.media_throughput = self.get_initial_media_throughput()
-        self.alt_media_throughput = self.get_initial_alt_media_throughput()
+        with RetainedMessageCache(
+            [
+                f"pioreactor/{self.unit}/{self.experiment}/{self.job_name}/media_throughput",
+                f"pioreactor/{self.unit}/{self.experiment}/{self.job_name}/alt_media_throughput",
+            ],
+            timeout=2,
+        ) as retained_state:
+            self.media_throughput = self.get_initial_media_throughput(retained_state)
+            self.alt_media_throughput = self.get_initial_alt_media_throughput(
+                retained_state
+            )
 
         self.start_passive_listeners()
 
@@ -51,20 +60,18 @@ class ThroughputCalculator(BackgroundSubJob):
 
         return
 
-    def get_initial_media_throughput(self):
-        message = subscribe(
-            f"pioreactor/{self.unit}/{self.experiment}/{self.job_name}/media_throughput",
-            timeout=2,
+    def get_initial_media_throughput(self, retained_state):
+        message = retained_state.get(
+            f"pioreactor/{self.unit}/{self.experiment}/{self.job_name}/media_throughput"
         )
         if message:
             return float(message.payload)
         else:
             return 0
 
-    def get_initial_alt_media_throughput(self):
-        message = subscribe(
-            f"pioreactor/{self.unit}/{self.experiment}/{self.job_name}/alt_media_throughput",
-            timeout=2,
+    def get_initial_alt_media_throughput(self, retained_state):
+        message = retained_state.get(
+            f"pioreactor/{self.unit}/{self.experiment}/{self.job_name}/alt_media_throughput"
         )
         if message:
             return float(message.payload)
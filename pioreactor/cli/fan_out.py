@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Run commands on many units in parallel over SSH, for `pios`.
+
+Connections to units are OpenSSH ControlMaster connections, kept open for CONTROL_PERSIST_SECONDS
+after their last use, so consecutive `pios` commands (and the steps of one, like the two copies in
+`pios sync-configs`) reuse one SSH connection per unit instead of each paying for a new handshake.
+
+At most `max_workers` units are worked on at once, each command has a timeout, and each unit gets a
+Result (exit code, duration, stdout and stderr), so `report` can show exactly which units failed, and why.
+
+> results = fan_out(["pioreactor2", "pioreactor3"], lambda unit: [ssh(unit, "pio version")])
+> all_ok = report(results)
+"""
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+USERNAME = "pi"
+CONTROL_PERSIST_SECONDS = 600
+MAX_WORKERS = 16
+
+# %C is a hash of the connection's user, host and port, see `man ssh_config`.
+SSH_OPTIONS = ["-o", "ControlPath=~/.ssh/pios-%C", "-o", "BatchMode=yes"]
+
+
+class Result(namedtuple("Result", ["unit", "exit_code", "duration", "stdout", "stderr"])):
+    """
+    exit_code is None if the unit's commands couldn't be run, or timed out.
+    """
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+
+def ssh(unit, command):
+    return ["ssh", *SSH_OPTIONS, f"{USERNAME}@{unit}", command]
+
+
+def scp(unit, local_path, remote_path):
+    return ["scp", "-q", *SSH_OPTIONS, local_path, f"{USERNAME}@{unit}:{remote_path}"]
+
+
+def connect(unit, timeout):
+    """
+    Start a master connection to `unit`, unless one is already open. Returns (exit_code, stdout, stderr).
+    """
+    host = f"{USERNAME}@{unit}"
+    check = subprocess.run(
+        ["ssh", *SSH_OPTIONS, "-O", "check", host],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    if check.returncode == 0:
+        return 0, "", ""
+
+    # -f backgrounds the master once it's connected. It keeps our stderr open, so it goes to a file
+    # instead of a pipe, which we'd otherwise wait on until the master exits.
+    with tempfile.TemporaryFile(mode="w+") as stderr:
+        try:
+            master = subprocess.run(
+                [
+                    "ssh",
+                    *SSH_OPTIONS,
+                    "-o",
+                    f"ConnectTimeout={max(1, int(timeout))}",
+                    "-o",
+                    f"ControlPersist={CONTROL_PERSIST_SECONDS}",
+                    "-M",
+                    "-N",
+                    "-f",
+                    host,
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=stderr,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return None, "", f"Timed out connecting after {timeout}s."
+
+        stderr.seek(0)
+        return master.returncode, "", stderr.read()
+
+
+def run_command(command, timeout):
+    """
+    Returns (exit_code, stdout, stderr).
+    """
+    try:
+        p = subprocess.run(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return None, "", f"Timed out after {timeout}s."
+    return p.returncode, p.stdout, p.stderr
+
+
+def fan_out(units, commands_for_unit, timeout=30, max_workers=MAX_WORKERS):
+    """
+    Parameters
+    -----------
+    units: list of str
+    commands_for_unit: callable
+        unit -> list of commands (see `ssh` and `scp`), run in order on that unit, stopping at the first
+        that fails. It can raise to fail the unit before anything is run.
+    timeout: float
+        seconds, for connecting, and for each command.
+
+    Returns
+    --------
+    list of Result, in the order of `units`.
+    """
+
+    def _fan_out(unit):
+        start = time.monotonic()
+        try:
+            commands = commands_for_unit(unit)
+            exit_code, stdout, stderr = connect(unit, timeout)
+            if exit_code == 0:
+                for command in commands:
+                    exit_code, stdout, stderr = run_command(command, timeout)
+                    if exit_code != 0:
+                        break
+        except Exception as e:
+            exit_code, stdout, stderr = None, "", str(e)
+
+        return Result(unit, exit_code, time.monotonic() - start, stdout, stderr)
+
+    if not units:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(units))) as executor:
+        return list(executor.map(_fan_out, units))
+
+
+def report(results):
+    """
+    Print a line per unit, and a summary of the failures. Returns True if every unit succeeded.
+    """
+    for result in results:
+        if result.ok:
+            print(f"{result.unit}: ok ({result.duration:.1f}s)")
+        else:
+            reason = (result.stderr.strip().splitlines() or ["no error output"])[-1]
+            print(
+                f"{result.unit}: failed with exit code {result.exit_code} "
+                f"({result.duration:.1f}s): {reason}",
+                file=sys.stderr,
+            )
+
+    failed = [result.unit for result in results if not result.ok]
+    if failed:
+        print(
+            f"Failed on {len(failed)} of {len(results)} units: {', '.join(failed)}",
+            file=sys.stderr,
+        )
+    return not failed
@@ -6,17 +6,41 @@ cmd line interface for running individual pioreactor units (including leader)
 > pio run od_reading --od-angle-channel 135,0
 > pio log
 """
+import importlib
 import logging
 import click
 from pioreactor.whoami import am_I_leader, am_I_active_worker, get_unit_name
 from pioreactor.config import config
-from pioreactor import background_jobs as jobs
-from pioreactor import actions
-
 
 logger = logging.getLogger(f"{get_unit_name()}-CLI")
 
 
+class LazyGroup(click.Group):
+    """
+    A click group whose subcommands are only imported when they're used, so `pio version` doesn't
+    import every job (and numpy, paho, adafruit, etc. with them).
+
+    Parameters
+    -----------
+    lazy_subcommands: dict of (name: "module:attribute") pairs
+    """
+
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        super(LazyGroup, self).__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        return sorted(
+            [*super(LazyGroup, self).list_commands(ctx), *self.lazy_subcommands]
+        )
+
+    def get_command(self, ctx, name):
+        if name in self.lazy_subcommands:
+            module_name, attribute = self.lazy_subcommands[name].split(":")
+            return getattr(importlib.import_module(module_name), attribute)
+        return super(LazyGroup, self).get_command(ctx, name)
+
+
 @click.group()
 def pio():
     """
@@ -57,7 +81,7 @@ def kill(job):
             pass
 
 
-@pio.group(short_help="run a job")
+@pio.group(cls=LazyGroup, short_help="run a job")
 def run():
     pass
 
@@ -116,29 +140,37 @@ def update(ui, app):
 
 
 # this runs on both leader and workers
-run.add_command(jobs.monitor.click_monitor)
+run.lazy_subcommands["monitor"] = "pioreactor.background_jobs.monitor:click_monitor"
 
 if am_I_active_worker():
-    run.add_command(jobs.growth_rate_calculating.click_growth_rate_calculating)
-    run.add_command(jobs.stirring.click_stirring)
-    run.add_command(jobs.od_reading.click_od_reading)
-    run.add_command(jobs.dosing_control.click_dosing_control)
-    run.add_command(jobs.led_control.click_led_control)
-
-    run.add_command(actions.add_alt_media.click_add_alt_media)
-    run.add_command(actions.led_intensity.click_led_intensity)
-    run.add_command(actions.add_media.click_add_media)
-    run.add_command(actions.remove_waste.click_remove_waste)
-    run.add_command(actions.od_normalization.click_od_normalization)
+    run.lazy_subcommands.update(
+        {
+            "growth_rate_calculating": "pioreactor.background_jobs.growth_rate_calculating:click_growth_rate_calculating",
+            "stirring": "pioreactor.background_jobs.stirring:click_stirring",
+            "od_reading": "pioreactor.background_jobs.od_reading:click_od_reading",
+            "dosing_control": "pioreactor.background_jobs.dosing_control:click_dosing_control",
+            "led_control": "pioreactor.background_jobs.led_control:click_led_control",
+            "add_alt_media": "pioreactor.actions.add_alt_media:click_add_alt_media",
+            "led_intensity": "pioreactor.actions.led_intensity:click_led_intensity",
+            "add_media": "pioreactor.actions.add_media:click_add_media",
+            "remove_waste": "pioreactor.actions.remove_waste:click_remove_waste",
+            "od_normalization": "pioreactor.actions.od_normalization:click_od_normalization",
+        }
+    )
 
 if am_I_leader():
-    run.add_command(jobs.log_aggregating.click_log_aggregating)
-    run.add_command(jobs.mqtt_to_db_streaming.click_mqtt_to_db_streaming)
-    run.add_command(jobs.time_series_aggregating.click_time_series_aggregating)
-    run.add_command(jobs.watchdog.click_watchdog)
-
-    run.add_command(actions.download_experiment_data.click_download_experiment_data)
-    run.add_command(actions.backup_database.click_backup_database)
+    run.lazy_subcommands.update(
+        {
+            "log_aggregating": "pioreactor.background_jobs.leader.log_aggregating:click_log_aggregating",
+            "mqtt_to_db_streaming": "pioreactor.background_jobs.leader.mqtt_to_db_streaming:click_mqtt_to_db_streaming",
+            "time_series_aggregating": "pioreactor.background_jobs.leader.time_series_aggregating:click_time_series_aggregating",
+            "watchdog": "pioreactor.background_jobs.leader.watchdog:click_watchdog",
+            "download_experiment_data": "pioreactor.actions.leader.download_experiment_data:click_download_experiment_data",
+            "backup_database": "pioreactor.actions.leader.backup_database:click_backup_database",
+            "replay_growth_rate": "pioreactor.actions.leader.replay_growth_rate:click_replay_growth_rate",
+            "migrate_database": "pioreactor.actions.leader.migrate_database:click_migrate_database",
+        }
+    )
 
     @pio.command(short_help="access the db CLI")
     def db():
@@ -9,6 +9,7 @@ command line for running the same command on all workers,
 """
 from concurrent.futures import ThreadPoolExecutor
 import logging
+import sys
 
 import click
 
@@ -44,31 +45,49 @@ def universal_identifier_to_all_units(units):
     return units
 
 
-def sync_config_files(ssh_client, unit):
+def config_files_to_sync(unit):
     """
-    this function occurs in a thread
+    The scp commands that copy the global config.ini and the unit's config to `unit`.
     """
-    ftp_client = ssh_client.open_sftp()
+    import os
+    from pioreactor.cli.fan_out import scp
+
+    commands = []
 
     # move the global config.ini
     # there was a bug where if the leader == unit, the config.ini would get wiped
     if get_leader_hostname() != unit:
-        ftp_client.put(
-            "/home/pi/.pioreactor/config.ini", "/home/pi/.pioreactor/config.ini"
+        commands.append(
+            scp(
+                unit,
+                "/home/pi/.pioreactor/config.ini",
+                "/home/pi/.pioreactor/config.ini",
+            )
         )
 
     # move the local config.ini
-    try:
-        ftp_client.put(
-            f"/home/pi/.pioreactor/config_{unit}.ini",
-            "/home/pi/.pioreactor/unit_config.ini",
+    local_config = f"/home/pi/.pioreactor/config_{unit}.ini"
+    if not os.path.isfile(local_config):
+        raise FileNotFoundError(
+            f"Did you forget to create a config_{unit}.ini to ship to {unit}?"
         )
-    except Exception as e:
-        print(f"Did you forget to create a config_{unit}.ini to ship to {unit}?")
-        raise e
+    commands.append(scp(unit, local_config, "/home/pi/.pioreactor/unit_config.ini"))
 
-    ftp_client.close()
-    return
+    return commands
+
+
+def fan_out_and_report(units, commands_for_unit, timeout):
+    """
+    Run commands on the units (in parallel, reusing SSH connections), print how each unit did,
+    and exit with status 1 if any of them failed.
+    """
+    from pioreactor.cli.fan_out import fan_out, report
+
+    results = fan_out(
+        universal_identifier_to_all_units(units), commands_for_unit, timeout=timeout
+    )
+    if not report(results):
+        sys.exit(1)
 
 
 @click.group()
@@ -101,31 +120,12 @@ def update(units):
     """
     Pulls and installs the latest code from Github to the workers.
     """
-    import paramiko
+    from pioreactor.cli.fan_out import ssh
 
     command = "pio update --app"
 
-    def _thread_function(unit):
-        print(f"Executing on {unit}...")
-        try:
-
-            client = paramiko.SSHClient()
-            client.load_system_host_keys()
-            client.connect(unit, username="pi")
-
-            (stdin, stdout, stderr) = client.exec_command(command)
-            for line in stderr.readlines():
-                pass
-
-            client.close()
-
-        except Exception as e:
-            print(f"unit={unit}")
-            logger.debug(e, exc_info=True)
-
-    units = universal_identifier_to_all_units(units)
-    with ThreadPoolExecutor(max_workers=len(units)) as executor:
-        executor.map(_thread_function, units)
+    # installing can take a while on a Raspberry Pi.
+    fan_out_and_report(units, lambda unit: [ssh(unit, command)], timeout=30 * 60)
 
 
 @pios.command(name="sync-configs", short_help="sync config")
@@ -140,27 +140,7 @@ def sync_configs(units):
     """
     Deploys the global config.ini and worker specific config.inis to the workers.
     """
-    import paramiko
-
-    def _thread_function(unit):
-        print(f"Executing on {unit}...")
-        try:
-
-            client = paramiko.SSHClient()
-            client.load_system_host_keys()
-            client.connect(unit, username="pi")
-
-            sync_config_files(client, unit)
-
-            client.close()
-        except Exception as e:
-            print(f"unit={unit}")
-            logger.debug(e, exc_info=True)
-            logger.error(f"Unable to connect to unit {unit}.")
-
-    units = universal_identifier_to_all_units(units)
-    with ThreadPoolExecutor(max_workers=len(units)) as executor:
-        executor.map(_thread_function, units)
+    fan_out_and_report(units, config_files_to_sync, timeout=60)
 
 
 @pios.command("kill", short_help="kill a job(s) on workers")
@@ -186,7 +166,7 @@ def kill(job, units, y):
 
 
     """
-    from sh import ssh
+    from pioreactor.cli.fan_out import ssh
 
     if not y:
         confirm = input(f"Confirm killing `{job}` on {units}? Y/n: ").strip()
@@ -195,14 +175,7 @@ def kill(job, units, y):
 
     command = f"pio kill {' '.join(job)}"
 
-    def _thread_function(unit):
-
-        print(f"Executing {command} on {unit}...")
-        ssh(unit, command)
-
-    units = universal_identifier_to_all_units(units)
-    with ThreadPoolExecutor(max_workers=len(units)) as executor:
-        executor.map(_thread_function, units)
+    fan_out_and_report(units, lambda unit: [ssh(unit, command)], timeout=60)
 
 
 @pios.command(
@@ -237,7 +210,7 @@ def run(ctx, job, units, y):
     > pios run stirring --units pioreactor2 --units pioreactor3
 
     """
-    from sh import ssh
+    from pioreactor.cli.fan_out import ssh
 
     extra_args = list(ctx.args)
 
@@ -253,15 +226,8 @@ def run(ctx, job, units, y):
         if confirm != "Y":
             return
 
-    def _thread_function(unit):
-        print(f"Executing {core_command} on {unit}.")
-        ssh(unit, command)
-
-    units = universal_identifier_to_all_units(units)
-    with ThreadPoolExecutor(max_workers=len(units)) as executor:
-        executor.map(_thread_function, units)
-
-    return
+    # the job is started in the background, so this returns once it's launched.
+    fan_out_and_report(units, lambda unit: [ssh(unit, command)], timeout=60)
 
 
 @pios.command(
@@ -290,7 +256,7 @@ def update_settings(ctx, job, units):
     from pioreactor.pubsub import publish
 
     def _thread_function(unit):
-        for (setting, value) in extra_args.items():
+        for setting, value in extra_args.items():
             publish(f"pioreactor/{unit}/{exp}/{job}/{setting}/set", value)
 
     units = universal_identifier_to_all_units(units)
@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
+"""
+Importing this module sets up the root logger's handlers, but is cheap: the log file is opened, and the
+MQTT handlers look up the experiment and connect to the broker, only when the first record is logged
+(and the MQTT handlers do that in their background thread).
+"""
 import logging
+import json
+import queue
+import threading
+import time
+from functools import lru_cache
 from pioreactor.pubsub import create_client, publish
 from pioreactor.whoami import (
     get_unit_name,
     am_I_active_worker,
     UNIVERSAL_EXPERIMENT,
+    NO_EXPERIMENT,
     get_latest_experiment_name,
 )
 from pioreactor.config import config
@@ -19,9 +30,14 @@ class CustomMQTTtoUIFormatter(logging.Formatter):
         "DEFAULT": "[%(name)s] %(message)s",
     }
 
+    def __init__(self):
+        super(CustomMQTTtoUIFormatter, self).__init__()
+        self.formatters = {
+            level: logging.Formatter(log_fmt) for level, log_fmt in self.FORMATS.items()
+        }
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno, self.FORMATS["DEFAULT"])
-        formatter = logging.Formatter(log_fmt)
+        formatter = self.formatters.get(record.levelno, self.formatters["DEFAULT"])
         return formatter.format(record)
 
 
@@ -29,34 +45,184 @@ class MQTTHandler(logging.Handler):
     """
     A handler class which writes logging records, appropriately formatted,
     to a MQTT server to a topic.
+
+    Like logging.handlers.QueueHandler and QueueListener, records are formatted in the thread that
+    logged them, and published from a background thread, so logging never waits on the broker. The
+    background thread publishes everything queued when it wakes up: a lone record is published as
+    before, to `topic`, and more than one as a single json list of {"timestamp", "message"} to
+    `<topic>_batched`. Timestamps are milliseconds since the unix epoch.
+
+    The background thread is started by the first record, and connects to the broker then. `topic` can be
+    a function returning the topic, which is also called then. If the broker can't be reached (ex: a worker
+    booting before the leader), the thread keeps trying, with a linear backoff, and records queue up.
+
+    Under pressure, i.e. more than half of `max_queue_size` records waiting, DEBUG records are dropped.
+    If the queue is full, every record is dropped. `stats` counts the records queued and dropped, the
+    messages published, the publishes paho didn't accept, and the failed attempts to connect.
     """
 
-    def __init__(self, topic, qos=2):
+    def __init__(self, topic, qos=2, max_queue_size=1000, max_batch_size=100):
         logging.Handler.__init__(self)
         self.topic = topic
         self.qos = qos
-        self.client = create_client(client_id=f"{get_unit_name()}-pub-logging-{id(self)}")
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+        self.send_errors_to_Pioreactor_com = config.getboolean(
+            "error_reporting", "send_to_Pioreactor_com", fallback=False
+        )
+        self.client = None
+
+        self.stats = {
+            "queued": 0,
+            "dropped": 0,
+            "published": 0,
+            "publish_errors": 0,
+            "connection_errors": 0,
+        }
+
+        self._queue = queue.Queue(max_queue_size)
+        self._thread = None
 
     def emit(self, record):
-        msg = self.format(record)
-        self.client.publish(self.topic, msg, qos=self.qos, retain=False)
+        # called with the handler's lock held, see logging.Handler.handle.
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="mqtt-logging", daemon=True
+            )
+            self._thread.start()
+
+        if (
+            record.levelno <= logging.DEBUG
+            and self._queue.qsize() >= self.max_queue_size // 2
+        ):
+            self.stats["dropped"] += 1
+            return
+
+        try:
+            self._queue.put_nowait(
+                (int(record.created * 1000), self.format(record), record.levelno)
+            )
+            self.stats["queued"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        # publishes anything left in the queue.
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+        logging.Handler.close(self)
+
+    def _connect(self):
+        if callable(self.topic):
+            self.topic = self.topic()
+
+        attempt = 0
+        while True:
+            try:
+                self.client = create_client(
+                    client_id=f"{get_unit_name()}-pub-logging-{id(self)}"
+                )
+                return
+            except OSError:
+                # possible that leader is down/restarting, keep trying, but log to local machine.
+                # (These records are queued for MQTT too, and published once we're connected.)
+                attempt += 1
+                self.stats["connection_errors"] += 1
+                logger = logging.getLogger("pioreactor")
+                if attempt == 1:
+                    logger.warning(
+                        "Unable to connect to MQTT broker. Logs are queued until we can."
+                    )
+                logger.debug(
+                    f"Attempt {attempt}: "
+                    "Unable to connect to MQTT broker to publish logs.",
+                    exc_info=True,
+                )
+                time.sleep(min(5 * attempt, 60))  # linear backoff
+
+    def _run(self):
+        self._connect()
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
 
-        if config.getboolean("error_reporting", "send_to_Pioreactor_com", fallback=False):
+            closed = batch[-1] is None
+            if closed:
+                batch.pop()
+
+            if batch:
+                try:
+                    self._publish(batch)
+                except Exception:
+                    self.stats["publish_errors"] += 1
+                    logging.getLogger("pioreactor").debug(
+                        "Unable to publish logs.", exc_info=True
+                    )
+
+            if closed:
+                return
+
+    def _publish(self, batch):
+        from paho.mqtt.client import MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN
+
+        if len(batch) == 1:
+            info = self.client.publish(
+                self.topic, batch[0][1], qos=self.qos, retain=False
+            )
+        else:
+            info = self.client.publish(
+                f"{self.topic}_batched",
+                json.dumps(
+                    [
+                        {"timestamp": timestamp, "message": msg}
+                        for timestamp, msg, _ in batch
+                    ]
+                ),
+                qos=self.qos,
+                retain=False,
+            )
+
+        # while disconnected, paho keeps QoS 1 and 2 messages, and sends them once reconnected.
+        if info.rc == MQTT_ERR_SUCCESS or (info.rc == MQTT_ERR_NO_CONN and self.qos > 0):
+            self.stats["published"] += 1
+        else:
+            self.stats["publish_errors"] += 1
+
+        if self.send_errors_to_Pioreactor_com:
             # turned off, by default
-            if record.levelno == logging.ERROR:
-                # TODO: build this service!
-                publish(self.topic, msg, hostname="mqtt.pioreactor.com")
+            for _, msg, levelno in batch:
+                if levelno == logging.ERROR:
+                    # TODO: build this service!
+                    publish(self.topic, msg, hostname="mqtt.pioreactor.com")
 
 
 logging.raiseExceptions = False
 # reduce logging from third party libs
 logging.getLogger("sh").setLevel("ERROR")
 logging.getLogger("paramiko").setLevel("ERROR")
-logging.getLogger("sqlite3worker").setLevel("CRITICAL")
+
+
+@lru_cache(maxsize=None)
+def get_experiment_for_logs():
+    if not am_I_active_worker():
+        return UNIVERSAL_EXPERIMENT
+
+    try:
+        return get_latest_experiment_name()
+    except SystemExit:
+        # there's no experiment yet, see get_latest_experiment_name.
+        return NO_EXPERIMENT
 
 
 # file handler
-file_handler = logging.FileHandler(config["logging"]["log_file"])
+file_handler = logging.FileHandler(config["logging"]["log_file"], delay=True)
 file_handler.setLevel(logging.DEBUG)
 file_handler.setFormatter(
     logging.Formatter(
@@ -76,16 +242,16 @@ console_handler.setFormatter(
 
 
 # create MQTT handlers for logging to DB
-exp = get_latest_experiment_name() if am_I_active_worker() else UNIVERSAL_EXPERIMENT
-topic = f"pioreactor/{get_unit_name()}/{exp}/logs/app"
-mqtt_handler = MQTTHandler(topic)
+mqtt_handler = MQTTHandler(
+    lambda: f"pioreactor/{get_unit_name()}/{get_experiment_for_logs()}/logs/app"
+)
 mqtt_handler.setLevel(getattr(logging, config["logging"]["mqtt_log_level"]))
 mqtt_handler.setFormatter(logging.Formatter("[%(name)s] %(levelname)-2s %(message)s"))
 
 # create MQTT handlers for logging to UI
-exp = get_latest_experiment_name() if am_I_active_worker() else UNIVERSAL_EXPERIMENT
-topic = f"pioreactor/{get_unit_name()}/{exp}/app_logs_for_ui"
-ui_handler = MQTTHandler(topic)
+ui_handler = MQTTHandler(
+    lambda: f"pioreactor/{get_unit_name()}/{get_experiment_for_logs()}/app_logs_for_ui"
+)
 ui_handler.setLevel(getattr(logging, config["logging"]["ui_log_level"]))
 ui_handler.setFormatter(CustomMQTTtoUIFormatter())
 
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import socket
 import time
+import atexit
 import threading
 import logging
 from pioreactor.config import leader_hostname
@@ -12,11 +13,29 @@ class QOS:
     EXACTLY_ONCE = 2
 
 
-def create_client(hostname=leader_hostname, last_will=None, client_id=None, keepalive=60):
+def create_client(
+    hostname=leader_hostname,
+    last_will=None,
+    client_id=None,
+    keepalive=60,
+    on_connect=None,
+    on_message=None,
+    on_subscribe=None,
+):
     from paho.mqtt.client import Client
 
     client = Client(client_id=client_id)
 
+    # set before connecting, so we can't miss the first connection.
+    if on_connect is not None:
+        client.on_connect = on_connect
+
+    if on_message is not None:
+        client.on_message = on_message
+
+    if on_subscribe is not None:
+        client.on_subscribe = on_subscribe
+
     if last_will is not None:
         client.will_set(**last_will)
 
@@ -25,13 +44,122 @@ def create_client(hostname=leader_hostname, last_will=None, client_id=None, keep
     return client
 
 
+class ConnectionReadiness:
+    """
+    Signalled from a client's `on_connect`, so we can block until the broker has accepted our connection, instead of
+    spinning on `client.is_connected()` (which pins a CPU core while the leader is slow or restarting).
+
+    Example
+    ---------
+
+        readiness = ConnectionReadiness(on_reconnect=...)
+        client = create_client(on_connect=readiness.on_connect)
+        if not readiness.wait(timeout=10):
+            ...
+
+    Parameters
+    -------------
+    on_reconnect: callable
+        paho's `on_connect` signature, called on every successful connection _after_ the first one.
+
+    Attributes
+    -------------
+    latency: float
+        seconds between creating this object and the broker accepting our first connection. None until then.
+    """
+
+    def __init__(self, on_reconnect=None):
+        self.on_reconnect = on_reconnect
+        self.latency = None
+        self._started_at = time.monotonic()
+        self._event = threading.Event()
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc != 0:
+            # refused by the broker, paho will try again.
+            return
+
+        if not self._event.is_set():
+            self.latency = time.monotonic() - self._started_at
+            self._event.set()
+        elif self.on_reconnect is not None:
+            self.on_reconnect(client, userdata, flags, rc, properties)
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the first connection, or the timeout occurs. Returns True if connected.
+        """
+        return self._event.wait(timeout)
+
+
+class PublishClientPool:
+    """
+    Keeps one long-lived client per hostname for `publish`, so module-level publishers (actions, PID logs, etc.)
+    don't pay for a new TCP connection and MQTT handshake on every message. paho's `publish` is thread-safe, so a
+    single client per hostname is shared by all threads in the process.
+
+    Clients are created lazily on first use. After they have connected, paho's network thread takes care of
+    reconnecting if the broker goes away.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._latest_message_info = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, hostname):
+        with self._lock:
+            if hostname not in self._clients:
+                self._clients[hostname] = create_client(hostname=hostname)
+            return self._clients[hostname]
+
+    def publish(self, topic, message, hostname, **mqtt_kwargs):
+        from paho.mqtt.client import MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN, error_string
+
+        client = self.get_client(hostname)
+        info = client.publish(topic, payload=message, **mqtt_kwargs)
+
+        # QoS > 0 messages are queued by paho while it reconnects, and sent later. QoS 0 messages are dropped, so we
+        # surface them as a connection error and let the caller retry.
+        if info.rc == MQTT_ERR_NO_CONN and mqtt_kwargs.get("qos", 0) > 0:
+            pass
+        elif info.rc != MQTT_ERR_SUCCESS:
+            raise ConnectionRefusedError(error_string(info.rc))
+
+        self._latest_message_info[hostname] = info
+        return info
+
+    def disconnect_all(self, timeout=5):
+        # messages are sent from paho's network thread, so we give the last message per client
+        # a chance to leave before we disconnect (ex: short-lived `pio run add_media` processes).
+        with self._lock:
+            for hostname, client in self._clients.items():
+                info = self._latest_message_info.get(hostname)
+                if info is not None:
+                    try:
+                        info.wait_for_publish(timeout=timeout)
+                    except (ValueError, RuntimeError):
+                        pass
+                client.disconnect()
+                client.loop_stop()
+
+            self._clients.clear()
+            self._latest_message_info.clear()
+
+
+publish_client_pool = PublishClientPool()
+atexit.register(publish_client_pool.disconnect_all)
+
+
 def publish(topic, message, hostname=leader_hostname, retries=10, **mqtt_kwargs):
-    from paho.mqtt import publish as mqtt_publish
 
     retry_count = 1
     while True:
         try:
-            mqtt_publish.single(topic, payload=message, hostname=hostname, **mqtt_kwargs)
+            publish_client_pool.publish(topic, message, hostname, **mqtt_kwargs)
             return
         except (ConnectionRefusedError, socket.gaierror, OSError, socket.timeout):
             # possible that leader is down/restarting, keep trying, but log to local machine.
@@ -104,6 +232,432 @@ def subscribe(topics, hostname=leader_hostname, retries=10, timeout=None, **mqtt
             raise ConnectionRefusedError(f"Unable to connect to host: {hostname}.")
 
 
+class RetainedMessageCache:
+    """
+    Subscribe once to many topics, and gather all their retained messages in a single round trip to the broker.
+    Lookups are answered from memory, and the subscription stays open so that new messages on these topics keep
+    the cache fresh. Compare to calling `subscribe(..., timeout=2)` per topic, which can block for the whole timeout
+    on each topic that has no retained message.
+
+    How do we know when all retained messages have arrived? We also subscribe to a private sync topic, and publish to it
+    once our subscriptions are acknowledged. The broker serves retained messages when it handles a SUBSCRIBE, and
+    handles our packets in order, so by the time our sync message comes back, the retained messages have arrived too.
+
+    Example
+    ---------
+
+        with RetainedMessageCache([topic1, topic2], timeout=2) as cache:
+            message = cache.get(topic1)
+
+    Parameters
+    -------------
+    topics: str, list of str
+    timeout: float
+        the most we will wait for the broker to serve the retained messages.
+    """
+
+    def __init__(
+        self,
+        topics,
+        hostname=leader_hostname,
+        timeout=2,
+        retries=10,
+        qos=QOS.EXACTLY_ONCE,
+    ):
+        import paho.mqtt.client as mqtt
+        from uuid import uuid4
+
+        self.topics = [topics] if isinstance(topics, str) else list(topics)
+        self.hostname = hostname
+        self.qos = qos
+        self._messages = {}
+        self._condition = threading.Condition()
+        self._synced = False
+        self._id = uuid4().hex
+        self._sync_topic = f"pioreactor/retained_message_cache/{self._id}"
+
+        self.client = mqtt.Client(client_id=f"retained-message-cache-{self._id}")
+        self.client.on_connect = self._on_connect
+        self.client.on_subscribe = self._on_subscribe
+        self.client.on_message = self._on_message
+
+        retry_count = 1
+        while True:
+            try:
+                self.client.connect(hostname)
+                break
+            except (ConnectionRefusedError, socket.gaierror, OSError, socket.timeout):
+                logger = logging.getLogger("pioreactor")
+                logger.debug(
+                    f"Attempt {retry_count}: Unable to connect to host: {hostname}",
+                    exc_info=True,
+                )
+                time.sleep(5 * retry_count)  # linear backoff
+                retry_count += 1
+
+            if retry_count == retries:
+                logger = logging.getLogger("pioreactor")
+                logger.error(f"Unable to connect to host: {hostname}. Exiting.")
+                raise ConnectionRefusedError(f"Unable to connect to host: {hostname}.")
+
+        self.client.loop_start()
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._synced, timeout=timeout)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        # (re)subscribe on every connect, which also handles reconnects.
+        _, self._subscribe_mid = client.subscribe(
+            [(topic, self.qos) for topic in self.topics] + [(self._sync_topic, self.qos)]
+        )
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        if mid == self._subscribe_mid:
+            client.publish(self._sync_topic, b"", qos=self.qos)
+
+    def _on_message(self, client, userdata, message):
+        with self._condition:
+            if message.topic == self._sync_topic:
+                self._synced = True
+            elif not message.payload:
+                # an empty payload is how retained messages are cleared.
+                self._messages.pop(message.topic, None)
+            else:
+                self._messages[message.topic] = message
+            self._condition.notify_all()
+
+    @property
+    def messages(self):
+        with self._condition:
+            return dict(self._messages)
+
+    def get(self, topic, default=None):
+        """
+        Return the latest message seen on `topic`, retained or live.
+        """
+        with self._condition:
+            return self._messages.get(topic, default)
+
+    def pop(self, topic, default=None):
+        """
+        Forget the cached message on `topic`, ex: before producing a new value for it.
+        """
+        with self._condition:
+            return self._messages.pop(topic, default)
+
+    def wait_for(self, topic, timeout=None):
+        """
+        Block until a message on `topic` is in the cache, or the timeout occurs. Returns the message, or None.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: topic in self._messages, timeout=timeout)
+            return self._messages.get(topic)
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_retained_messages(topics, hostname=leader_hostname, timeout=2, **kwargs):
+    """
+    One-shot version of RetainedMessageCache: returns a dict of topic -> retained message
+    for all `topics`, after a single round trip to the broker.
+    """
+    with RetainedMessageCache(
+        topics, hostname=hostname, timeout=timeout, **kwargs
+    ) as cache:
+        return cache.messages
+
+
+class Channel:
+    """
+    A job's logical connection to the broker. Many channels share one physical connection, see SharedConnection.
+
+    Parameters
+    -------------
+    last_will: dict
+        a dictionary describing the last will details: topic, payload, qos, retain.
+    on_reconnect: callable
+        called (with no arguments) after the shared connection has reconnected to the broker. Subscriptions
+        are restored for us.
+
+    Attributes
+    -------------
+    startup_latency: float
+        seconds spent opening this channel, including waiting for the broker if we were the first channel.
+    """
+
+    def __init__(self, connection, last_will=None, on_reconnect=None):
+        self.connection = connection
+        self.last_will = last_will
+        self.on_reconnect = on_reconnect
+        self.is_open = True
+        self.startup_latency = None
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        return self.connection.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def subscribe(self, subscription, callback, qos=0):
+        """
+        callback has paho's signature: callback(client, userdata, message).
+        """
+        self.connection.subscribe(self, subscription, callback, qos=qos)
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            self.connection.close_channel(self)
+
+
+class SharedConnection:
+    """
+    Multiplexes all the jobs in a process (ex: a DosingController, its automation, and the automation's subjobs) over
+    a single MQTT connection and network thread, instead of two connections and two network threads per job.
+
+    Each job opens a `Channel`. Incoming messages are routed to the channels subscribed to them: our `on_message`
+    fans out to every channel's callback on each subscription matching the message's topic.
+
+    Locking: paho holds its own lock while it runs our callbacks, and our callbacks take `_lock`. So we never wait
+    on paho (ex: `loop_stop`, which joins the network thread) while holding `_lock`.
+
+    Retained messages: the broker only marks a message as retained when it's sent because of a new SUBSCRIBE. When a
+    second channel subscribes to an existing (or overlapping) subscription, the broker re-sends the retained messages,
+    but only the channel that just subscribed should see them. So each channel's subscription waits for the retained
+    messages of its own SUBSCRIBE, and no others, until they have all arrived. Like RetainedMessageCache, we know
+    when that is with a private sync topic: once the SUBSCRIBE is acknowledged, we publish its mid to the sync topic,
+    and the broker handles our packets in order, so the retained messages arrive before the mid comes back.
+
+    Last wills: MQTT allows a single last-will per connection. The connection uses the last-will of its first channel,
+    which is normally the process's top-level job. Subjobs are considered lost along with their parent. If the
+    channel owning the last-will closes while other channels are still open, we reconnect with the next channel's
+    last-will, so a job that disconnected cleanly isn't later marked as lost.
+
+    Parameters
+    -------------
+    connect_timeout: float
+        how long we wait for the broker to accept a connection before trying again, with a linear backoff.
+    retries: int
+        how many connection attempts before giving up and raising ConnectionRefusedError.
+
+    """
+
+    def __init__(
+        self, hostname=leader_hostname, keepalive=10, connect_timeout=10, retries=10
+    ):
+        from uuid import uuid4
+
+        self.hostname = hostname
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.client = None
+        self.channels = []
+        self._callbacks = {}  # subscription -> {channel: callback}
+        self._qos = {}  # subscription -> qos
+        # (channel, subscription) -> (mid of its SUBSCRIBE, topics of the retained messages delivered), until
+        # the broker has served all the retained messages for that SUBSCRIBE.
+        self._awaiting_retained = {}
+        self._sync_topic = f"pioreactor/shared_connection/{uuid4().hex}"
+        self._will_owner = None
+        self._client_id = None
+        self.connect_latency = None
+        self._lock = threading.RLock()
+
+    def open_channel(self, last_will=None, on_reconnect=None, client_id=None):
+        started_at = time.monotonic()
+
+        with self._lock:
+            channel = Channel(self, last_will=last_will, on_reconnect=on_reconnect)
+
+            if self.client is None:
+                self._client_id = client_id
+                self._connect(channel)
+
+            self.channels.append(channel)
+            channel.startup_latency = time.monotonic() - started_at
+            return channel
+
+    def close_channel(self, channel):
+        with self._lock:
+            self.channels.remove(channel)
+
+            for subscription in list(self._callbacks):
+                self._remove_callback(channel, subscription)
+
+            is_last_channel = not self.channels
+            if not is_last_channel and channel is not self._will_owner:
+                return
+
+            client = self.client
+            if is_last_channel:
+                self.client = None
+
+        # this HAS to happen last, because this contains our publishing client.
+        client.loop_stop()
+        client.disconnect()
+
+        if not is_last_channel:
+            self._reconnect_with_new_last_will(client)
+
+    def subscribe(self, channel, subscription, callback, qos=0):
+        with self._lock:
+            self._callbacks.setdefault(subscription, {})[channel] = callback
+            self._qos[subscription] = max(qos, self._qos.get(subscription, 0))
+            _, mid = self.client.subscribe(subscription, qos=self._qos[subscription])
+            self._awaiting_retained[(channel, subscription)] = (mid, set())
+
+    def _remove_callback(self, channel, subscription):
+        callbacks = self._callbacks[subscription]
+        callbacks.pop(channel, None)
+        self._awaiting_retained.pop((channel, subscription), None)
+
+        if not callbacks:
+            del self._callbacks[subscription]
+            del self._qos[subscription]
+            self.client.unsubscribe(subscription)
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        with self._lock:
+            is_awaited = any(
+                awaited_mid == mid for awaited_mid, _ in self._awaiting_retained.values()
+            )
+        if is_awaited:
+            client.publish(self._sync_topic, str(mid), qos=QOS.AT_LEAST_ONCE)
+
+    def _on_sync(self, message):
+        # the retained messages for this SUBSCRIBE have all arrived.
+        mid = int(message.payload)
+        with self._lock:
+            for key, (awaited_mid, _) in list(self._awaiting_retained.items()):
+                if awaited_mid == mid:
+                    del self._awaiting_retained[key]
+
+    def _on_message(self, client, userdata, message):
+        from paho.mqtt.client import topic_matches_sub
+
+        if message.topic == self._sync_topic:
+            self._on_sync(message)
+            return
+
+        with self._lock:
+            recipients = []
+            for subscription, callbacks in self._callbacks.items():
+                if not topic_matches_sub(subscription, message.topic):
+                    continue
+
+                for channel, callback in callbacks.items():
+                    if message.retain:
+                        awaiting = self._awaiting_retained.get((channel, subscription))
+                        if awaiting is None or message.topic in awaiting[1]:
+                            # served for another channel's SUBSCRIBE, or we already have it.
+                            continue
+                        awaiting[1].add(message.topic)
+                    recipients.append(callback)
+
+        for callback in recipients:
+            callback(client, userdata, message)
+
+    def _connect(self, will_owner):
+        readiness = ConnectionReadiness(on_reconnect=self._on_reconnect)
+
+        retry_count = 1
+        while True:
+            try:
+                client = create_client(
+                    hostname=self.hostname,
+                    last_will=will_owner.last_will,
+                    client_id=self._client_id,
+                    keepalive=self.keepalive,
+                    on_connect=readiness.on_connect,
+                    on_message=self._on_message,
+                    on_subscribe=self._on_subscribe,
+                )
+            except (ConnectionRefusedError, socket.gaierror, OSError, socket.timeout):
+                logger = logging.getLogger("pioreactor")
+                logger.debug(
+                    f"Attempt {retry_count}: Unable to connect to host: {self.hostname}",
+                    exc_info=True,
+                )
+            else:
+                # the client connects async, so wait for the broker to accept us.
+                if readiness.wait(timeout=self.connect_timeout):
+                    break
+
+                client.loop_stop()
+                client.disconnect()
+                logger = logging.getLogger("pioreactor")
+                logger.debug(
+                    f"Attempt {retry_count}: Timed out waiting for host: {self.hostname}"
+                )
+
+            time.sleep(5 * retry_count)  # linear backoff
+            retry_count += 1
+
+            if retry_count == self.retries:
+                logger = logging.getLogger("pioreactor")
+                logger.error(f"Unable to connect to host: {self.hostname}. Exiting.")
+                raise ConnectionRefusedError(
+                    f"Unable to connect to host: {self.hostname}."
+                )
+
+        client.subscribe(self._sync_topic, qos=QOS.AT_LEAST_ONCE)
+        self.client = client
+        self._will_owner = will_owner
+        self.connect_latency = readiness.latency
+
+    def _on_reconnect(self, client, userdata, flags, rc, properties=None):
+        # our subscriptions are lost when we reconnect, so restore them all, and every channel sees the
+        # retained messages again.
+        with self._lock:
+            client.subscribe(self._sync_topic, qos=QOS.AT_LEAST_ONCE)
+            self._awaiting_retained = {}
+            for subscription, callbacks in self._callbacks.items():
+                _, mid = client.subscribe(subscription, qos=self._qos[subscription])
+                for channel in callbacks:
+                    self._awaiting_retained[(channel, subscription)] = (mid, set())
+            channels = list(self.channels)
+
+        for channel in channels:
+            if channel.on_reconnect is not None:
+                channel.on_reconnect()
+
+    def _reconnect_with_new_last_will(self, old_client):
+        with self._lock:
+            if self.client is not old_client or not self.channels:
+                # the last channel closed while we were disconnecting.
+                return
+
+            self._connect(self.channels[0])
+            # only channels still waiting for their retained messages should see them again.
+            awaiting, self._awaiting_retained = self._awaiting_retained, {}
+            for subscription, callbacks in self._callbacks.items():
+                _, mid = self.client.subscribe(subscription, qos=self._qos[subscription])
+                for channel in callbacks:
+                    key = (channel, subscription)
+                    if key in awaiting:
+                        self._awaiting_retained[key] = (mid, awaiting[key][1])
+
+
+_shared_connections = {}
+_shared_connections_lock = threading.Lock()
+
+
+def get_shared_connection(hostname=leader_hostname):
+    """
+    The process-wide SharedConnection to `hostname`.
+    """
+    with _shared_connections_lock:
+        if hostname not in _shared_connections:
+            _shared_connections[hostname] = SharedConnection(hostname=hostname)
+        return _shared_connections[hostname]
+
+
 def subscribe_and_callback(
     callback,
     topics,
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Connections to the leader's SQLite database. Use these instead of calling `sqlite3.connect` directly.
+
+The database is in WAL mode, so readers (exports, the UI, queries) don't block the writer (the MQTT to DB
+streamer), and the writer doesn't block readers. There should be a single writer connection, see
+`connect_writer`. Readers borrow read-only connections from a pool, see `read_connection`:
+
+    with read_connection() as con:
+        con.execute(...)
+
+"""
+
+import threading
+import sqlite3
+from contextlib import contextmanager
+from queue import Queue, Empty, Full
+
+from pioreactor.config import config
+
+# the schema version of sql/create_tables.sql, stored in the database's user_version. Older databases are
+# brought up to date with `pio run migrate_database`.
+SCHEMA_VERSION = 1
+
+# applied to every connection. journal_mode is persistent, and set by the writer.
+PRAGMAS = {
+    # with WAL, NORMAL is safe from corruption, and avoids an fsync per transaction.
+    "synchronous": "NORMAL",
+    # negative values are in KiB, so 16MB of page cache.
+    "cache_size": -16000,
+    "mmap_size": 64 * 1024 * 1024,
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+}
+
+
+def get_database():
+    return config["storage"]["database"]
+
+
+def get_schema_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _apply_pragmas(connection):
+    for pragma, value in PRAGMAS.items():
+        connection.execute(f"PRAGMA {pragma}={value}")
+
+
+def connect_writer(database=None, **kwargs):
+    """
+    Open a connection for writing. The database is put in WAL mode, if it isn't already.
+    """
+    connection = sqlite3.connect(database or get_database(), **kwargs)
+    connection.execute("PRAGMA journal_mode=WAL")
+    _apply_pragmas(connection)
+    return connection
+
+
+def connect_reader(database=None):
+    """
+    Open a read-only connection. Prefer `read_connection`, which reuses connections.
+    """
+    connection = sqlite3.connect(
+        f"file:{database or get_database()}?mode=ro",
+        uri=True,
+        check_same_thread=False,  # connections are handed between threads by the pool, but only used by one at a time.
+    )
+    _apply_pragmas(connection)
+    connection.execute("PRAGMA query_only=ON")
+    return connection
+
+
+class ReadConnectionPool:
+    """
+    Keeps up to `max_idle` read-only connections open, so queries and exports don't pay for opening a
+    connection (and warming its cache) each time. More connections than `max_idle` can be borrowed at once,
+    the extras are closed when returned.
+    """
+
+    def __init__(self, database=None, max_idle=4):
+        self.database = database
+        self._idle = Queue(maxsize=max_idle)
+
+    @contextmanager
+    def connection(self):
+        try:
+            connection = self._idle.get_nowait()
+        except Empty:
+            connection = connect_reader(self.database)
+
+        try:
+            yield connection
+        finally:
+            # don't leave a read transaction open, it would stop the WAL from being checkpointed.
+            if connection.in_transaction:
+                connection.rollback()
+            try:
+                self._idle.put_nowait(connection)
+            except Full:
+                connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                return
+
+
+_read_pools = {}
+_read_pools_lock = threading.Lock()
+
+
+def read_connection(database=None):
+    """
+    Borrow a pooled read-only connection, as a context manager.
+    """
+    database = database or get_database()
+    with _read_pools_lock:
+        if database not in _read_pools:
+            _read_pools[database] = ReadConnectionPool(database)
+        pool = _read_pools[database]
+    return pool.connection()
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 import time
 
+import pytest
+
 from pioreactor.background_jobs.base import BackgroundJob
+from pioreactor.utils import job_registry
 from pioreactor.whoami import get_unit_name, get_latest_experiment_name
-from pioreactor.pubsub import publish
+from pioreactor.pubsub import publish, get_shared_connection
 
 
 def pause():
@@ -33,3 +36,56 @@ def test_states():
 
     publish(f"pioreactor/{unit}/{exp}/job/$state/set", "disconnected")
     pause()
+
+
+def test_jobs_in_a_process_share_one_connection():
+    from pioreactor.background_jobs.subjobs.base import BackgroundSubJob
+
+    unit = get_unit_name()
+    exp = get_latest_experiment_name()
+    topic = f"pioreactor/{unit}/{exp}/test_shared_connection"
+    publish(topic, "retained", retain=True)
+    pause()
+
+    job1 = BackgroundSubJob(job_name="job1", unit=unit, experiment=exp)
+    job2 = BackgroundSubJob(job_name="job2", unit=unit, experiment=exp)
+    assert job1.channel.connection.client is job2.channel.connection.client
+
+    received1, received2 = [], []
+    job1.subscribe_and_callback(lambda msg: received1.append(msg.payload), topic)
+    pause()
+    job2.subscribe_and_callback(lambda msg: received2.append(msg.payload), topic)
+    pause()
+
+    # each job sees the retained message exactly once.
+    assert received1 == [b"retained"]
+    assert received2 == [b"retained"]
+
+    publish(topic, "live")
+    pause()
+    assert received1 == [b"retained", b"live"]
+    assert received2 == [b"retained", b"live"]
+
+    job2.set_state("disconnected")
+    publish(topic, "after")
+    pause()
+    assert received1 == [b"retained", b"live", b"after"]
+    assert received2 == [b"retained", b"live"]
+
+    job1.set_state("disconnected")
+    publish(topic, None, retain=True)
+
+
+def test_a_duplicate_job_does_not_open_a_channel(monkeypatch):
+    # as if another process were running the job.
+    monkeypatch.setattr(job_registry, "register", lambda job_name: False)
+    n_channels = len(get_shared_connection().channels)
+
+    with pytest.raises(ValueError):
+        BackgroundJob(
+            job_name="duplicate_job",
+            unit=get_unit_name(),
+            experiment=get_latest_experiment_name(),
+        )
+
+    assert len(get_shared_connection().channels) == n_channels
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from pioreactor.utils import batch_codec
+
+
+def test_binary_frames_round_trip():
+    readings = {0: 0.086, 1: 0.0877, 3: 1.5}
+    payload = batch_codec.encode(
+        readings, format=batch_codec.BINARY, timestamp=1600000000.25, gain=2
+    )
+
+    batch = batch_codec.decode(payload)
+    assert list(batch.readings.keys()) == ["0", "1", "3"]
+    assert all(abs(batch.readings[str(k)] - v) < 1e-6 for k, v in readings.items())
+    assert batch.timestamp == 1600000000.25
+    assert batch.gain == 2
+
+
+def test_binary_frames_are_smaller_than_json():
+    readings = {"135/0": 0.08612345678, "135/1": 0.08612345678, "90/2": 0.0877654321}
+    binary = batch_codec.encode(readings, format=batch_codec.BINARY)
+    assert len(binary) < len(batch_codec.encode(readings))
+    assert batch_codec.decode(binary).timestamp is None
+
+
+def test_decode_accepts_json():
+    batch = batch_codec.decode(json.dumps({"135/0": 0.5}))
+    assert batch.readings == {"135/0": 0.5}
+    assert batch.timestamp is None and batch.gain is None
+
+    assert batch_codec.decode(b'{"135/0": 0.5}').readings == {"135/0": 0.5}
+
+
+def test_binary_frames_refuse_readings_that_dont_fit():
+    with pytest.raises(ValueError, match="at most 255 readings"):
+        batch_codec.encode({i: 0.0 for i in range(256)}, format=batch_codec.BINARY)
+
+    with pytest.raises(ValueError, match="at most 255 bytes"):
+        batch_codec.encode({"é" * 128: 0.0}, format=batch_codec.BINARY)
+
+    # right at the limits is fine.
+    readings = {f"{i:0255d}": 0.0 for i in range(255)}
+    payload = batch_codec.encode(readings, format=batch_codec.BINARY)
+    assert batch_codec.decode(payload).readings == readings
+
+    # json doesn't have these limits.
+    batch_codec.encode({i: 0.0 for i in range(256)})
@@ -12,6 +12,8 @@ from pioreactor.background_jobs.dosing_control import (
 from pioreactor.background_jobs.subjobs.dosing_automation import DosingAutomation
 from pioreactor.dosing_automations import events
 from pioreactor.whoami import get_unit_name, get_latest_experiment_name
+from pioreactor.config import config
+from pioreactor.utils import batch_codec
 from pioreactor import pubsub
 
 unit = get_unit_name()
@@ -38,6 +40,25 @@ def test_silent_automation():
     algo.set_state("disconnected")
 
 
+def test_automations_read_od_filtered_batched_without_per_channel_topics(monkeypatch):
+    monkeypatch.setitem(config["growth_rate_kalman"], "publish_per_channel", "0")
+    algo = Silent(volume=None, duration=60, unit=unit, experiment=experiment)
+    pause()
+    pubsub.publish(
+        f"pioreactor/{unit}/{experiment}/od_filtered_batched",
+        batch_codec.encode({"135/0": 1.0, "90/1": 2.0}),
+    )
+    pause()
+    pubsub.publish(
+        f"pioreactor/{unit}/{experiment}/od_filtered_batched",
+        batch_codec.encode({"135/0": 1.1, "90/1": 2.1}, format=batch_codec.BINARY),
+    )
+    pause()
+    assert algo.previous_od == 1.0
+    assert round(algo.latest_od, 5) == 1.1  # float32 in the binary format
+    algo.set_state("disconnected")
+
+
 def test_turbidostat_automation():
     target_od = 1.0
     algo = Turbidostat(
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import sqlite3
+import zipfile
+from datetime import datetime, timezone
+
+import pytest
+
+import pioreactor.storage
+from pioreactor.actions.leader.download_experiment_data import download_experiment_data
+
+experiment = "test_download_experiment_data"
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    database = str(tmp_path / "pioreactor.sqlite")
+    con = sqlite3.connect(database)
+    with open("sql/create_tables.sql") as f:
+        con.executescript(f.read())
+
+    # one reading a second, for 100 seconds, from two sensors.
+    con.executemany(
+        "INSERT INTO od_readings_raw VALUES (?, ?, ?, ?, ?)",
+        [
+            (1_600_000_000_000 + i * 1000, "unit1", 0.1 * i, experiment, angle)
+            for i in range(100)
+            for angle in ("90", "135")
+        ],
+    )
+    con.execute(
+        "INSERT INTO od_readings_raw VALUES (?, ?, ?, ?, ?)",
+        (1_600_000_000_000, "unit1", 1.0, "another_experiment", "90"),
+    )
+    con.executemany(
+        "INSERT INTO experiments VALUES (?, ?, ?)",
+        [(experiment, "2020-09-13T12:26:40", "a"), ("another", "2020-09-14", "b")],
+    )
+    # no timestamp at all.
+    con.executemany(
+        "INSERT INTO dosing_automation_settings VALUES (?, ?, ?, ?, ?, ?)",
+        [("unit1", experiment, "2020-09-13", None, "silent", "{}")] * 3,
+    )
+    con.commit()
+    con.close()
+
+    monkeypatch.setattr(pioreactor.storage, "get_database", lambda: database)
+    return database
+
+
+def read_csvs(output):
+    tables = {}
+    with zipfile.ZipFile(output) as zf:
+        for name in zf.namelist():
+            table = name.split("-")[1]
+            with zf.open(name) as f:
+                tables[table] = list(
+                    csv.DictReader(io.TextIOWrapper(f, encoding="utf-8"))
+                )
+    return tables
+
+
+def test_export_streams_every_table_into_the_zip(database, tmp_path):
+    output = str(tmp_path / "export.zip")
+    progress = []
+
+    download_experiment_data(
+        experiment,
+        output,
+        ["od_readings_raw", "experiments", "dosing_automation_settings"],
+        progress=lambda table, n_rows: progress.append((table, n_rows)),
+        chunksize=50,
+    )
+    tables = read_csvs(output)
+
+    readings = tables["od_readings_raw"]
+    assert len(readings) == 200
+    # ordered by sensor, then time, and the timestamps are ISO8601 in UTC.
+    assert [r["angle"] for r in readings[:2]] == ["135", "135"]
+    assert readings[0]["timestamp"] == "2020-09-13T12:26:40.000Z"
+
+    assert len(tables["experiments"]) == 1
+    assert len(tables["dosing_automation_settings"]) == 3
+    assert ("od_readings_raw", 200) in progress and ("od_readings_raw", 50) in progress
+
+
+def test_export_filters_on_time_and_downsamples(database, tmp_path):
+    output = str(tmp_path / "export.zip")
+
+    download_experiment_data(
+        experiment,
+        output,
+        ["od_readings_raw", "experiments", "dosing_automation_settings"],
+        start_time=datetime.fromtimestamp(1_600_000_010, tz=timezone.utc),
+        end_time=datetime.fromtimestamp(1_600_000_060, tz=timezone.utc),
+        downsample_seconds=10,
+    )
+    tables = read_csvs(output)
+
+    # 50 seconds of readings, one every 10 seconds, for each sensor.
+    readings = tables["od_readings_raw"]
+    assert len(readings) == 10
+    assert {r["timestamp"] for r in readings if r["angle"] == "90"} == {
+        f"2020-09-13T12:{minute}.000Z"
+        for minute in ["26:50", "27:00", "27:10", "27:20", "27:30"]
+    }
+
+    # tables that aren't time series aren't filtered or downsampled.
+    assert len(tables["experiments"]) == 1
+    assert len(tables["dosing_automation_settings"]) == 3
+
+
+def test_filtering_an_unmigrated_table_asks_to_migrate(database, tmp_path):
+    # logs, as it was before migrate_database.
+    con = sqlite3.connect(database)
+    con.execute("DROP TABLE logs")
+    con.execute("CREATE TABLE logs (timestamp TEXT, experiment TEXT, message TEXT)")
+    con.executemany(
+        "INSERT INTO logs VALUES (?, ?, ?)",
+        [(f"2020-09-13T12:26:{i:02d}", experiment, "hi") for i in range(10)],
+    )
+    con.commit()
+    con.close()
+
+    output = tmp_path / "export.zip"
+    with pytest.raises(ValueError, match="migrate_database"):
+        download_experiment_data(experiment, str(output), ["logs"], downsample_seconds=10)
+    with pytest.raises(ValueError, match="migrate_database"):
+        download_experiment_data(
+            experiment,
+            str(output),
+            ["od_readings_raw", "logs"],
+            start_time=datetime(2020, 9, 13),
+        )
+    assert not output.exists()
+
+    # without filters, it's exported as is.
+    download_experiment_data(experiment, str(output), ["logs"])
+    logs = read_csvs(str(output))["logs"]
+    assert len(logs) == 10
+    assert logs[0]["timestamp"] == "2020-09-13T12:26:00"
+
+
+def test_export_refuses_tables_that_dont_exist(database, tmp_path):
+    with pytest.raises(ValueError):
+        download_experiment_data(
+            experiment, str(tmp_path / "export.zip"), ["od_readings_raw; DROP TABLE logs"]
+        )
+
+
+def test_npz_export_loads_with_numpy_and_load_npz(database, tmp_path):
+    import numpy as np
+    from pioreactor.actions.leader.download_experiment_data import load_npz
+
+    output = str(tmp_path / "export.npz")
+    download_experiment_data(
+        experiment,
+        output,
+        ["od_readings_raw", "dosing_automation_settings"],
+        format="npz",
+        chunksize=30,
+    )
+
+    with np.load(output) as data:
+        loaded = {name: data[name] for name in data.files}
+    mapped = load_npz(output)
+    assert set(mapped) == set(loaded)
+    for name in loaded:
+        assert np.array_equal(mapped[name], loaded[name])
+
+    # timestamps are int64 milliseconds, values keep their type, text is dictionary encoded.
+    assert mapped["od_readings_raw/timestamp"].dtype == np.int64
+    assert mapped["od_readings_raw/timestamp"][0] == 1_600_000_000_000
+    assert mapped["od_readings_raw/od_reading_v"].dtype == np.float32
+    assert len(mapped["od_readings_raw/od_reading_v"]) == 200
+
+    angles = mapped["od_readings_raw/angle.categories"][mapped["od_readings_raw/angle"]]
+    assert sorted(set(angles)) == ["135", "90"]
+
+    # NULL text is -1.
+    assert list(mapped["dosing_automation_settings/ended_at"]) == [-1, -1, -1]
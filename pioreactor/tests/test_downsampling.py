@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from pioreactor.utils.downsampling import lttb, min_max
+
+
+@pytest.mark.parametrize("downsampler", [lttb, min_max])
+def test_small_series_are_unchanged(downsampler):
+    x, y = np.arange(10.0), np.arange(10.0)
+    x_out, y_out = downsampler(x, y, 100)
+    assert (x_out == x).all()
+    assert (y_out == y).all()
+
+
+@pytest.mark.parametrize("downsampler", [lttb, min_max])
+def test_output_is_bounded_and_ordered(downsampler):
+    x = np.arange(10000.0)
+    y = np.sin(x / 100)
+    x_out, y_out = downsampler(x, y, 500)
+    assert len(x_out) <= 500
+    assert (np.diff(x_out) > 0).all()
+    assert np.isin(x_out, x).all()
+
+
+def test_lttb_keeps_endpoints_and_spikes():
+    x = np.arange(10000.0)
+    y = np.zeros(10000)
+    y[4321] = 1.0
+    x_out, y_out = lttb(x, y, 100)
+    assert len(x_out) == 100
+    assert x_out[0] == 0 and x_out[-1] == 9999
+    assert 4321 in x_out
+
+
+def test_min_max_keeps_extremes():
+    x = np.arange(10001.0)
+    y = np.random.normal(size=10001)
+    x_out, y_out = min_max(x, y, 100)
+    assert y_out.max() == y.max()
+    assert y_out.min() == y.min()
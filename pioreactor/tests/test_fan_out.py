@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from pioreactor.cli import fan_out
+
+
+def test_fan_out_bounds_concurrency_and_reports_each_unit(monkeypatch):
+    # no SSH here: the "connection" is always open, and the commands run locally.
+    in_flight, max_in_flight = [0], [0]
+    lock = threading.Lock()
+
+    def connect(unit, timeout):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        time.sleep(0.05)
+        with lock:
+            in_flight[0] -= 1
+        return 0, "", ""
+
+    monkeypatch.setattr(fan_out, "connect", connect)
+
+    def commands_for_unit(unit):
+        if unit == "missing_config":
+            raise FileNotFoundError("no config for missing_config")
+        elif unit == "fails":
+            return [["true"], ["sh", "-c", "echo oops >&2; exit 3"], ["false"]]
+        elif unit == "hangs":
+            return [["sleep", "5"]]
+        return [["echo", unit]]
+
+    units = ["unit1", "fails", "hangs", "missing_config", "unit2", "unit3"]
+    start = time.monotonic()
+    results = fan_out.fan_out(units, commands_for_unit, timeout=0.5, max_workers=2)
+
+    assert time.monotonic() - start < 3
+    assert max_in_flight[0] <= 2
+    assert [result.unit for result in results] == units
+
+    results = {result.unit: result for result in results}
+    assert results["unit1"].ok and results["unit1"].stdout == "unit1\n"
+    # stops at the first command that fails.
+    assert results["fails"].exit_code == 3 and results["fails"].stderr == "oops\n"
+    assert results["hangs"].exit_code is None and "Timed out" in results["hangs"].stderr
+    assert results["missing_config"].exit_code is None
+
+    assert not fan_out.report(results.values())
+    assert fan_out.report([results["unit1"], results["unit2"]])
@@ -2,9 +2,13 @@
 import json
 import time
 import numpy as np
+from types import SimpleNamespace
+
+import pytest
 
 from pioreactor.background_jobs.growth_rate_calculating import GrowthRateCalculator
 from pioreactor.pubsub import publish
+from pioreactor.utils import batch_codec
 from pioreactor.whoami import get_unit_name, get_latest_experiment_name
 
 unit = get_unit_name()
@@ -35,6 +39,7 @@ def test_subscribing(monkeypatch):
         retain=True,
     )
     publish(f"pioreactor/{unit}/{experiment}/growth_rate", 1.0, retain=True)
+    pause()
     calc = GrowthRateCalculator(unit=unit, experiment=experiment)
     pause()
     assert calc.initial_growth_rate == 1.0
@@ -284,7 +289,137 @@ def test_scaling_works():
     assert (
         (
             calc.ekf.observation_noise_covariance
-            - 30 * np.array([[1e-4 / 0.8 ** 2, 0], [0, 1e-6 / 0.5 ** 2]])
+            - 30 * np.array([[1e-4 / 0.8**2, 0], [0, 1e-6 / 0.5**2]])
         )
         < 1e-7
     ).all()
+
+
+def test_od_filtered_batched_matches_per_channel_topics(monkeypatch):
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_normalization/median",
+        json.dumps({"135/0": 0.5, "90/1": 0.8}),
+        retain=True,
+    )
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_normalization/variance",
+        json.dumps({"135/0": 1e-6, "90/1": 1e-4}),
+        retain=True,
+    )
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_raw_batched",
+        '{"135/0": 0.5, "90/1": 0.8}',
+        retain=True,
+    )
+    publish(f"pioreactor/{unit}/{experiment}/growth_rate", "", retain=True)
+
+    calc = GrowthRateCalculator(unit=unit, experiment=experiment)
+
+    published = {}
+    monkeypatch.setattr(
+        calc,
+        "publish",
+        lambda topic, payload, **kwargs: published.update({topic: payload}),
+    )
+    calc.update_state_from_observation(
+        SimpleNamespace(payload='{"135/0": 0.51, "90/1": 0.82}')
+    )
+
+    prefix = f"pioreactor/{unit}/{experiment}"
+    batch = batch_codec.decode(published[f"{prefix}/od_filtered_batched"]).readings
+    assert batch == {
+        "135/0": published[f"{prefix}/od_filtered/135/0"],
+        "90/1": published[f"{prefix}/od_filtered/90/1"],
+    }
+
+
+def test_noisy_sample_variances_dont_destabilize_the_filter(monkeypatch):
+    import copy
+
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_normalization/median",
+        json.dumps({"135/0": 0.5, "90/1": 0.8}),
+        retain=True,
+    )
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_normalization/variance",
+        json.dumps({"135/0": 1e-6, "90/1": 1e-6}),
+        retain=True,
+    )
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_raw_batched",
+        '{"135/0": 0.5, "90/1": 0.8}',
+        retain=True,
+    )
+    publish(f"pioreactor/{unit}/{experiment}/growth_rate", "", retain=True)
+    pause()
+
+    calc = GrowthRateCalculator(unit=unit, experiment=experiment)
+    monkeypatch.setattr(calc, "publish", lambda *args, **kwargs: None)
+    # the same filter, without sample variances.
+    reference = copy.deepcopy(calc.ekf)
+
+    rng = np.random.RandomState(0)
+    covariances = []
+    for i in range(500):
+        # the variance of 3 samples (ddof=1) is very noisy, and sometimes way off.
+        variances = 1e-6 * rng.chisquare(2, size=2) / 2
+        if i % 50 == 0:
+            variances[0] *= 100
+        calc.update_obs_noise_covariance_from_sample_variances(
+            SimpleNamespace(payload=batch_codec.encode(dict(zip(calc.angles, variances))))
+        )
+        covariances.append(np.diag(calc.ekf.observation_noise_covariance))
+
+        growth = np.exp(0.05 * i * calc.dt)
+        observation = {"135/0": 0.5 * growth, "90/1": 0.8 * growth}
+        observation = {k: v + 1e-3 * rng.randn() for k, v in observation.items()}
+        calc.update_state_from_observation(
+            SimpleNamespace(payload=json.dumps(observation))
+        )
+        reference.update(
+            calc.scale_observation_batch(SimpleNamespace(readings=observation))
+        )
+
+    # no single message moves the observation covariance much.
+    covariances = np.array(covariances)
+    assert (np.abs(np.diff(covariances, axis=0)) / covariances[:-1] < 0.1).all()
+    # the angles are equally noisy, so neither is trusted much more than the other.
+    assert (covariances.max(axis=1) / covariances.min(axis=1) < 2).all()
+
+    assert np.isfinite(calc.state_).all()
+    assert abs(calc.state_[-1] - reference.state_[-1]) < 0.01
+
+
+def test_retained_state_is_closed_if_starting_up_fails(monkeypatch):
+    from pioreactor.pubsub import RetainedMessageCache
+
+    closed = []
+    close = RetainedMessageCache.close
+
+    def record_close(self):
+        closed.append(self)
+        close(self)
+
+    def fail(self):
+        raise ValueError("couldn't start")
+
+    monkeypatch.setattr(RetainedMessageCache, "close", record_close)
+    monkeypatch.setattr(GrowthRateCalculator, "initialize_extended_kalman_filter", fail)
+
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_normalization/median",
+        '{"135/0": 1, "90/0": 1}',
+        retain=True,
+    )
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_normalization/variance",
+        '{"135/0": 1, "90/0": 1}',
+        retain=True,
+    )
+    pause()
+
+    with pytest.raises(ValueError):
+        GrowthRateCalculator(unit=unit, experiment=experiment)
+    assert len(closed) == 1
+    assert not closed[0].client.is_connected()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import sys
+import time
+
+from pioreactor.utils import job_registry
+
+
+def test_registering_is_per_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_registry, "get_registry_dir", lambda: str(tmp_path))
+
+    assert not job_registry.is_running("stirring")
+    assert job_registry.register("stirring")
+    # this process can register it again, see BackgroundJob.check_for_duplicate_process
+    assert job_registry.register("stirring")
+    assert job_registry.is_running("stirring")
+    assert job_registry.jobs_running() == ["stirring"]
+
+    job_registry.unregister("stirring")
+    assert job_registry.is_running("stirring")
+    job_registry.unregister("stirring")
+    assert not job_registry.is_running("stirring")
+    assert not (tmp_path / "stirring.lock").exists()
+
+
+def test_another_process_holding_the_lock_is_running(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_registry, "get_registry_dir", lambda: str(tmp_path))
+
+    # another process registers od_reading, then dies without unregistering.
+    other = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import fcntl, os, time;"
+            f"fd = os.open({str(tmp_path / 'od_reading.lock')!r}, os.O_RDWR | os.O_CREAT);"
+            "fcntl.flock(fd, fcntl.LOCK_EX); print('locked', flush=True); time.sleep(30)",
+        ],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    try:
+        assert other.stdout.readline().strip() == "locked"
+        assert job_registry.is_running("od_reading")
+        assert not job_registry.register("od_reading")
+    finally:
+        other.kill()
+        other.wait()
+
+    # its lock file is stale, and cleaned up.
+    time.sleep(0.1)
+    assert job_registry.jobs_running() == []
+    assert not (tmp_path / "od_reading.lock").exists()
+    assert job_registry.register("od_reading")
+    job_registry.unregister("od_reading")
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from pioreactor.background_jobs.leader import log_aggregating
+from pioreactor.background_jobs.leader.log_aggregating import LogAggregation
+from pioreactor.whoami import UNIVERSAL_EXPERIMENT
+
+leader = "leader"
+
+
+def log(experiment, message, unit="unit1"):
+    return SimpleNamespace(
+        topic=f"pioreactor/{unit}/{experiment}/app_logs_for_ui", payload=message.encode()
+    )
+
+
+def clear(experiment):
+    return SimpleNamespace(
+        topic=f"pioreactor/{leader}/{experiment}/log_aggregating/aggregated_log_table/set",
+        payload=b"",
+    )
+
+
+def read(path):
+    with open(path) as f:
+        return [entry["message"] for entry in json.load(f)]
+
+
+def create_log_aggregation(output, write_every_n_seconds=None, **kwargs):
+    # we pass logs to on_message ourselves, and by default write ourselves too.
+    return LogAggregation(
+        ["pioreactor/+/+/test_log_aggregating"],
+        output,
+        write_every_n_seconds=write_every_n_seconds,
+        experiment=UNIVERSAL_EXPERIMENT,
+        unit=leader,
+        **kwargs,
+    )
+
+
+def test_aggregated_log_table_is_per_experiment_when_partitioned(tmp_path):
+    logs = create_log_aggregation(
+        str(tmp_path / "logs.json"), partition_by_experiment=True
+    )
+
+    logs.on_message(log("exp1", "hello"))
+    logs.on_message(log("exp2", "world"))
+    logs.on_message(log("exp2", "again"))
+
+    table = logs.aggregated_log_table
+    assert list(table) == ["exp1", "exp2"]
+    assert [entry["message"] for entry in table["exp2"]] == ["again", "world"]
+
+
+def test_clearing_all_experiments_clears_partitions_on_disk(tmp_path):
+    logs = create_log_aggregation(
+        str(tmp_path / "logs.json"),
+        partition_by_experiment=True,
+        max_partitions_in_memory=1,
+    )
+
+    logs.on_message(log("exp1", "hello"))
+    logs.on_message(log("exp2", "world"))  # exp1 is evicted from memory
+    logs.write_if_dirty()
+    assert read(tmp_path / "logs_exp1.json") == ["hello"]
+    assert list(logs.aggregated_log_table) == ["exp2"]
+
+    logs.clear(clear(UNIVERSAL_EXPERIMENT))
+
+    assert read(tmp_path / "logs_exp1.json") == []
+    assert read(tmp_path / "logs_exp2.json") == []
+
+
+def test_clearing_an_experiment_only_clears_its_partition(tmp_path):
+    logs = create_log_aggregation(
+        str(tmp_path / "logs.json"), partition_by_experiment=True
+    )
+
+    logs.on_message(log("exp1", "hello"))
+    logs.on_message(log("exp2", "world"))
+    logs.clear(clear("exp1"))
+
+    assert read(tmp_path / "logs_exp1.json") == []
+    assert read(tmp_path / "logs_exp2.json") == ["world"]
+
+
+def test_a_burst_of_logs_is_one_write(tmp_path, monkeypatch):
+    output = str(tmp_path / "logs.json")
+    writes = []
+    monkeypatch.setattr(
+        log_aggregating, "write_atomically", lambda path, text: writes.append(path)
+    )
+    logs = create_log_aggregation(output)
+
+    for i in range(100):
+        logs.on_message(log("exp1", f"log {i}"))
+    assert writes == []
+
+    logs.write_if_dirty()
+    assert writes == [output]
+
+    # nothing new, nothing to write.
+    logs.write_if_dirty()
+    assert writes == [output]
+
+
+def test_logs_are_written_on_a_timer(tmp_path):
+    output = str(tmp_path / "logs.json")
+    logs = create_log_aggregation(output, write_every_n_seconds=0.1, log_display_count=10)
+
+    for i in range(100):
+        logs.on_message(log("exp1", f"log {i}"))
+    time.sleep(0.5)
+
+    # newest first, and only the latest log_display_count.
+    assert read(output) == [f"log {i}" for i in range(99, 89, -1)]
+
+
+def test_a_failed_write_leaves_the_previous_file(tmp_path, monkeypatch):
+    output = str(tmp_path / "logs.json")
+    logs = create_log_aggregation(output)
+    logs.on_message(log("exp1", "hello"))
+    logs.write_if_dirty()
+
+    def disk_full(fd):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(os, "fsync", disk_full)
+    logs.on_message(log("exp1", "world"))
+    with pytest.raises(OSError):
+        logs.write_if_dirty()
+
+    # readers never see a partially written file.
+    assert read(output) == ["hello"]
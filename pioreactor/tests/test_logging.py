@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+import time
+from types import SimpleNamespace
+
+import pioreactor.logging
+from pioreactor.logging import MQTTHandler
+
+
+def test_mqtt_handler_batches_and_drops_debug_under_pressure(monkeypatch):
+    published = []
+    broker_is_slow = threading.Event()
+
+    def slow_publish(topic, payload, **kwargs):
+        broker_is_slow.wait()
+        published.append((topic, payload))
+        return SimpleNamespace(rc=0)
+
+    monkeypatch.setattr(
+        pioreactor.logging,
+        "create_client",
+        lambda **kwargs: SimpleNamespace(publish=slow_publish),
+    )
+
+    handler = MQTTHandler(lambda: "pioreactor/testing/logs/app", max_queue_size=10)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+
+    logger = logging.getLogger("test_mqtt_handler")
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+
+    # the handler's thread is stuck publishing this one.
+    logger.info("first")
+    time.sleep(0.1)
+
+    for i in range(20):
+        logger.debug(f"debug {i}")
+    logger.info("last")
+
+    broker_is_slow.set()
+    handler.close()
+    logger.removeHandler(handler)
+
+    # once half the queue is full, DEBUG records are dropped, but not INFO.
+    assert handler.stats == {
+        "queued": 7,
+        "dropped": 15,
+        "published": 2,
+        "publish_errors": 0,
+        "connection_errors": 0,
+    }
+    assert published[0] == ("pioreactor/testing/logs/app", "first")
+
+    topic, payload = published[1]
+    assert topic == "pioreactor/testing/logs/app_batched"
+    assert [log["message"] for log in json.loads(payload)] == [
+        *(f"debug {i}" for i in range(5)),
+        "last",
+    ]
+
+
+def test_mqtt_handler_retries_connecting_to_the_broker(monkeypatch):
+    published = []
+    attempts = {}
+    sleeps = []
+
+    def create_client(client_id, **kwargs):
+        attempts[client_id] = attempts.get(client_id, 0) + 1
+        if attempts[client_id] < 3:
+            # ex: the leader is restarting.
+            raise ConnectionRefusedError()
+        return SimpleNamespace(
+            publish=lambda topic, payload, **kwargs: (
+                published.append((topic, payload)),
+                SimpleNamespace(rc=0),
+            )[1]
+        )
+
+    monkeypatch.setattr(pioreactor.logging, "create_client", create_client)
+    monkeypatch.setattr(pioreactor.logging, "time", SimpleNamespace(sleep=sleeps.append))
+
+    handler = MQTTHandler("pioreactor/testing/logs/app")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.handle(logging.makeLogRecord({"msg": "hello", "levelno": logging.INFO}))
+    handler.close()
+
+    # the root logger's MQTT handlers publish the warnings about connecting, not us.
+    assert [
+        payload for topic, payload in published if topic == "pioreactor/testing/logs/app"
+    ] == ["hello"]
+    assert handler.stats["connection_errors"] == 2
+    assert sorted(set(sleeps)) == [5, 10]
+
+
+def test_importing_the_cli_is_fast_and_lazy():
+    import os
+    import subprocess
+    import sys
+
+    # -X importtime writes "import time: self [us] | cumulative [us] | module" lines to stderr.
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import pioreactor.cli.pio"],
+        env={**os.environ, "TESTING": "1", "HOSTNAME": "localhost"},
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    cumulative_us = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, module = line[len("import time:") :].split("|")
+            if cumulative.strip().isdigit():
+                cumulative_us[module.strip()] = int(cumulative)
+
+    # nothing heavy, like the jobs or their dependencies, is imported just to parse the command line.
+    for module in [
+        "numpy",
+        "paho",
+        "adafruit_ads1x15",
+        "RPi",
+        "pioreactor.background_jobs.stirring",
+    ]:
+        assert module not in cumulative_us
+
+    # it's ~100ms on a laptop. The budget is generous, since it depends on the machine, but catches
+    # something heavy being imported at the top of a module again.
+    print(
+        f"import pioreactor.cli.pio: {cumulative_us['pioreactor.cli.pio'] / 1000:.0f}ms"
+    )
+    assert cumulative_us["pioreactor.cli.pio"] < 1_000_000
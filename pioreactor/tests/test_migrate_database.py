@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import logging
+import sqlite3
+from datetime import datetime
+
+from pioreactor.actions.leader.migrate_database import migrate_database
+from pioreactor.storage import SCHEMA_VERSION
+
+
+def create_old_database(database):
+    # the schema before version 1: local-time ISO8601 TEXT timestamps, and no user_version.
+    con = sqlite3.connect(database)
+    con.executescript("""
+        CREATE TABLE od_readings_raw (
+            timestamp              TEXT  NOT NULL,
+            pioreactor_unit        TEXT  NOT NULL,
+            od_reading_v           REAL  NOT NULL,
+            experiment             TEXT  NOT NULL,
+            angle                  TEXT  NOT NULL
+        );
+        CREATE INDEX od_readings_raw_ix ON od_readings_raw (experiment);
+
+        CREATE TABLE logs (
+            timestamp              TEXT,
+            experiment             TEXT  NOT NULL,
+            message                TEXT  NOT NULL,
+            pioreactor_unit        TEXT  NOT NULL,
+            source                 TEXT
+        );
+
+        CREATE TABLE experiments (
+            experiment             TEXT  NOT NULL UNIQUE,
+            timestamp              TEXT  NOT NULL,
+            description            TEXT
+        );
+        """)
+    con.executemany(
+        "INSERT INTO od_readings_raw VALUES (?, 'unit1', ?, 'exp', '90')",
+        [
+            ("2021-03-01T12:00:00.250000", 0.1),
+            ("2021-03-01T12:00:05", 0.2),
+            # written by a new mqtt_to_db_streaming, before the migration.
+            ("1614600010000", 0.3),
+            ("not a time", 0.4),
+        ],
+    )
+    con.executemany(
+        "INSERT INTO logs VALUES (?, 'exp', ?, 'unit1', 'app')",
+        [("2021-03-01T12:00:00", "hello"), (None, "no time"), ("", "empty")],
+    )
+    con.execute("INSERT INTO experiments VALUES ('exp', '2021-03-01T11:00:00', '')")
+    con.commit()
+    con.close()
+
+
+def local_iso_to_ms(iso):
+    return round(datetime.fromisoformat(iso).timestamp() * 1000)
+
+
+def test_migration_converts_timestamps_and_keeps_unparseable_rows(tmp_path, caplog):
+    database = str(tmp_path / "pioreactor.sqlite")
+    create_old_database(database)
+
+    with caplog.at_level(logging.INFO, logger="migrate_database"):
+        migrate_database(database)
+
+    con = sqlite3.connect(database)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    assert con.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    columns = {
+        name: type_ for _, name, type_, *_ in con.execute("PRAGMA table_info(logs)")
+    }
+    assert columns["timestamp"] == "INTEGER"
+
+    assert con.execute(
+        "SELECT timestamp, od_reading_v FROM od_readings_raw ORDER BY timestamp"
+    ).fetchall() == [
+        (local_iso_to_ms("2021-03-01T12:00:00.250000"), 0.1),
+        (local_iso_to_ms("2021-03-01T12:00:05"), 0.2),
+        (1614600010000, 0.3),
+    ]
+    assert con.execute("SELECT timestamp, message FROM logs").fetchall() == [
+        (local_iso_to_ms("2021-03-01T12:00:00"), "hello")
+    ]
+
+    # nothing is lost: rows that couldn't be migrated are kept, and counted.
+    assert con.execute(
+        "SELECT timestamp, od_reading_v FROM od_readings_raw_unparseable"
+    ).fetchall() == [("not a time", 0.4)]
+    assert con.execute(
+        "SELECT timestamp, message FROM logs_unparseable ORDER BY message"
+    ).fetchall() == [
+        ("", "empty"),
+        (None, "no time"),
+    ]
+    assert "Moved 1 rows with unparseable timestamps from od_readings_raw" in caplog.text
+    assert "Moved 2 rows with unparseable timestamps from logs" in caplog.text
+
+    # the new indexes end in timestamp, and tables that aren't time series are left alone.
+    assert [
+        name for _, _, name in con.execute("PRAGMA index_info(od_readings_raw_ix)")
+    ] == ["experiment", "pioreactor_unit", "angle", "timestamp", "od_reading_v"]
+    assert con.execute("SELECT timestamp FROM experiments").fetchall() == [
+        ("2021-03-01T11:00:00",)
+    ]
+    con.close()
+
+
+def test_migrating_twice_is_safe(tmp_path):
+    database = str(tmp_path / "pioreactor.sqlite")
+    create_old_database(database)
+
+    migrate_database(database)
+    con = sqlite3.connect(database)
+    after_first = con.execute("SELECT * FROM od_readings_raw").fetchall()
+    con.close()
+
+    migrate_database(database)
+    con = sqlite3.connect(database)
+    assert con.execute("SELECT * FROM od_readings_raw").fetchall() == after_first
+    (n_unparseable,) = con.execute(
+        "SELECT COUNT(*) FROM od_readings_raw_unparseable"
+    ).fetchone()
+    assert n_unparseable == 1
+    con.close()
+
+
+def test_migrating_a_new_database_is_a_no_op(tmp_path):
+    database = str(tmp_path / "pioreactor.sqlite")
+    con = sqlite3.connect(database)
+    with open("sql/create_tables.sql") as f:
+        con.executescript(f.read())
+    con.execute("INSERT INTO growth_rates VALUES (1614600000000, 'exp', 0.1, 'unit1')")
+    con.commit()
+    con.close()
+
+    migrate_database(database)
+
+    con = sqlite3.connect(database)
+    assert con.execute("SELECT * FROM growth_rates").fetchall() == [
+        (1614600000000, "exp", 0.1, "unit1")
+    ]
+    con.close()
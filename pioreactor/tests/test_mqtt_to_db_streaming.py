@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import time
+
+from pioreactor.background_jobs.leader.mqtt_to_db_streaming import BatchedDBWriter
+
+
+def create_database(tmp_path, create_table=True):
+    database = str(tmp_path / "pioreactor.sqlite")
+    con = sqlite3.connect(database)
+    if create_table:
+        con.execute("CREATE TABLE growth_rates (timestamp INTEGER, rate REAL)")
+    con.close()
+    return database
+
+
+def read_rates(database):
+    con = sqlite3.connect(database)
+    rates = [
+        rate for (rate,) in con.execute("SELECT rate FROM growth_rates ORDER BY rate")
+    ]
+    con.close()
+    return rates
+
+
+def test_writer_flushes_everything_on_close(tmp_path):
+    database = create_database(tmp_path)
+    writer = BatchedDBWriter(database, flush_every_n_rows=4)
+
+    for i in range(10):
+        writer.write("growth_rates", {"timestamp": i, "rate": float(i)})
+    writer.close()
+
+    assert read_rates(database) == [float(i) for i in range(10)]
+    assert writer.stats["rows_written"] == 10
+    assert writer.stats["dropped_rows"] == 0
+
+
+def test_write_does_not_block_when_the_writer_is_behind(tmp_path):
+    database = create_database(tmp_path)
+    # never flushes on its own, so the rows pile up.
+    writer = BatchedDBWriter(
+        database, flush_every_n_rows=1000, flush_every_n_ms=60_000, max_pending_rows=5
+    )
+
+    start = time.time()
+    for i in range(10):
+        writer.write("growth_rates", {"timestamp": i, "rate": float(i)})
+    assert time.time() - start < 1
+
+    writer.close()
+    assert read_rates(database) == [0.0, 1.0, 2.0, 3.0, 4.0]
+    assert writer.stats["dropped_rows"] == 5
+
+
+def test_failed_flushes_are_retried(tmp_path):
+    database = create_database(tmp_path, create_table=False)
+    writer = BatchedDBWriter(database, flush_every_n_rows=1, retry_after_s=0.5)
+    writer.write("growth_rates", {"timestamp": 0, "rate": 0.0})
+
+    # the first attempt fails with "no table", an OperationalError like "database is locked".
+    deadline = time.time() + 5
+    while writer.stats["errors"] == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    create_database(tmp_path)
+
+    writer.close()
+    assert read_rates(database) == [0.0]
+    assert writer.stats["errors"] == 1
+    assert writer.stats["dropped_rows"] == 0
+
+
+def test_rows_are_dropped_and_counted_after_the_last_attempt(tmp_path):
+    database = create_database(tmp_path, create_table=False)
+    writer = BatchedDBWriter(database, flush_attempts=2, retry_after_s=0.01)
+
+    writer.write("growth_rates", {"timestamp": 0, "rate": 0.0})
+    writer.write("growth_rates", {"timestamp": 1, "rate": 1.0})
+    writer.close()
+
+    assert writer.stats["errors"] == 2
+    assert writer.stats["dropped_rows"] == 2
+    assert writer.stats["rows_written"] == 0
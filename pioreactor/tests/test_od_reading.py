@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import pioreactor.background_jobs.od_reading
+from pioreactor.background_jobs.od_reading import ODReader, REDUCERS
+from pioreactor.utils import batch_codec
+from pioreactor.whoami import get_unit_name, get_latest_experiment_name
+
+unit = get_unit_name()
+experiment = get_latest_experiment_name()
+
+
+@pytest.fixture(autouse=True)
+def no_ir_led(monkeypatch):
+    # the IR LED's DAC isn't available in tests.
+    monkeypatch.setattr(
+        pioreactor.background_jobs.od_reading,
+        "led_intensity",
+        lambda *args, **kwargs: True,
+    )
+
+
+def test_direct_mode_hands_readings_to_od_reader_in_process():
+    od = ODReader(
+        {0: "135/0", 1: "90/1"},
+        sampling_rate=1000,  # we take the readings ourselves.
+        fake_data=True,
+        direct=True,
+        publish_per_channel=False,
+        unit=unit,
+        experiment=experiment,
+    )
+    published, published_by_adc = [], []
+    od.publish = lambda topic, payload, **kwargs: published.append((topic, payload))
+    od.adc_reader.publish = lambda topic, payload, **kwargs: published_by_adc.append(
+        topic
+    )
+
+    try:
+        od.adc_reader.take_reading()
+
+        # nothing goes through the adc/ topics, and only the batch is published.
+        assert published_by_adc == []
+        assert [topic for topic, _ in published] == [
+            f"pioreactor/{unit}/{experiment}/od_raw_batched"
+        ]
+        batch = batch_codec.decode(published[0][1])
+        assert set(batch.readings) == {"135/0", "90/1"}
+
+        published.clear()
+        od.publish_per_channel = True
+        od.adc_reader.take_reading()
+        assert [topic for topic, _ in published] == [
+            f"pioreactor/{unit}/{experiment}/od_raw/135/0",
+            f"pioreactor/{unit}/{experiment}/od_raw/90/1",
+            f"pioreactor/{unit}/{experiment}/od_raw_batched",
+        ]
+    finally:
+        od.adc_reader.timer.cancel()
+
+
+def test_direct_mode_publishes_oversampled_variances():
+    od = ODReader(
+        {0: "135/0"},
+        sampling_rate=1000,
+        fake_data=True,
+        direct=True,
+        publish_per_channel=False,
+        unit=unit,
+        experiment=experiment,
+    )
+    published = []
+    od.publish = lambda topic, payload, **kwargs: published.append((topic, payload))
+    od.adc_reader.oversampling = 5
+
+    try:
+        od.adc_reader.take_reading()
+    finally:
+        od.adc_reader.timer.cancel()
+
+    topics = dict(published)
+    variances = batch_codec.decode(
+        topics[f"pioreactor/{unit}/{experiment}/od_raw_variance_batched"]
+    )
+    assert set(variances.readings) == {"135/0"}
+    assert variances.readings["135/0"] >= 0
+
+
+def test_reducers_reduce_each_channel():
+    samples = np.array([[1.0, 2.0, 3.0, 4.0, 100.0] * 2, [0.5] * 10])
+
+    assert REDUCERS["mean"](samples).tolist() == [22.0, 0.5]
+    assert REDUCERS["median"](samples).tolist() == [3.0, 0.5]
+    # the trimmed mean drops the lowest and highest 10% of samples: one 1.0 and one 100.0.
+    assert REDUCERS["trimmed_mean"](samples).tolist() == [
+        (1.0 + 2.0 * 2 + 3.0 * 2 + 4.0 * 2 + 100.0) / 8,
+        0.5,
+    ]
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pioreactor.pubsub import (
+    publish,
+    publish_client_pool,
+    get_retained_messages,
+    RetainedMessageCache,
+    SharedConnection,
+    QOS,
+)
+from pioreactor.config import leader_hostname
+from pioreactor.whoami import get_unit_name, get_latest_experiment_name
+
+unit = get_unit_name()
+experiment = get_latest_experiment_name()
+
+
+def test_publish_reuses_a_single_client_across_threads():
+    topic = f"pioreactor/{unit}/{experiment}/test_pubsub/threads"
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: publish(topic, i), range(200)))
+
+    client = publish_client_pool.get_client(leader_hostname)
+    publish(topic, "last", qos=QOS.EXACTLY_ONCE)
+    assert publish_client_pool.get_client(leader_hostname) is client
+
+
+def test_publish_benchmark():
+    """
+    Compare publishes per second between paho's `publish.single` (a new connection per message)
+    and our pooled `publish`. Run with `pytest -s` to see the numbers, they aren't asserted on.
+    """
+    from paho.mqtt import publish as mqtt_publish
+
+    topic = f"pioreactor/{unit}/{experiment}/test_pubsub/benchmark"
+    N = 200
+
+    start = time.perf_counter()
+    for i in range(N):
+        mqtt_publish.single(topic, payload=i, hostname=leader_hostname)
+    single_rate = N / (time.perf_counter() - start)
+
+    publish(topic, "warm up")
+    start = time.perf_counter()
+    for i in range(N):
+        publish(topic, i)
+    pooled_rate = N / (time.perf_counter() - start)
+
+    print(
+        f"publish.single: {single_rate:.0f} msg/s, pooled publish: {pooled_rate:.0f} msg/s"
+    )
+
+
+def test_retained_message_cache_gathers_retained_messages_in_one_round_trip():
+    topics = [
+        f"pioreactor/{unit}/{experiment}/test_pubsub/retained/{i}" for i in range(5)
+    ]
+    for i, topic in enumerate(topics[:3]):
+        publish(topic, i, retain=True, qos=QOS.EXACTLY_ONCE)
+    publish(topics[3], None, retain=True, qos=QOS.EXACTLY_ONCE)
+    time.sleep(0.25)
+
+    start = time.time()
+    with RetainedMessageCache(topics, timeout=5) as cache:
+        # shouldn't wait the full timeout for topics without a retained message.
+        assert time.time() - start < 2.5
+        assert [float(cache.get(topic).payload) for topic in topics[:3]] == [0, 1, 2]
+        assert cache.get(topics[3]) is None
+        assert cache.get(topics[4]) is None
+
+        # the live subscription keeps the cache fresh
+        publish(topics[4], "new")
+        assert cache.wait_for(topics[4], timeout=2).payload == b"new"
+
+    for topic in topics:
+        publish(topic, None, retain=True)
+
+
+def test_get_retained_messages():
+    topic = f"pioreactor/{unit}/{experiment}/test_pubsub/get_retained_messages"
+    publish(topic, "value", retain=True, qos=QOS.EXACTLY_ONCE)
+    time.sleep(0.25)
+    assert get_retained_messages(topic)[topic].payload == b"value"
+
+    publish(topic, None, retain=True, qos=QOS.EXACTLY_ONCE)
+
+    # the broker clears the retained message asynchronously.
+    deadline = time.time() + 5
+    while get_retained_messages(topic) and time.time() < deadline:
+        time.sleep(0.1)
+    assert get_retained_messages(topic) == {}
+
+
+def test_connection_readiness_is_signalled_by_on_connect():
+    from pioreactor.pubsub import ConnectionReadiness, create_client
+
+    reconnects = []
+    readiness = ConnectionReadiness(on_reconnect=lambda *args: reconnects.append(args))
+    client = create_client(on_connect=readiness.on_connect)
+
+    assert readiness.wait(timeout=5)
+    assert readiness.latency is not None and readiness.latency < 5
+    assert reconnects == []
+
+    client.reconnect()
+    time.sleep(0.5)
+    assert len(reconnects) == 1
+
+    client.loop_stop()
+    client.disconnect()
+
+
+def test_closing_a_shared_connection_while_dispatching_messages_does_not_deadlock():
+    topic = f"pioreactor/{unit}/{experiment}/test_pubsub/close"
+    connection = SharedConnection(hostname=leader_hostname)
+    channel = connection.open_channel()
+
+    in_callback = threading.Event()
+
+    def slow_callback(client, userdata, message):
+        in_callback.set()
+        # meanwhile, close_channel runs, and the next message waits to be dispatched.
+        time.sleep(0.5)
+
+    channel.subscribe(topic, slow_callback, qos=QOS.EXACTLY_ONCE)
+    time.sleep(0.5)
+    publish(topic, "first", qos=QOS.EXACTLY_ONCE)
+    publish(topic, "second", qos=QOS.EXACTLY_ONCE)
+    assert in_callback.wait(timeout=5)
+
+    closer = threading.Thread(target=channel.close, daemon=True)
+    closer.start()
+    closer.join(timeout=10)
+    assert not closer.is_alive()
+    assert connection.client is None
+
+
+def test_retained_messages_are_only_delivered_to_the_channel_that_subscribed():
+    prefix = f"pioreactor/{unit}/{experiment}/test_pubsub/overlapping"
+    publish(f"{prefix}/a", "1", retain=True, qos=QOS.EXACTLY_ONCE)
+    publish(f"{prefix}/b", "2", retain=True, qos=QOS.EXACTLY_ONCE)
+    time.sleep(0.25)
+
+    connection = SharedConnection(hostname=leader_hostname)
+    channels = [connection.open_channel() for _ in range(3)]
+    received = [[], [], []]
+
+    def collect(i):
+        return lambda client, userdata, message: received[i].append(
+            (message.topic, message.payload)
+        )
+
+    try:
+        channels[0].subscribe(f"{prefix}/#", collect(0), qos=QOS.EXACTLY_ONCE)
+        time.sleep(0.5)
+        # overlaps with the first channel's subscription, and then the same subscription.
+        channels[1].subscribe(f"{prefix}/b", collect(1), qos=QOS.EXACTLY_ONCE)
+        channels[2].subscribe(f"{prefix}/#", collect(2), qos=QOS.EXACTLY_ONCE)
+        time.sleep(0.5)
+
+        assert sorted(received[0]) == [(f"{prefix}/a", b"1"), (f"{prefix}/b", b"2")]
+        assert received[1] == [(f"{prefix}/b", b"2")]
+        assert sorted(received[2]) == [(f"{prefix}/a", b"1"), (f"{prefix}/b", b"2")]
+
+        # but live messages go to every channel subscribed.
+        publish(f"{prefix}/a", "3", qos=QOS.EXACTLY_ONCE)
+        time.sleep(0.5)
+        assert received[0][-1] == received[2][-1] == (f"{prefix}/a", b"3")
+        assert [len(r) for r in received] == [3, 1, 3]
+    finally:
+        for channel in channels:
+            channel.close()
+        publish(f"{prefix}/a", None, retain=True, qos=QOS.EXACTLY_ONCE)
+        publish(f"{prefix}/b", None, retain=True, qos=QOS.EXACTLY_ONCE)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import time
+from statistics import median, variance
+from types import SimpleNamespace
+
+import numpy as np
+
+import pioreactor.storage
+from pioreactor.actions.leader.replay_growth_rate import replay_growth_rate
+from pioreactor.background_jobs.growth_rate_calculating import GrowthRateCalculator
+from pioreactor.pubsub import publish
+from pioreactor.whoami import get_unit_name
+
+unit = get_unit_name()
+experiment = "test_replay_growth_rate"
+
+
+def pause():
+    # to avoid race conditions when updating state
+    time.sleep(0.5)
+
+
+def test_replay_agrees_with_a_live_growth_rate_calculator(tmp_path, monkeypatch):
+    database = str(tmp_path / "pioreactor.sqlite")
+    con = sqlite3.connect(database)
+    with open("sql/create_tables.sql") as f:
+        con.executescript(f.read())
+
+    # a growing culture, two sensors, and a dosing event halfway through.
+    rng = np.random.RandomState(0)
+    batches = [
+        {
+            "135/0": 0.5 * np.exp(0.002 * i) + 0.001 * rng.randn(),
+            "90/1": 0.8 * np.exp(0.002 * i) + 0.001 * rng.randn(),
+        }
+        for i in range(100)
+    ]
+    timestamps = [1_600_000_000_000 + 5000 * i for i in range(100)]
+    dosing_event_timestamp = timestamps[50] - 2500
+
+    con.executemany(
+        "INSERT INTO od_readings_raw VALUES (?, ?, ?, ?, ?)",
+        [
+            (timestamp + offset, unit, batch[angle], experiment, angle)
+            for timestamp, batch in zip(timestamps, batches)
+            for offset, angle in enumerate(["135/0", "90/1"])
+        ],
+    )
+    con.execute(
+        "INSERT INTO dosing_events VALUES (?, ?, ?, ?, ?, ?)",
+        (dosing_event_timestamp, experiment, "add_media", 1.0, unit, "test"),
+    )
+    con.commit()
+
+    monkeypatch.setattr(pioreactor.storage, "get_database", lambda: database)
+    replay_growth_rate(experiment, unit)
+    replayed_rates = [
+        rate
+        for (rate,) in con.execute(
+            "SELECT rate FROM growth_rates WHERE experiment=? ORDER BY timestamp",
+            (experiment,),
+        )
+    ]
+    con.close()
+
+    # live, with the same normalization the replay computes from the first readings.
+    first_batches = batches[:35]
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_normalization/median",
+        json.dumps({a: median(b[a] for b in first_batches) for a in batches[0]}),
+        retain=True,
+    )
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_normalization/variance",
+        json.dumps({a: variance(b[a] for b in first_batches) for a in batches[0]}),
+        retain=True,
+    )
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_raw_batched",
+        json.dumps(batches[0]),
+        retain=True,
+    )
+    publish(f"pioreactor/{unit}/{experiment}/growth_rate", None, retain=True)
+    pause()
+
+    calc = GrowthRateCalculator(unit=unit, experiment=experiment)
+    monkeypatch.setattr(calc, "publish", lambda *args, **kwargs: None)
+
+    # the first batch initializes the filter, like the retained od_raw_batched does live.
+    live_rates = []
+    for i, batch in enumerate(batches[1:], start=1):
+        if i == 50:
+            calc.update_ekf_variance_after_dosing_event(None)
+        calc.update_state_from_observation(SimpleNamespace(payload=json.dumps(batch)))
+        live_rates.append(calc.state_[-1])
+
+    assert len(replayed_rates) == len(live_rates) == 99
+    assert np.allclose(replayed_rates, live_rates)
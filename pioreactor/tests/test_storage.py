@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import pytest
+
+import pioreactor.storage
+from pioreactor.actions.leader import backup_database as backup_database_module
+from pioreactor.storage import (
+    connect_writer,
+    connect_reader,
+    read_connection,
+    ReadConnectionPool,
+)
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    database = str(tmp_path / "pioreactor.sqlite")
+    con = connect_writer(database)
+    con.execute("CREATE TABLE growth_rates (timestamp INTEGER, rate REAL)")
+    con.execute("INSERT INTO growth_rates VALUES (1, 0.1)")
+    con.commit()
+    con.close()
+
+    monkeypatch.setattr(pioreactor.storage, "get_database", lambda: database)
+    return database
+
+
+def test_the_writer_puts_the_database_in_wal_mode_and_applies_pragmas(database):
+    con = connect_writer(database)
+    assert con.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert con.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    assert con.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+    assert con.execute("PRAGMA cache_size").fetchone()[0] == -16000
+    assert con.execute("PRAGMA temp_store").fetchone()[0] == 2  # MEMORY
+    con.close()
+
+    # journal_mode is persistent, readers see it too.
+    reader = connect_reader(database)
+    assert reader.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    reader.close()
+
+
+def test_readers_are_read_only(database):
+    reader = connect_reader(database)
+    assert reader.execute("PRAGMA query_only").fetchone()[0] == 1
+
+    with pytest.raises(sqlite3.OperationalError):
+        reader.execute("INSERT INTO growth_rates VALUES (2, 0.2)")
+    reader.close()
+
+
+def test_readers_dont_wait_on_an_open_write_transaction(database):
+    writer = connect_writer(database)
+    writer.execute("INSERT INTO growth_rates VALUES (2, 0.2)")
+    assert writer.in_transaction
+
+    # in WAL mode, we read the last committed state right away, instead of waiting busy_timeout.
+    with read_connection() as con:
+        assert con.execute("SELECT rate FROM growth_rates").fetchall() == [(0.1,)]
+
+    writer.commit()
+    with read_connection() as con:
+        assert con.execute("SELECT rate FROM growth_rates").fetchall() == [(0.1,), (0.2,)]
+    writer.close()
+
+
+def test_the_pool_reuses_connections(database):
+    pool = ReadConnectionPool(database, max_idle=1)
+
+    with pool.connection() as first:
+        with pool.connection() as second:
+            assert first is not second
+
+    # only one is kept, the other was closed.
+    with pool.connection() as con:
+        assert con is second
+        with pytest.raises(sqlite3.ProgrammingError):
+            first.execute("SELECT 1")
+
+        # an open read transaction is rolled back when the connection is returned.
+        con.execute("BEGIN")
+        con.execute("SELECT * FROM growth_rates").fetchall()
+    assert not con.in_transaction
+    pool.close()
+
+
+def test_read_connection_pools_per_database(database, tmp_path):
+    other = str(tmp_path / "other.sqlite")
+    connect_writer(other).close()
+
+    with read_connection() as con:
+        pass
+    with read_connection(database) as same:
+        assert same is con
+    with read_connection(other) as different:
+        assert different is not con
+
+
+def test_backup_database_copies_committed_rows(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        backup_database_module, "get_active_workers_in_inventory", lambda: []
+    )
+    writer = connect_writer(database)
+    writer.execute("INSERT INTO growth_rates VALUES (2, 0.2)")
+
+    # the backup reads through a read-only connection, so it doesn't wait on the writer.
+    output = str(tmp_path / "backup.sqlite")
+    backup_database_module.backup_database(output)
+    writer.commit()
+    writer.close()
+
+    backup = sqlite3.connect(output)
+    assert backup.execute("SELECT rate FROM growth_rates").fetchall() == [(0.1,)]
+    backup.close()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import time
+import numpy as np
+
+from pioreactor.utils.streaming_calculations import ExtendedKalmanFilter
+
+
+def create_ekf(n_sensors=3):
+    d = n_sensors + 1
+    initial_state = np.array([0.5] * n_sensors + [0.01])
+    initial_covariance = 0.0001 * np.eye(d)
+    process_noise_covariance = np.diag([1e-6] * n_sensors + [1e-9])
+    observation_noise_covariance = 1e-4 * np.diag(np.arange(1, d))
+    return ExtendedKalmanFilter(
+        initial_state,
+        initial_covariance,
+        process_noise_covariance,
+        observation_noise_covariance,
+        dt=5 / 60 / 60,
+    )
+
+
+def test_fast_update_agrees_with_generic_update():
+    fast, generic = create_ekf(), create_ekf()
+    rng = np.random.RandomState(0)
+
+    for i in range(500):
+        observation = 0.5 * np.exp(0.1 * i * 5 / 60 / 60) + 0.01 * rng.randn(3)
+        if i == 250:
+            fast.scale_OD_variance_for_next_n_steps(5e3, 10)
+            generic.scale_OD_variance_for_next_n_steps(5e3, 10)
+        fast.update(observation)
+        generic.update_generic(observation)
+
+    assert np.allclose(fast.state_, generic.state_, rtol=1e-6, atol=1e-9)
+    assert np.allclose(fast.covariance_, generic.covariance_, rtol=1e-4, atol=1e-12)
+    assert np.allclose(fast.covariance_, fast.covariance_.T)
+
+
+def test_update_benchmark():
+    """
+    Compare the cost of the fast update and the generic update. Run with `pytest -s` to see the numbers.
+    Only reports them, timings on a shared machine are too noisy to assert on. That the updates agree is
+    tested above.
+    """
+    N = 2000
+    observation = [0.5, 0.51, 0.49]
+
+    def cost_per_update(update):
+        # best of 3, to reduce noise from other processes
+        costs = []
+        for _ in range(3):
+            start = time.perf_counter()
+            for _ in range(N):
+                update(observation)
+            costs.append((time.perf_counter() - start) / N)
+        return min(costs)
+
+    generic_cost = cost_per_update(create_ekf().update_generic)
+    fast_cost = cost_per_update(create_ekf().update)
+
+    print(
+        f"generic update: {1e6 * generic_cost:.1f}µs, fast update: {1e6 * fast_cost:.1f}µs"
+    )
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 import time
+import json
+
+import pytest
+
+import pioreactor.background_jobs.leader.time_series_aggregating as time_series_aggregating
 from pioreactor.background_jobs.leader.time_series_aggregating import (
     TimeSeriesAggregation,
+    RingBuffer,
+    read_time_series,
 )
 from pioreactor.pubsub import publish
+from pioreactor.utils import batch_codec
 from pioreactor.whoami import get_unit_name, UNIVERSAL_EXPERIMENT
 
 unit = get_unit_name()
@@ -186,6 +194,112 @@ def test_passes_multiple_experiments_when_allowed():
     assert [_["y"] for _ in ts.aggregated_time_series["data"][0]] == [1.0, 1.1]
 
 
+def test_partitions_by_experiment(tmp_path):
+    output_dir = str(tmp_path) + "/"
+
+    def unit_from_topic(topic):
+        return topic.split("/")[1]
+
+    ts = TimeSeriesAggregation(
+        "pioreactor/+/+/growth_rate",
+        output_dir=output_dir,
+        experiment=experiment,
+        unit=leader,
+        ignore_cache=True,
+        extract_label=unit_from_topic,
+        record_every_n_seconds=0.1,
+        write_every_n_seconds=0.1,
+        partition_by_experiment=True,
+        max_partitions_in_memory=1,
+    )
+    pause()  # for our subscription
+
+    publish(f"pioreactor/{unit}/exp1/growth_rate", 1.0)
+    pause()
+    publish(f"pioreactor/{unit}/exp2/growth_rate", 1.1)
+    pause()
+
+    # exp1 was evicted from memory, but written first.
+    assert list(ts.aggregated_time_series) == ["exp2"]
+    with open(output_dir + f"{ts.job_name}_exp1.json") as f:
+        assert [_["y"] for _ in json.load(f)["data"][0]] == [1.0]
+    with open(output_dir + f"{ts.job_name}_exp2.json") as f:
+        assert [_["y"] for _ in json.load(f)["data"][0]] == [1.1]
+
+
+def test_clearing_all_experiments_clears_partitions_on_disk(tmp_path):
+    output_dir = str(tmp_path) + "/"
+
+    def unit_from_topic(topic):
+        return topic.split("/")[1]
+
+    ts = TimeSeriesAggregation(
+        "pioreactor/+/+/growth_rate",
+        output_dir=output_dir,
+        experiment=experiment,
+        unit=leader,
+        ignore_cache=True,
+        extract_label=unit_from_topic,
+        record_every_n_seconds=0.1,
+        write_every_n_seconds=0.1,
+        partition_by_experiment=True,
+        max_partitions_in_memory=1,
+    )
+    pause()  # for our subscription
+
+    publish(f"pioreactor/{unit}/exp1/growth_rate", 1.0)
+    pause()
+    publish(f"pioreactor/{unit}/exp2/growth_rate", 1.1)
+    pause()
+    assert list(ts.aggregated_time_series) == ["exp2"]
+
+    publish(
+        f"pioreactor/{leader}/{experiment}/time_series_aggregating/aggregated_time_series/set",
+        None,
+    )
+    pause()
+
+    # exp1 was only on disk.
+    for name in ["exp1", "exp2"]:
+        with open(output_dir + f"{ts.job_name}_{name}.json") as f:
+            assert json.load(f) == {"series": [], "data": []}
+
+
+def test_batched_topics_are_labelled_like_their_per_channel_topics(tmp_path):
+    def single_sensor_label_from_topic(topic):
+        split_topic = topic.split("/")
+        return f"{split_topic[1]}-{split_topic[-1]}"
+
+    ts = TimeSeriesAggregation(
+        f"pioreactor/+/{experiment}/od_raw_batched",
+        output_dir=str(tmp_path) + "/",
+        experiment=experiment,
+        unit=leader,
+        ignore_cache=True,
+        extract_label=single_sensor_label_from_topic,
+        record_every_n_seconds=0.1,
+    )
+    pause()  # for our subscription
+
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_raw_batched",
+        batch_codec.encode({"135/0": 0.5, "90/1": 0.25}),
+    )
+    pause()
+    publish(
+        f"pioreactor/{unit}/{experiment}/od_raw_batched",
+        batch_codec.encode({"135/0": 0.75, "90/1": 0.5}, format=batch_codec.BINARY),
+    )
+    pause()
+
+    series = ts.aggregated_time_series
+    assert series["series"] == [f"{unit}-0", f"{unit}-1"]
+    assert [[point["y"] for point in points] for points in series["data"]] == [
+        [0.5, 0.75],
+        [0.25, 0.5],
+    ]
+
+
 def test_drops_really_old_data():
 
     publish(f"pioreactor/{unit}/exp1/growth_rate", None, retain=True)
@@ -247,3 +361,105 @@ def test_drops_retained_messages():
     publish(f"pioreactor/{unit}/exp2/growth_rate", 1.1, retain=True)
     pause()
     assert [_["y"] for _ in ts.aggregated_time_series["data"][0]] == [1.0, 1.1]
+
+
+def test_incremental_output_serves_snapshots_and_deltas(tmp_path):
+    output_dir = str(tmp_path) + "/"
+
+    def unit_from_topic(topic):
+        return topic.split("/")[1]
+
+    ts = TimeSeriesAggregation(
+        f"pioreactor/+/{experiment}/growth_rate",
+        output_dir=output_dir,
+        experiment=experiment,
+        unit=leader,
+        ignore_cache=True,
+        extract_label=unit_from_topic,
+        record_every_n_seconds=0.1,
+        write_every_n_seconds=0.1,
+        incremental=True,
+    )
+
+    publish(f"pioreactor/{unit}1/{experiment}/growth_rate", 1.0)
+    pause()
+    full = read_time_series(output_dir, ts.job_name)
+    assert full["snapshot"]
+    assert full["series"] == [f"{unit}1"]
+    since = full["data"][0][-1]["x"]
+
+    publish(f"pioreactor/{unit}1/{experiment}/growth_rate", 1.1)
+    pause()
+    delta = read_time_series(output_dir, ts.job_name, since=since)
+    assert not delta["snapshot"]
+    assert [point["y"] for point in delta["data"][0]] == [1.1]
+
+    publish(
+        f"pioreactor/{leader}/{experiment}/time_series_aggregating/aggregated_time_series/set",
+        None,
+    )
+    pause()
+    cleared = read_time_series(output_dir, ts.job_name, since=since)
+    assert cleared["snapshot"]
+    assert cleared["series"] == []
+
+
+def test_reading_time_series_retries_if_compacted_while_reading(tmp_path, monkeypatch):
+    output_dir = str(tmp_path) + "/"
+    job_name = "job"
+    with open(output_dir + "job.json", "w") as f:
+        json.dump({"series": ["unit1"], "data": [[{"x": 1, "y": 1.0}]]}, f)
+    with open(output_dir + "job.manifest.json", "w") as f:
+        json.dump(
+            {
+                "snapshot": "job.json",
+                "segment": "job.segment.1.jsonl",
+                "compacted_until": 1,
+                "generation": 1,
+                "time_window_seconds": None,
+            },
+            f,
+        )
+
+    # the segment is missing, as if the job compacted between us reading the manifest and the segment.
+    with pytest.raises(FileNotFoundError):
+        read_time_series(output_dir, job_name)
+
+    # the job finished compacting before we tried again.
+    read_once = time_series_aggregating._read_time_series
+    n_reads = []
+
+    def read_after_compaction(*args):
+        n_reads.append(1)
+        if len(n_reads) == 2:
+            open(output_dir + "job.segment.1.jsonl", "w").close()
+        return read_once(*args)
+
+    monkeypatch.setattr(
+        time_series_aggregating, "_read_time_series", read_after_compaction
+    )
+    assert read_time_series(output_dir, job_name)["series"] == ["unit1"]
+    assert len(n_reads) == 2
+
+
+def test_ring_buffer_grows_and_evicts_in_order():
+    buffer = RingBuffer(capacity=2)
+    for x in range(1, 6):
+        buffer.append(x, x / 10)
+    assert len(buffer) == 5
+
+    buffer.evict_up_to(2)
+    assert buffer.to_list() == [
+        {"x": 3, "y": 0.3},
+        {"x": 4, "y": 0.4},
+        {"x": 5, "y": 0.5},
+    ]
+
+    # wraps around the end of the arrays
+    buffer.append(6, 0.6)
+    buffer.append(7, 0.7)
+    buffer.evict_up_to(5)
+    assert buffer.to_list() == [{"x": 6, "y": 0.6}, {"x": 7, "y": 0.7}]
+
+    buffer.evict_up_to(10)
+    assert buffer.to_list() == []
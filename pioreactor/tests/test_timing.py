@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+from pioreactor.utils.timing import RepeatedTimer
+
+
+def stopped_timer(interval, policy=RepeatedTimer.SKIP):
+    timer = RepeatedTimer(interval, lambda: None, policy=policy)
+    timer.cancel()
+    return timer
+
+
+def test_repeated_timer_does_not_drift():
+    timer = stopped_timer(0.2)
+
+    # the next tick is an interval after the last tick's deadline, not after the callback finished.
+    assert timer._next_deadline(1.0, now=1.05) == (1.2, 0)
+    assert timer._next_deadline(1.0, now=1.0) == (1.2, 0)
+
+
+def test_repeated_timer_runs_slightly_late_ticks():
+    # regression: a 0.21s callback on a 0.2s interval ran every other tick.
+    timer = stopped_timer(0.2)
+
+    next_deadline, n_missed = timer._next_deadline(0.0, now=0.21)
+    assert n_missed == 0 and abs(next_deadline - 0.2) < 1e-9
+
+
+def test_repeated_timer_skips_missed_ticks():
+    timer = stopped_timer(0.1)
+
+    # late by more than an interval: the ticks at 0.1 and 0.2 are skipped, and 0.3 runs late.
+    next_deadline, n_missed = timer._next_deadline(0.0, now=0.35)
+    assert n_missed == 2 and abs(next_deadline - 0.3) < 1e-9
+
+
+def test_repeated_timer_catch_up():
+    timer = stopped_timer(0.1, policy=RepeatedTimer.CATCH_UP)
+
+    next_deadline, n_missed = timer._next_deadline(0.0, now=0.35)
+    assert n_missed == 0 and abs(next_deadline - 0.1) < 1e-9
+
+
+def test_a_blocking_callback_does_not_stall_other_timers():
+    unblock = threading.Event()
+    other_timer_ran = threading.Event()
+
+    blocking = RepeatedTimer(0.01, unblock.wait, run_immediately=True)
+    other = RepeatedTimer(0.05, other_timer_ran.set)
+
+    try:
+        assert other_timer_ran.wait(timeout=10)
+    finally:
+        unblock.set()
+        blocking.cancel()
+        other.cancel()
+
+    assert other.stats["runs"] >= 1
+
+
+def test_a_timer_without_an_interval_only_runs_immediately():
+    runs = []
+    never = RepeatedTimer(None, lambda: runs.append("never"))
+    once = RepeatedTimer(None, lambda: runs.append("once"), run_immediately=True)
+
+    time.sleep(0.5)
+    never.cancel()
+    once.cancel()
+    assert runs == ["once"]
+
+
+def test_falling_behind_is_counted_and_logged_once(caplog):
+    skipping = stopped_timer(0.1)
+    catching_up = stopped_timer(0.1, policy=RepeatedTimer.CATCH_UP)
+
+    with caplog.at_level(logging.WARNING):
+        for _ in range(2):
+            # the generation is stale, so the ticks aren't rescheduled.
+            skipping._fire(time.monotonic() - 0.35, generation=-1)
+            catching_up._fire(time.monotonic() - 0.35, generation=-1)
+
+    assert skipping.stats["skipped"] == 4 and skipping.stats["caught_up"] == 0
+    assert catching_up.stats["skipped"] == 0 and catching_up.stats["caught_up"] == 2
+
+    warnings = [r.getMessage() for r in caplog.records if r.levelno == logging.WARNING]
+    assert len(warnings) == 2
+    assert "skipping missed ticks" in warnings[0] and "'skipped': 2" in warnings[0]
+    assert "catching up on missed ticks" in warnings[1]
@@ -2,35 +2,39 @@
 
 
 def pio_jobs_running():
-    import psutil
-
-    jobs = []
-    for proc in psutil.process_iter(attrs=["pid", "name", "cmdline"]):
-        try:
-            if (
-                proc.info["cmdline"]
-                and (proc.info["cmdline"][0] == "/usr/bin/python3")
-                and (proc.info["cmdline"][1] == "/usr/local/bin/pio")  # not pios!
-            ):
-                # TODO: needs to be more specific, this fails often
-                job = proc.info["cmdline"][3]
-                jobs.append(job)
-        except Exception:
-            pass
-    return jobs
+    # see job_registry
+    from pioreactor.utils import job_registry
+
+    return job_registry.jobs_running()
+
+
+def is_pio_job_running(job_name):
+    from pioreactor.utils import job_registry
+
+    return job_registry.is_running(job_name)
 
 
 def execute_query_against_db(query):
     # must run on leader
-    import sqlite3
-    from pioreactor.config import config
-
-    conn = sqlite3.connect(config["storage"]["database"])
-    cur = conn.cursor()
-    cur.execute(query)
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    from pioreactor.storage import read_connection
+
+    with read_connection() as conn:
+        return conn.execute(query).fetchall()
+
+
+def write_atomically(path, text):
+    """
+    Write `text` to a temporary file next to `path`, then rename it over `path`. Readers (ex: the UI)
+    see either the old or the new file, never a partially written one.
+    """
+    import os
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode="wt") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
 
 
 def pump_ml_to_duration(ml, duty_cycle, duration_=0):
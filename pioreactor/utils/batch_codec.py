@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Encoding and decoding of the batched readings published on the od_reading pipeline, i.e. the payloads of
+
+    pioreactor/<unit>/<experiment>/adc_batched
+    pioreactor/<unit>/<experiment>/od_raw_batched
+
+Two formats are supported:
+
+1. json (default): a json object of key -> value, ex: {"135/0": 0.086, "90/1": 0.0877}
+2. binary: a compact, packed frame. At higher sampling rates, most of the pipeline's CPU is spent in json.
+
+The binary frame is little-endian:
+
+    magic      uint8     0xB1
+    timestamp  float64   unix time the readings were taken
+    gain       float32   the ADC gain used, NaN if unknown
+    n          uint8     number of readings
+    n x (key length uint8, key utf-8 bytes)
+    n x value  float32
+
+so a binary frame holds at most 255 readings, with keys of at most 255 bytes.
+
+Consumers should use `decode`, which accepts both formats, so publishers can switch
+format without coordinating with subscribers.
+"""
+import json
+import struct
+import sys
+from array import array
+from collections import namedtuple
+
+JSON = "json"
+BINARY = "binary"
+FORMATS = (JSON, BINARY)
+
+MAGIC = 0xB1
+HEADER = struct.Struct("<BdfB")
+# the number of readings and the keys' lengths are uint8s.
+MAX_READINGS = 255
+MAX_KEY_BYTES = 255
+
+Batch = namedtuple("Batch", ["readings", "timestamp", "gain"])
+
+
+def encode(readings, format=JSON, timestamp=None, gain=None):
+    """
+    Parameters
+    -----------
+    readings: dict of (key: float) pairs. Keys are converted to str.
+    format: str
+        one of "json" or "binary". A ValueError is raised if the readings don't fit in a binary
+        frame, see above.
+    timestamp, gain: float
+        only included in the binary format.
+
+    Returns
+    --------
+    str or bytes
+    """
+    if format == JSON:
+        return json.dumps({str(k): v for k, v in readings.items()})
+    elif format == BINARY:
+        keys = [str(k).encode("utf-8") for k in readings]
+        if len(keys) > MAX_READINGS:
+            raise ValueError(
+                f"A binary frame holds at most {MAX_READINGS} readings, not {len(keys)}."
+            )
+        for key in keys:
+            if len(key) > MAX_KEY_BYTES:
+                raise ValueError(
+                    f"Keys in a binary frame are at most {MAX_KEY_BYTES} bytes, and "
+                    f"{key.decode('utf-8')[:20]}... is {len(key)} bytes."
+                )
+
+        values = array("f", readings.values())
+        if sys.byteorder == "big":
+            values.byteswap()  # frames are little-endian
+
+        return b"".join(
+            [
+                HEADER.pack(
+                    MAGIC,
+                    timestamp if timestamp is not None else float("nan"),
+                    gain if gain is not None else float("nan"),
+                    len(keys),
+                ),
+                *(bytes([len(key)]) + key for key in keys),
+                values.tobytes(),
+            ]
+        )
+    else:
+        raise ValueError(f"format must be one of {FORMATS}, not {format}.")
+
+
+def decode(payload):
+    """
+    Decode a json or binary payload into a Batch(readings, timestamp, gain). For json payloads, timestamp
+    and gain are None.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+
+    if not payload or payload[0] != MAGIC:
+        return Batch(json.loads(payload), None, None)
+
+    _, timestamp, gain, n = HEADER.unpack_from(payload)
+
+    keys = []
+    offset = HEADER.size
+    for _ in range(n):
+        length = payload[offset]
+        keys.append(payload[offset + 1 : offset + 1 + length].decode("utf-8"))
+        offset += 1 + length
+
+    values = array("f")
+    values.frombytes(payload[offset : offset + 4 * n])
+    if sys.byteorder == "big":
+        values.byteswap()
+
+    return Batch(
+        dict(zip(keys, values.tolist())),
+        None if timestamp != timestamp else timestamp,  # NaN check
+        None if gain != gain else gain,
+    )
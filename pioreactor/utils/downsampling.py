@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Reduce a time series to at most `n_out` points for plotting, keeping its visual shape. Both take and
+return numpy arrays x, y (x increasing), and return the input unchanged if it's already small enough.
+
+- lttb: Largest-Triangle-Three-Buckets (Steinarsson, 2013). Picks, from each bucket, the point that makes
+  the largest triangle with the previously picked point and the next bucket's average. Good general
+  purpose choice.
+- min_max: keeps each bucket's minimum and maximum. Cheaper, and never hides a spike.
+"""
+
+
+def lttb(x, y, n_out):
+    import numpy as np
+
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+
+    # the first and last points are always kept, the rest are split in n_out - 2 buckets.
+    edges = (np.arange(n_out - 1) * ((n - 2) / (n_out - 2))).astype(int) + 1
+    edges[-1] = n - 1
+
+    # each bucket's average, used as the third point of the next bucket's triangles.
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[:-1], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[:-1], edges[:-1]) / counts
+    avg_x = np.append(avg_x[1:], x[-1])
+    avg_y = np.append(avg_y[1:], y[-1])
+
+    selected = np.empty(n_out, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # twice the triangle's area, the constant factor doesn't change the argmax.
+        areas = np.abs(
+            (x[a] - avg_x[i]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y[i] - y[a])
+        )
+        a = lo + int(np.argmax(areas))
+        selected[i + 1] = a
+
+    return x[selected], y[selected]
+
+
+def min_max(x, y, n_out):
+    import numpy as np
+
+    n = len(x)
+    n_buckets = n_out // 2
+    if n_out >= n or n_buckets < 1:
+        return x, y
+
+    # equal sized buckets, the last one padded with NaNs.
+    size = -(-n // n_buckets)
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(n_buckets, size)
+
+    # buckets past the end of y are all NaNs, skip them.
+    n_buckets = -(-n // size)
+    padded = padded[:n_buckets]
+    offsets = np.arange(n_buckets) * size
+    selected = np.union1d(
+        offsets + np.nanargmin(padded, axis=1), offsets + np.nanargmax(padded, axis=1)
+    )
+
+    return x[selected], y[selected]
+
+
+DOWNSAMPLERS = {"lttb": lttb, "min_max": min_max}
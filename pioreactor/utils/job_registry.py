@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+A registry of the jobs running on this Pioreactor. Each running job holds an exclusive flock on
+<job_registry>/<job_name>.lock (the file contains its pid), taken on init and released on disconnect.
+
+The OS releases a process's locks when it exits, however it exits (kill -9, a crash), so a lock file
+that isn't locked is stale, and is removed by whoever notices. Checking if a job is running is one
+non-blocking lock attempt, instead of a walk over every process on the machine.
+
+Like the process walk this replaces, a process can register the same job more than once (ex: the
+tests) - only other processes count as duplicates.
+
+If the registry's directory can't be used, we fall back to looking for `pio run <job>` processes.
+"""
+import os
+import threading
+
+from pioreactor.config import config
+
+_lock = threading.Lock()
+_registered = {}  # job_name -> [fd, count], the jobs registered by this process
+
+
+def get_registry_dir():
+    return os.path.expanduser(
+        config.get("storage", "job_registry", fallback="~/.pioreactor/jobs")
+    )
+
+
+def lock_file_path(job_name):
+    return os.path.join(get_registry_dir(), f"{job_name}.lock")
+
+
+def register(job_name):
+    """
+    Returns False if another process has registered `job_name`, else True.
+    """
+    with _lock:
+        if job_name in _registered:
+            _registered[job_name][1] += 1
+            return True
+
+        try:
+            os.makedirs(get_registry_dir(), exist_ok=True)
+        except OSError:
+            return job_name not in _jobs_running_from_processes(exclude_pid=os.getpid())
+
+        path = lock_file_path(job_name)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            if not _try_to_lock_exclusively(fd):
+                os.close(fd)
+                return False
+
+            # the file may have been removed (as stale) between our open and flock. If so, our lock
+            # is on a file no one else will look at: try again.
+            try:
+                if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        _registered[job_name] = [fd, 1]
+        return True
+
+
+def unregister(job_name):
+    with _lock:
+        if job_name not in _registered:
+            return
+
+        _registered[job_name][1] -= 1
+        if _registered[job_name][1] > 0:
+            return
+
+        fd, _ = _registered.pop(job_name)
+        try:
+            # remove the file while we hold the lock, see `register`.
+            os.remove(lock_file_path(job_name))
+        except OSError:
+            pass
+        os.close(fd)
+
+
+def is_running(job_name):
+    with _lock:
+        if job_name in _registered:
+            return True
+
+    if not os.path.isdir(get_registry_dir()):
+        return job_name in _jobs_running_from_processes()
+
+    return _is_locked(lock_file_path(job_name))
+
+
+def jobs_running():
+    """
+    Returns the names of the jobs running on this Pioreactor, and removes stale lock files.
+    """
+    registry_dir = get_registry_dir()
+    if not os.path.isdir(registry_dir):
+        return _jobs_running_from_processes()
+
+    with _lock:
+        jobs = list(_registered)
+
+    for filename in os.listdir(registry_dir):
+        job_name, extension = os.path.splitext(filename)
+        if extension != ".lock" or job_name in jobs:
+            continue
+
+        if _is_locked(os.path.join(registry_dir, filename)):
+            jobs.append(job_name)
+    return jobs
+
+
+def _is_locked(path):
+    import fcntl
+
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return False
+
+    # a shared lock, so checks don't block each other. They still block a job registering, but only
+    # for a moment, see `register`.
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    else:
+        # no one holds it: the job exited without unregistering.
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return False
+    finally:
+        os.close(fd)
+
+
+def _try_to_lock_exclusively(fd, attempts=5):
+    # someone checking the registry holds a lock for a moment, a running job holds it until it exits.
+    import fcntl
+    import time
+
+    for _ in range(attempts):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            time.sleep(0.01)
+    return False
+
+
+def _jobs_running_from_processes(exclude_pid=None):
+    import psutil
+
+    jobs = []
+    for proc in psutil.process_iter(attrs=["pid", "cmdline"]):
+        try:
+            cmdline = proc.info["cmdline"] or []
+            # ex: /usr/bin/python3 /usr/local/bin/pio run <job> ..., from any interpreter. Not pios!
+            for i, arg in enumerate(cmdline[:-2]):
+                if os.path.basename(arg) == "pio" and cmdline[i + 1] == "run":
+                    if proc.info["pid"] != exclude_pid:
+                        jobs.append(cmdline[i + 2])
+                    break
+        except Exception:
+            pass
+    return jobs
@@ -116,6 +116,13 @@ class ExtendedKalmanFilter:
             : (self.dim - 1)
         ].copy()
 
+        # work buffers for `update`. The entries of F and A that don't change are set here.
+        self._F = np.eye(self.dim)
+        self._A = np.eye(self.dim)
+        self._H_transpose = self._jacobian_observation().T.copy()
+        self._state_prediction = np.empty(self.dim)
+        self._OD_diagonal = np.arange(self.dim - 1) * (self.dim + 1)
+
     def predict(self):
         return (
             self._predict_state(self.state_, self.covariance_),
@@ -123,6 +130,58 @@ class ExtendedKalmanFilter:
         )
 
     def update(self, observation):
+        """
+        A specialized version of the EKF update for our model. The process Jacobian is
+
+            F = [[exp(r∆t) I, OD exp(r∆t) ∆t],
+                 [0,          1             ]]
+
+        and the observation Jacobian is H = [I 0], so we fill F in a preallocated buffer, and take the products
+        with H as slices instead of matrix products. We solve the innovation step instead of
+        inverting the residual covariance, and use the Joseph form of the covariance update, which keeps the
+        covariance symmetric and positive definite.
+        """
+        import numpy as np
+
+        observation = np.asarray(observation, dtype=float)
+        self.update_counters()
+        assert (observation.shape[0] + 1) == self.state_.shape[0], (
+            (observation.shape[0] + 1),
+            self.state_.shape[0],
+        )
+        n = self.dim - 1
+        F, A, state_prediction = self._F, self._A, self._state_prediction
+
+        # predict
+        growth = np.exp(self.state_[-1] * self.dt)
+        np.multiply(self.state_, growth, out=state_prediction)
+        state_prediction[-1] = self.state_[-1]
+
+        F.flat[self._OD_diagonal] = growth
+        np.multiply(state_prediction[:-1], self.dt, out=F[:n, n])
+        covariance_prediction = F @ self.covariance_ @ F.T + self.process_noise_covariance
+
+        # update
+        residual_state = observation - state_prediction[:-1]
+        residual_covariance = (
+            covariance_prediction[:n, :n] + self.observation_noise_covariance
+        )
+        # K = P H^T S^-1, i.e. K^T = S^-1 H P, as S and P are symmetric.
+        kalman_gain = np.linalg.solve(residual_covariance, covariance_prediction[:n]).T
+        self.state_ = state_prediction + kalman_gain @ residual_state
+
+        # Joseph form: (I - KH) P (I - KH)^T + K R K^T
+        np.subtract(self._H_transpose, kalman_gain, out=A[:, :n])
+        self.covariance_ = (
+            A @ covariance_prediction @ A.T
+            + kalman_gain @ self.observation_noise_covariance @ kalman_gain.T
+        )
+        return
+
+    def update_generic(self, observation):
+        """
+        The textbook EKF update, using the Jacobians below. Slower than `update`, kept as a reference.
+        """
         import numpy as np
 
         observation = np.asarray(observation)
@@ -164,15 +223,11 @@ class ExtendedKalmanFilter:
     def _predict_state(self, state, covariance):
         import numpy as np
 
-        return np.array(
-            [v * np.exp(state[-1] * self.dt) for v in state[:-1]] + [state[-1]]
-        )
+        return np.append(state[:-1] * np.exp(state[-1] * self.dt), state[-1])
 
     def _predict_covariance(self, state, covariance):
-        return (
-            self._jacobian_process(state) @ covariance @ self._jacobian_process(state).T
-            + self.process_noise_covariance
-        )
+        J = self._jacobian_process(state)
+        return J @ covariance @ J.T + self.process_noise_covariance
 
     def _jacobian_process(self, state):
         import numpy as np
@@ -194,7 +249,7 @@ class ExtendedKalmanFilter:
         ODs = state[:-1]
 
         J[np.arange(d - 1), np.arange(d - 1)] = np.exp(rate * self.dt)
-        J[np.arange(d - 1), np.arange(1, d)] = ODs * np.exp(rate * self.dt) * self.dt
+        J[np.arange(d - 1), -1] = ODs * np.exp(rate * self.dt) * self.dt
         J[-1, -1] = 1.0
 
         return J
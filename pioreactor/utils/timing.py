@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 import time, sys, logging
-from threading import Timer
+import heapq
+import itertools
+import math
+import queue
+import threading
 
 
 def every(delay, task, *args, **kwargs):
@@ -30,6 +34,77 @@ def every(delay, task, *args, **kwargs):
         next_time += (time.time() - next_time) // delay * delay + delay
 
 
+class Scheduler:
+    """
+    Schedules all the RepeatedTimers in a process from a single thread. Deadlines are kept in a heap,
+    keyed on `time.monotonic()`, so wall-clock changes (ex: NTP syncing on boot) don't affect us.
+
+    Due callbacks are handed to a few worker threads, so a callback that blocks (ex: a sleep after an
+    error) only delays its own timer - unless `n_workers` callbacks block at once, then every timer in
+    the process waits. A timer's next tick is scheduled once its callback returns, so a timer never runs
+    concurrently with itself. Timers catch up (or skip) after a delay according to their policy, see
+    RepeatedTimer.
+    """
+
+    def __init__(self, n_workers=4):
+        self.n_workers = n_workers
+        self._heap = []  # (deadline, tie-breaker, timer, generation)
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._due = queue.Queue()
+        self._thread = None
+
+    def schedule(self, timer, deadline, generation):
+        with self._condition:
+            heapq.heappush(self._heap, (deadline, next(self._counter), timer, generation))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="scheduler", daemon=True
+                )
+                self._thread.start()
+                for i in range(self.n_workers):
+                    threading.Thread(
+                        target=self._work, name=f"scheduler-worker-{i}", daemon=True
+                    ).start()
+            self._condition.notify()
+
+    def wake(self):
+        with self._condition:
+            self._condition.notify()
+
+    def _next_due(self):
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                deadline, _, timer, generation = self._heap[0]
+                if generation != timer._generation:
+                    # cancelled, or restarted since this was scheduled.
+                    heapq.heappop(self._heap)
+                    continue
+
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    heapq.heappop(self._heap)
+                    return timer, deadline, generation
+
+                self._condition.wait(wait)
+
+    def _run(self):
+        while True:
+            self._due.put(self._next_due())
+
+    def _work(self):
+        while True:
+            timer, deadline, generation = self._due.get()
+            timer._fire(deadline, generation)
+
+
+scheduler = Scheduler()
+
+
 class RepeatedTimer:
     """
     A class for repeating a function in the background every N seconds.
@@ -43,44 +118,122 @@ class RepeatedTimer:
 
     To run a job right away (i.e. don't wait interval seconds), use run_immediately
 
+    Ticks are scheduled on the process's Scheduler, at fixed multiples of `interval` from the start, so
+    they don't drift by the time it takes to run `function`. If a tick is late by more than `interval`
+    (ex: a slow callback), the `policy` decides what to do with the missed ticks:
+
+     - "skip" (default): drop them, and stay on the original schedule. Same as `every`.
+     - "catch_up": run them back-to-back until we are on schedule again.
+
+    How late ticks run, and how many were skipped or caught up on, is recorded in `stats`, and logged
+    the first time the timer falls behind (and on cancel). With an `interval` of None, `function` only runs once if
+    run_immediately, else never (like threading.Timer).
+
     """
 
+    SKIP = "skip"
+    CATCH_UP = "catch_up"
+
     def __init__(
-        self, interval, function, run_immediately=False, job_name=None, *args, **kwargs
+        self,
+        interval,
+        function,
+        run_immediately=False,
+        job_name=None,
+        policy=SKIP,
+        *args,
+        **kwargs,
     ):
-        self._timer = None
+        assert policy in (self.SKIP, self.CATCH_UP), f"policy {policy} is not valid."
         self.interval = interval
         self.function = function
+        self.run_immediately = run_immediately
+        self.policy = policy
         self.args = args
         self.kwargs = kwargs
         self.is_running = False
         self.logger = logging.getLogger(job_name or "RepeatedTimer")
-        self.daemon = True
-        if run_immediately:
-            self._timer = Timer(0, self.function, self.args, self.kwargs)
-            self._timer.daemon = True
-            self._timer.start()
+        self.stats = {
+            "runs": 0,
+            "skipped": 0,
+            "caught_up": 0,
+            "mean_lateness": 0.0,
+            "max_lateness": 0.0,
+        }
+        self._fell_behind = False
+        self._generation = 0
+        self._lock = threading.Lock()
 
         self.start()
 
-    def _run(self):
-        self.is_running = False
-        self.start()
+    def start(self):
+        with self._lock:
+            if not self.is_running:
+                self.is_running = True
+                self._generation += 1
+                if self.interval is None and not self.run_immediately:
+                    return self
+                first_deadline = time.monotonic() + (
+                    0 if self.run_immediately else self.interval
+                )
+                scheduler.schedule(self, first_deadline, self._generation)
+        return self
+
+    def cancel(self):
+        with self._lock:
+            self.is_running = False
+            self._generation += 1
+        scheduler.wake()
+
+        if self.stats["runs"]:
+            self.logger.debug(f"Timer stats: {self.stats}")
+
+    def _fire(self, deadline, generation):
+        lateness = time.monotonic() - deadline
+        self._update_stats(lateness)
+
         try:
             self.function(*self.args, **self.kwargs)
         except Exception as e:
             self.logger.debug(e, exc_info=True)
             self.logger.error(e)
-            raise e
 
-    def start(self):
-        if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.daemon = True
-            self._timer.start()
-            self.is_running = True
-        return self
+        if self.interval is None:
+            return
 
-    def cancel(self):
-        self._timer.cancel()
-        self.is_running = False
+        now = time.monotonic()
+        next_deadline, n_missed = self._next_deadline(deadline, now)
+        # with catch_up, the next tick is already due, and runs right away.
+        n_caught_up = int(self.policy == self.CATCH_UP and now > next_deadline)
+        self.stats["skipped"] += n_missed
+        self.stats["caught_up"] += n_caught_up
+
+        if (n_missed or n_caught_up) and not self._fell_behind:
+            self._fell_behind = True
+            self.logger.warning(
+                f"Fell more than {self.interval}s behind schedule, "
+                f"{'skipping' if self.policy == self.SKIP else 'catching up on'} missed ticks. "
+                f"Timer stats: {self.stats}"
+            )
+
+        with self._lock:
+            # we may have been cancelled, or restarted, while running.
+            if generation == self._generation:
+                scheduler.schedule(self, next_deadline, generation)
+
+    def _next_deadline(self, deadline, now):
+        """
+        Returns the deadline of the tick after the one due at `deadline`, and how many ticks were skipped.
+        """
+        next_deadline = deadline + self.interval
+        n_missed = 0
+        if self.policy == self.SKIP and now > next_deadline:
+            # a tick late by less than `interval` still runs, like in `every`.
+            n_missed = math.floor((now - next_deadline) / self.interval)
+        return next_deadline + n_missed * self.interval, n_missed
+
+    def _update_stats(self, lateness):
+        stats = self.stats
+        stats["runs"] += 1
+        stats["mean_lateness"] += (lateness - stats["mean_lateness"]) / stats["runs"]
+        stats["max_lateness"] = max(stats["max_lateness"], lateness)
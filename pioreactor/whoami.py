@@ -13,9 +13,10 @@ def get_latest_experiment_name():
     if "pytest" in sys.modules or os.environ.get("TESTING"):
         return "testing_experiment"
 
-    from pioreactor.pubsub import subscribe
+    from pioreactor.pubsub import get_retained_messages
 
-    mqtt_msg = subscribe("pioreactor/latest_experiment", timeout=1)
+    topic = "pioreactor/latest_experiment"
+    mqtt_msg = get_retained_messages(topic, timeout=1).get(topic)
     if mqtt_msg:
         return mqtt_msg.payload.decode()
     else:
@@ -1,7 +1,15 @@
-# create_tables.sql
+-- create_tables.sql
+--
+-- Time series tables store timestamps as INTEGER milliseconds since the unix epoch (UTC), and their
+-- indexes end in timestamp, so time-range queries are index range scans. The indexes on the tables
+-- the charts read (od_readings_*, growth_rates) also include the value, so those queries never touch
+-- the table. Keep the indexes in sync with pioreactor/actions/leader/migrate_database.py.
+--
+-- Bump user_version (and storage.SCHEMA_VERSION) when the schema changes.
+PRAGMA user_version = 1;
 
 CREATE TABLE IF NOT EXISTS od_readings_raw (
-    timestamp              TEXT  NOT NULL,
+    timestamp              INTEGER NOT NULL, -- milliseconds since the unix epoch, UTC
     pioreactor_unit        TEXT  NOT NULL,
     od_reading_v           REAL  NOT NULL,
     experiment             TEXT  NOT NULL,
@@ -9,23 +17,23 @@ CREATE TABLE IF NOT EXISTS od_readings_raw (
 );
 
 CREATE INDEX IF NOT EXISTS od_readings_raw_ix
-ON od_readings_raw (experiment, pioreactor_unit, angle);
+ON od_readings_raw (experiment, pioreactor_unit, angle, timestamp, od_reading_v);
 
 
 CREATE TABLE IF NOT EXISTS alt_media_fraction (
-    timestamp              TEXT  NOT NULL,
+    timestamp              INTEGER NOT NULL, -- milliseconds since the unix epoch, UTC
     pioreactor_unit        TEXT  NOT NULL,
     alt_media_fraction     REAL  NOT NULL,
     experiment             TEXT  NOT NULL
 );
 
 CREATE INDEX IF NOT EXISTS alt_media_fraction_ix
-ON alt_media_fraction (experiment, pioreactor_unit);
+ON alt_media_fraction (experiment, pioreactor_unit, timestamp);
 
 
 
 CREATE TABLE IF NOT EXISTS od_readings_filtered (
-    timestamp              TEXT  NOT NULL,
+    timestamp              INTEGER NOT NULL, -- milliseconds since the unix epoch, UTC
     pioreactor_unit        TEXT  NOT NULL,
     od_reading_v           REAL  NOT NULL,
     experiment             TEXT  NOT NULL,
@@ -33,11 +41,11 @@ CREATE TABLE IF NOT EXISTS od_readings_filtered (
 );
 
 CREATE INDEX IF NOT EXISTS od_readings_filtered_ix
-ON od_readings_filtered (experiment, pioreactor_unit, angle);
+ON od_readings_filtered (experiment, pioreactor_unit, angle, timestamp, od_reading_v);
 
 
 CREATE TABLE IF NOT EXISTS dosing_events (
-    timestamp              TEXT  NOT NULL,
+    timestamp              INTEGER NOT NULL, -- milliseconds since the unix epoch, UTC
     experiment             TEXT  NOT NULL,
     event                  TEXT  NOT NULL,
     volume_change_ml       REAL  NOT NULL,
@@ -46,11 +54,11 @@ CREATE TABLE IF NOT EXISTS dosing_events (
 );
 
 CREATE INDEX IF NOT EXISTS dosing_events_ix
-ON dosing_events (experiment);
+ON dosing_events (experiment, pioreactor_unit, timestamp);
 
 
 CREATE TABLE IF NOT EXISTS led_events (
-    timestamp              TEXT  NOT NULL,
+    timestamp              INTEGER NOT NULL, -- milliseconds since the unix epoch, UTC
     experiment             TEXT  NOT NULL,
     event                  TEXT  NOT NULL,
     channel                TEXT  NOT NULL,
@@ -60,24 +68,24 @@ CREATE TABLE IF NOT EXISTS led_events (
 );
 
 CREATE INDEX IF NOT EXISTS led_events_ix
-ON led_events (experiment);
+ON led_events (experiment, pioreactor_unit, timestamp);
 
 
 
 CREATE TABLE IF NOT EXISTS growth_rates (
-    timestamp              TEXT  NOT NULL,
+    timestamp              INTEGER NOT NULL, -- milliseconds since the unix epoch, UTC
     experiment             TEXT  NOT NULL,
     rate                   REAL  NOT NULL,
     pioreactor_unit        TEXT  NOT NULL
 );
 
 CREATE INDEX IF NOT EXISTS growth_rates_ix
-ON growth_rates (experiment, pioreactor_unit);
+ON growth_rates (experiment, pioreactor_unit, timestamp, rate);
 
 
 
 CREATE TABLE IF NOT EXISTS logs (
-    timestamp              TEXT  NOT NULL,
+    timestamp              INTEGER NOT NULL, -- milliseconds since the unix epoch, UTC
     experiment             TEXT  NOT NULL,
     message                TEXT  NOT NULL,
     pioreactor_unit        TEXT  NOT NULL,
@@ -85,7 +93,7 @@ CREATE TABLE IF NOT EXISTS logs (
 );
 
 CREATE INDEX IF NOT EXISTS logs_ix
-ON logs (experiment);
+ON logs (experiment, timestamp);
 
 
 CREATE TABLE IF NOT EXISTS experiments (
@@ -99,7 +107,7 @@ ON experiments (experiment);
 
 
 CREATE TABLE IF NOT EXISTS pid_logs (
-    timestamp              TEXT  NOT NULL,
+    timestamp              INTEGER NOT NULL, -- milliseconds since the unix epoch, UTC
     pioreactor_unit        TEXT  NOT NULL,
     experiment             TEXT  NOT NULL,
     setpoint               REAL  NOT NULL,
@@ -116,7 +124,7 @@ CREATE TABLE IF NOT EXISTS pid_logs (
 );
 
 CREATE INDEX IF NOT EXISTS pid_logs_ix
-ON pid_logs (experiment);
+ON pid_logs (experiment, pioreactor_unit, timestamp);
 
 
 CREATE TABLE IF NOT EXISTS dosing_automation_settings (